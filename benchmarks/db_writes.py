@@ -0,0 +1,175 @@
+"""Benchmark of writes of tokens and settings: statements executed and time per call of the former
+read-then-write implementation and of the upserts of utils.manage_db. Run it from the root of repository:
+
+    python -m benchmarks.db_writes --calls 1000
+
+Caches of manage_db are cleared before every call, so the numbers show work of database. With warm caches
+unchanged records are not written at all.
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import manage_db  # noqa: E402
+from utils.manage_db import Tokens, Settings, DEFAULT_SETTINGS  # noqa: E402
+
+SCHEMA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sql_db.sql')
+
+
+class CountingCursor(sqlite3.Cursor):
+    def execute(self, *args):
+        self.connection.statements += 1
+        return super().execute(*args)
+
+    def executemany(self, *args):
+        self.connection.statements += 1
+        return super().executemany(*args)
+
+
+class CountingConnection(sqlite3.Connection):
+    """Connection which counts statements sent by application, statements run by triggers are not counted."""
+    statements = 0
+
+    def cursor(self, factory=CountingCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+    def commit(self):
+        self.statements += 1
+        super().commit()
+
+
+def legacy_add_athlete(db, tokens: Tokens):
+    """Implementation of manage_db.add_athlete before upserts."""
+    cur = db.cursor()
+    tokens_db = cur.execute('SELECT * FROM subscribers WHERE id = ?', (tokens.id,)).fetchone()
+    if not tokens_db:
+        cur.execute('INSERT INTO subscribers VALUES(?, ?, ?, ?)', tokens)
+    elif tokens.access_token != Tokens(*tokens_db).access_token:
+        sql = 'UPDATE subscribers SET access_token = ?, refresh_token = ?, expires_at = ? WHERE id = ?;'
+        cur.execute(sql, (*tokens[1:], tokens.id))
+    else:
+        return
+    db.commit()
+
+
+def legacy_add_settings(db, settings: Settings):
+    """Implementation of manage_db.add_settings before upserts."""
+    cur = db.cursor()
+    settings_db = cur.execute('SELECT * FROM settings WHERE id = ?', (settings.id,)).fetchone()
+    if settings_db:
+        if settings == Settings(*settings_db):
+            return
+        sql = 'UPDATE settings SET icon = ?, humidity = ?, wind = ?, aqi = ?, lan = ? WHERE id = ?;'
+        cur.execute(sql, (*settings[1:], settings.id))
+    else:
+        if settings[1:] == DEFAULT_SETTINGS[1:]:
+            return
+        cur.execute('INSERT INTO settings VALUES(?, ?, ?, ?, ?, ?)', settings)
+    db.commit()
+
+
+def legacy_add_athletes(db, tokens_list):
+    for tokens in tokens_list:
+        legacy_add_athlete(db, tokens)
+
+
+def new_tokens(i: int, generation: int = 0) -> Tokens:
+    return Tokens(i, f'access_{i}_{generation}', f'refresh_{i}_{generation}', 1600000000 + generation)
+
+
+def new_settings(i: int, generation: int = 0) -> Settings:
+    return Settings(i, generation % 2, 1, 1, 0, 'en')
+
+
+SCENARIOS = {
+    # name: (function of old implementation, function of new one, argument of i-th call, records to prepare)
+    'new athlete': ('add_athlete', lambda i: new_tokens(i), None),
+    'refreshed tokens': ('add_athlete', lambda i: new_tokens(i, 1), new_tokens),
+    'unchanged tokens': ('add_athlete', lambda i: new_tokens(i), new_tokens),
+    'new settings': ('add_settings', lambda i: new_settings(i), None),
+    'changed settings': ('add_settings', lambda i: new_settings(i, 1), new_settings),
+    'unchanged settings': ('add_settings', lambda i: new_settings(i), new_settings),
+}
+IMPLEMENTATIONS = {
+    'before': {'add_athlete': legacy_add_athlete, 'add_settings': legacy_add_settings},
+    'after': {'add_athlete': lambda db, arg: manage_db.add_athlete(arg),
+              'add_settings': lambda db, arg: manage_db.add_settings(arg)},
+}
+
+
+def make_db(path: str, prepared=None, calls: int = 0) -> CountingConnection:
+    db = sqlite3.connect(path, factory=CountingConnection)
+    for pragma in manage_db.PRAGMAS:
+        db.execute(pragma)
+    with open(SCHEMA) as f:
+        db.executescript(f.read())
+    if prepared is not None:
+        for i in range(calls):
+            record = prepared(i)
+            table = 'subscribers' if isinstance(record, Tokens) else 'settings'
+            db.execute(f'INSERT INTO {table} VALUES ({", ".join("?" * len(record))})', record)
+        db.commit()
+    db.statements = 0
+    return db
+
+
+def measure(db, function, args) -> dict:
+    started = time.perf_counter()
+    for arg in args:
+        manage_db.TOKENS_CACHE.clear()
+        manage_db.SETTINGS_CACHE.clear()
+        function(db, arg)
+    elapsed = time.perf_counter() - started
+    return {'statements_per_call': db.statements / len(args), 'us_per_call': elapsed / len(args) * 1e6}
+
+
+def run_benchmark(calls: int = 1000, batch: int = 100) -> dict:
+    """Compare implementations in every scenario and for batch refresh of tokens.
+
+    :return: dictionary scenario -> implementation -> results
+    """
+    report = {}
+    get_db = manage_db.get_db
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            for n, (scenario, (name, argument, prepared)) in enumerate(SCENARIOS.items()):
+                report[scenario] = {}
+                for version, functions in IMPLEMENTATIONS.items():
+                    db = make_db(os.path.join(tmp, f'{n}_{version}.db'), prepared, calls)
+                    manage_db.get_db = lambda: db
+                    report[scenario][version] = measure(db, functions[name], [argument(i) for i in range(calls)])
+            report[f'refresh of {batch} tokens'] = {}
+            batches = [[new_tokens(i, 1) for i in range(start, start + batch)] for start in range(0, calls, batch)]
+            for version, function in (('before', legacy_add_athletes),
+                                      ('after', lambda db, arg: manage_db.add_athletes(arg))):
+                db = make_db(os.path.join(tmp, f'batch_{version}.db'), new_tokens, calls)
+                manage_db.get_db = lambda: db
+                report[f'refresh of {batch} tokens'][version] = measure(db, function, batches)
+        finally:
+            manage_db.get_db = get_db
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=1000, help='number of calls in every scenario')
+    parser.add_argument('--batch', type=int, default=100, help='number of tokens refreshed in one batch')
+    args = parser.parse_args(argv)
+    print(json.dumps(run_benchmark(args.calls, args.batch), indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,109 @@
+"""Microbenchmark of rendering of descriptions: time per render of the former f-string implementation
+and of the prebuilt templates of utils.descriptions. Run it from the root of repository:
+
+    python -m benchmarks.descriptions --renders 100000
+
+Records cover all combinations of languages and settings, outputs of both implementations are compared.
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import descriptions  # noqa: E402
+
+LEGACY_PHRASES = {
+    'ru': ['по ощущениям', 'км/ч', 'с'],
+    'en': ['feels like', 'kph', 'from']
+}
+
+
+def legacy_compass_direction(degree, lan='en') -> str:
+    compass_arr = {'ru': ["С", "ССВ", "СВ", "ВСВ", "В", "ВЮВ", "ЮВ", "ЮЮВ",
+                          "Ю", "ЮЮЗ", "ЮЗ", "ЗЮЗ", "З", "ЗСЗ", "СЗ", "ССЗ", "С"],
+                   'en': ["N", "NNE", "NE", "ENE", "E", "ESE", "SE", "SSE",
+                          "S", "SSW", "SW", "WSW", "W", "WNW", "NW", "NNW", "N"]}
+    return compass_arr[lan][int((degree % 360) / 22.5 + 0.5)]
+
+
+def legacy_weather(w, lan, hum, wind) -> str:
+    t = LEGACY_PHRASES[lan]
+    feels_like = format(w['feelslike_c'], '.0f')
+    description = f"{w['condition']['text'].capitalize()}, " \
+                  f"🌡\xa0{w['temp_c']:.0f}°C ({t[0]} {'0' if feels_like == '-0' else feels_like}°C)"
+    description += f", 💦\xa0{w['humidity']}%" if hum else ""
+    if wind:
+        description += f", 💨\xa0{w['wind_kph']:.0f}{t[1]}"
+        if f"{w['wind_kph']:.0f}" != '0':
+            description += f" ({t[2]} {legacy_compass_direction(w['wind_degree'], lan)})."
+        else:
+            description += '.'
+    return description
+
+
+def legacy_air(aq, lan) -> str:
+    aqi = ['😃', '🙂', '😐', '🙁', '😨', '🤢'][aq['us-epa-index'] - 1]
+    air = {'ru': 'Воздух', 'en': 'Air'}
+    return f"\n{air[lan]} {aqi} {aq['pm2_5']:.1f}(PM2.5), " \
+           f"{aq['so2']:.0f}(SO₂), {aq['no2']:.0f}(NO₂), " \
+           f"{aq['o3']:.0f}(O₃), {aq['co']:.0f}(CO)."
+
+
+def make_records() -> list:
+    records = []
+    for i, (temp, wind_kph) in enumerate(itertools.product((-10.4, -0.4, 0, 0.3, 21.7), (0, 0.4, 0.6, 12.2, 35))):
+        records.append({'condition': {'text': 'partly cloudy', 'code': 1003}, 'temp_c': temp, 'feelslike_c': temp - 1.5,
+                        'humidity': 40 + i, 'wind_kph': wind_kph, 'wind_degree': (i * 37.3) % 400})
+    return records
+
+
+def make_air_records() -> list:
+    return [{'us-epa-index': index, 'pm2_5': 3.14 * index, 'so2': 0.5 * index, 'no2': 12.45, 'o3': 60.5, 'co': 210.7}
+            for index in range(1, 7)]
+
+
+def cases() -> list:
+    """All pairs of implementations of every combination of language and settings with arguments."""
+    result = []
+    for lan, hum, wind in itertools.product(('ru', 'en'), (0, 1), (0, 1)):
+        for w in make_records():
+            result.append((legacy_weather, (w, lan, hum, wind), descriptions.weather, (w, lan, hum, wind)))
+    for lan in ('ru', 'en'):
+        for aq in make_air_records():
+            result.append((legacy_air, (aq, lan), descriptions.air, (aq, lan)))
+    return result
+
+
+def measure(calls, renders: int) -> float:
+    """Return microseconds per render."""
+    started = time.perf_counter()
+    rounds = max(renders // len(calls), 1)
+    for _ in range(rounds):
+        for render, args in calls:
+            render(*args)
+    return (time.perf_counter() - started) / (rounds * len(calls)) * 1e6
+
+
+def run_benchmark(renders: int = 100000) -> dict:
+    pairs = cases()
+    mismatches = sum(before(*before_args) != after(*after_args) for before, before_args, after, after_args in pairs)
+    before_us = measure([(before, args) for before, args, _, _ in pairs], renders)
+    after_us = measure([(after, args) for _, _, after, args in pairs], renders)
+    return {'cases': len(pairs), 'mismatches': mismatches, 'before_us_per_render': round(before_us, 3),
+            'after_us_per_render': round(after_us, 3)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--renders', type=int, default=100000, help='number of renders of every implementation')
+    args = parser.parse_args(argv)
+    print(json.dumps(run_benchmark(args.renders), indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,63 @@
+"""Benchmark of cold start: time of import of the web application and of the worker of activities,
+measured by python -X importtime in a new interpreter. Run it from the root of repository:
+
+    python -m benchmarks.import_time --repeat 5
+
+The best of repeats is reported, so the numbers do not depend on the disk cache. Time of import is compared
+with import of the heaviest dependency of the module in the same run (ratio), so it does not depend on the machine.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULES = ('run', 'utils.worker')
+# Dependencies which are imported anyway, the rest of time of import is spent by the application
+REFERENCES = {'run': 'flask', 'utils.worker': 'requests'}
+
+
+def import_time(module: str) -> dict:
+    """Import module in new interpreter.
+
+    :return: dictionary with total time of imports in seconds and names of all imported modules
+    """
+    env = {**os.environ, 'PYTHONPATH': ROOT_PATH}
+    env.setdefault('SECRET_KEY', 'benchmark')
+    env.setdefault('DATABASE', 'benchmark.db')
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=ROOT_PATH, env=env,
+                             capture_output=True, text=True, check=True)
+    total, modules = 0, set()
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        modules.add(name.strip())
+        if not name[1:].startswith(' '):  # nested imports are included in time of top level ones
+            total += int(cumulative)
+    return {'seconds': total / 1e6, 'modules': modules}
+
+
+def run_benchmark(modules=MODULES, repeat: int = 3) -> dict:
+    report = {}
+    for module in modules:
+        results = [import_time(module) for _ in range(repeat)]
+        best = min(result['seconds'] for result in results)
+        reference = min(import_time(REFERENCES[module])['seconds'] for _ in range(repeat))
+        heavy = sorted(name for name in ('flask', 'flask_restful', 'git', 'dotenv') if name in results[0]['modules'])
+        report[module] = {'seconds': round(best, 4), 'ratio': round(best / reference, 2),
+                          'modules': len(results[0]['modules']), 'heavy': heavy}
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs of every import')
+    args = parser.parse_args(argv)
+    print(json.dumps(run_benchmark(repeat=args.repeat), indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
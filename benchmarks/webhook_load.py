@@ -0,0 +1,251 @@
+"""Load test of the path /webhook -> job queue -> weather.add_weather -> StravaClient.modify_activity.
+
+Strava and weatherapi.com are replaced by a local stub server with configurable latency, error rate and
+rate limits, so the benchmark runs offline. Run it from the root of repository:
+
+    python -m benchmarks.webhook_load --events 500 --latency 0.05
+
+Use --min-throughput and --max-p95 to fail (exit code 1) on performance regressions, e.g. in CI.
+"""
+import argparse
+import contextlib
+import json
+import os
+import random
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DATABASE', 'benchmark.db')
+
+from utils import (cache, ingest, job_queue, manage_db, rate_limit, retry_policy, strava_client, weather,  # noqa: E402
+                   weather_providers)
+
+CITIES = [(55.75, 37.62), (59.94, 30.31), (51.51, -0.13), (48.86, 2.35), (40.71, -74.01)]
+
+
+class StubServer(ThreadingHTTPServer):
+    """Stand-in for Strava and weatherapi.com APIs."""
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, error_rate=0.0, rate_limit_short=600, rate_limit_long=30000):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.limits = (rate_limit_short, rate_limit_long)
+        self.usage = 0
+        self.calls = Counter()
+        self.modified = {}  # activity ID -> time of PUT request
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def _handle(self, method):
+        server = self.server
+        path = urlsplit(self.path).path
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(server.latency)
+        headers = {}
+        with server.lock:
+            server.calls[f'{method} {re.sub(r"/[0-9]+", "/{id}", path)}'] += 1
+            if path.startswith('/api/v3/'):
+                server.usage += 1
+                headers = {'X-RateLimit-Limit': f'{server.limits[0]},{server.limits[1]}',
+                           'X-RateLimit-Usage': f'{server.usage},{server.usage}'}
+                if server.usage > server.limits[0]:
+                    return self._send(429, {'message': 'Rate Limit Exceeded'}, headers)
+        if random.random() < server.error_rate:
+            return self._send(500, {'message': 'error'}, headers)
+        if path.startswith('/api/v3/activities/'):
+            activity_id = int(path.rsplit('/', 1)[1])
+            if method == 'PUT':
+                with server.lock:
+                    server.modified[activity_id] = time.perf_counter()
+                return self._send(200, {'id': activity_id}, headers)
+            return self._send(200, make_activity(activity_id), headers)
+        if path == '/oauth/token':
+            return self._send(200, {'access_token': 'access', 'refresh_token': 'refresh',
+                                    'expires_at': int(time.time()) + 21600})
+        if path == '/v1/history.json':
+            return self._send(200, {'forecast': {'forecastday': [{'hour': [make_hour(h) for h in range(24)]}]}})
+        if path == '/v1/current.json':
+            return self._send(200, {'current': {'air_quality': {'us-epa-index': 1, 'pm2_5': 5.5, 'so2': 1.2,
+                                                                'no2': 3.4, 'o3': 50.1, 'co': 200.3}}})
+        self._send(404, {'message': 'not found'})
+
+    def _send(self, status, data, headers=None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def make_activity(activity_id: int) -> dict:
+    lat, lon = CITIES[activity_id % len(CITIES)]
+    start = datetime.now(timezone.utc) - timedelta(hours=1)
+    return {'id': activity_id, 'name': 'Morning Run', 'description': None, 'elapsed_time': 3600,
+            'start_date': start.strftime('%Y-%m-%dT%H:%M:%SZ'), 'start_latlng': [lat + random.random() / 100, lon]}
+
+
+def make_hour(hour: int) -> dict:
+    return {'condition': {'text': 'Sunny', 'code': 1000}, 'temp_c': 10.0 + hour / 2, 'feelslike_c': 9.0 + hour / 2,
+            'humidity': 60, 'wind_kph': 12.0, 'wind_degree': 15 * hour}
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+# Failed jobs are retried at once, rate limited ones wait for the next window of the stub
+RETRIED_POLICIES = ('DEFAULT', 'SERVER_ERROR', 'UNAUTHORIZED', 'WEATHER_ERROR')
+
+
+@contextlib.contextmanager
+def patched(obj, **attributes):
+    saved = {name: getattr(obj, name) for name in attributes}
+    for name, value in attributes.items():
+        setattr(obj, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(obj, name, value)
+
+
+def run_benchmark(events=200, athletes=50, latency=0.0, error_rate=0.0, workers=2, batch_size=10,
+                  rate_limit_short=600, rate_limit_long=30000, timeout=120.0) -> dict:
+    """Send burst of webhook events to application and wait until all activities are processed.
+
+    :return: dictionary with results
+    """
+    import run
+
+    app = run.app
+    with tempfile.TemporaryDirectory() as tmp, \
+            StubServer(latency, error_rate, rate_limit_short, rate_limit_long) as stub, \
+            patched(strava_client, STRAVA_URL=stub.url, RATE_LIMITER=rate_limit.RateLimiter()), \
+            patched(weather, BASE_URL=f'{stub.url}/v1'), \
+            patched(weather.ROUTER, providers=[weather_providers.WeatherAPIProvider(f'{stub.url}/v1')]), \
+            patched(ingest, COALESCE_WINDOW=0), \
+            patched(retry_policy, JITTER=0, **{name: getattr(retry_policy, name)._replace(base_delay=0, max_delay=0)
+                                               for name in RETRIED_POLICIES}), \
+            patched(run.workers, size=workers, batch_size=batch_size, poll_interval=0.05), \
+            patched(run.token_refresher, start=lambda: None):
+        database = app.config['DATABASE']
+        app.config['DATABASE'] = os.path.join(tmp, 'benchmark.db')
+        try:
+            return _run(app, run.workers, stub, events, athletes, timeout)
+        finally:
+            run.workers.stop()
+            app.config['DATABASE'] = database
+
+
+def _run(app, pool, stub, events, athletes, timeout) -> dict:
+    cache.clear_all()
+    with app.app_context():
+        manage_db.init_db()
+        for athlete_id in range(1, athletes + 1):
+            manage_db.add_athlete(manage_db.Tokens(athlete_id, 'access', 'refresh', int(time.time()) + 21600))
+    client = app.test_client()
+    sent = {}
+    started = time.perf_counter()
+    for activity_id in range(1, events + 1):
+        sent[activity_id] = time.perf_counter()
+        client.post('/webhook', json={'aspect_type': 'create', 'object_type': 'activity', 'object_id': activity_id,
+                                      'owner_id': activity_id % athletes + 1, 'updates': {}})
+    ingested = time.perf_counter()
+    with app.app_context():
+        while time.perf_counter() - started < timeout:
+            if job_queue.count(job_queue.DONE) + job_queue.count(job_queue.FAILED) >= events:
+                break
+            time.sleep(0.01)
+    finished = time.perf_counter()
+    pool.stop()
+    with app.app_context():
+        failed = job_queue.count(job_queue.FAILED)
+        deferred = job_queue.count(job_queue.PENDING)
+    latencies = [stub.modified[activity_id] - sent[activity_id] for activity_id in stub.modified]
+    upstream_calls = sum(stub.calls.values())
+    return {
+        'events': events,
+        'processed': len(stub.modified),
+        'failed': failed,
+        'deferred': deferred,
+        'ingest_ms_per_event': (ingested - started) / events * 1000,
+        'events_per_sec': len(stub.modified) / (finished - started),
+        'latency_p50': percentile(latencies, 50),
+        'latency_p95': percentile(latencies, 95),
+        'latency_p99': percentile(latencies, 99),
+        'upstream_calls_per_activity': upstream_calls / events,
+        'upstream_calls': dict(stub.calls),
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=200, help='number of webhook events in the burst')
+    parser.add_argument('--athletes', type=int, default=50, help='number of subscribers')
+    parser.add_argument('--latency', type=float, default=0.02, help='latency of stub APIs in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of stub responses with HTTP 500')
+    parser.add_argument('--workers', type=int, default=2, help='number of worker threads')
+    parser.add_argument('--batch-size', type=int, default=10, help='jobs processed concurrently by a worker')
+    parser.add_argument('--rate-limit', default='600,30000', help='Strava 15 minutes and daily limits')
+    parser.add_argument('--timeout', type=float, default=120, help='max time to wait for processing')
+    parser.add_argument('--min-throughput', type=float, help='fail if events/sec is lower')
+    parser.add_argument('--max-p95', type=float, help='fail if p95 latency in seconds is higher')
+    args = parser.parse_args(argv)
+    short_limit, long_limit = (int(limit) for limit in args.rate_limit.split(','))
+    report = run_benchmark(args.events, args.athletes, args.latency, args.error_rate, args.workers,
+                           args.batch_size, short_limit, long_limit, args.timeout)
+    print(json.dumps(report, indent=2))
+    if args.min_throughput is not None and report['events_per_sec'] < args.min_throughput:
+        print(f"FAIL: throughput {report['events_per_sec']:.1f} events/sec < {args.min_throughput}")
+        return 1
+    if args.max_p95 is not None and report['latency_p95'] > args.max_p95:
+        print(f"FAIL: p95 latency {report['latency_p95']:.3f} s > {args.max_p95}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
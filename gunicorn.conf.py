@@ -0,0 +1,56 @@
+"""Configuration of production server: gunicorn -c gunicorn.conf.py
+
+The application is imported once in the master process and forked into workers, so the modules and
+the loaded data are shared copy-on-write. Workers are recycled after max_requests (with jitter, so they
+do not restart at once) to cap memory growth. On SIGTERM a worker stops accepting requests and waits for
+the jobs in progress, so activities are not lost on deploy. Worker is killed by master graceful_timeout
+seconds after SIGTERM, jobs interrupted so are taken again by other workers after JOB_TIMEOUT
+(600 seconds, see utils/job_queue.py).
+"""
+import os
+
+wsgi_app = 'run:app'
+bind = os.environ.get('BIND', f"0.0.0.0:{os.environ.get('PORT', 5000)}")
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+preload_app = True
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 100))
+# Time to finish requests and jobs in progress after SIGTERM, then the worker is killed
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 60))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+accesslog = '-'
+
+
+def on_starting(server):
+    """Remove metrics of workers of the previous run, see METRICS_DIR in utils/metrics.py."""
+    from utils import metrics
+
+    metrics.clear_dir()
+
+
+def pre_fork(server, worker):
+    """Close connections to database opened by master process, so workers do not share them."""
+    from utils import manage_db
+
+    manage_db.close_db()
+
+
+def post_fork(server, worker):
+    """Start threads in worker, threads of master process are not copied by fork."""
+    from run import workers as job_workers, token_refresher
+    from utils import metrics
+
+    job_workers.start()  # jobs left in the queue by previous workers are processed at once
+    token_refresher.start()
+    metrics.start_dumping()
+
+
+def worker_exit(server, worker):
+    """Let workers finish jobs in progress within graceful_timeout in total, the rest of the queue is taken
+    by the next worker.
+    """
+    from run import workers as job_workers, token_refresher
+
+    token_refresher.stop(0)
+    job_workers.stop(graceful_timeout)
@@ -1,12 +1,16 @@
+import functools
+import logging
 import os
-from multiprocessing import Process
 
-from flask import Flask, url_for, render_template, request, session, abort, redirect, jsonify, send_from_directory
-from flask_restful import reqparse
+from flask import Flask, Response, url_for, render_template, request, session, abort, redirect, jsonify, send_from_directory
 
-from utils import weather, manage_db, strava_helpers, git_helpers
+from utils import backfill, cli, ingest, job_queue, manage_db, metrics, partitions, strava_client, strava_helpers
+from utils import git_helpers, tracing
 from utils.exceptions import StravaAPIError
 
+tracing.init_logging()
+logger = logging.getLogger(__name__)
+
 app = Flask(__name__)
 
 app.config.from_mapping(
@@ -14,9 +18,20 @@ app.config.from_mapping(
     SESSION_COOKIE_HTTPONLY=True,
     SESSION_COOKIE_SAMESITE='Lax',
     SECRET_KEY=os.environ.get('SECRET_KEY'),
-    DATABASE=os.path.join(app.root_path, os.environ.get('DATABASE'))
+    DATABASE=os.path.join(app.root_path, os.environ.get('DATABASE')),
+    STORAGE_BACKEND=os.environ.get('STORAGE_BACKEND', 'sqlite'),
+    DATABASE_URL=os.environ.get('DATABASE_URL'),
+    WORKERS=int(os.environ.get('WORKERS', 2)),
+    WORKER_BATCH_SIZE=int(os.environ.get('WORKER_BATCH_SIZE', 10)),
+    PARTITIONED_WORKERS=bool(int(os.environ.get('PARTITIONED_WORKERS', 0)))
 )
 manage_db.init_app(app)
+cli.init_app(app)
+# In partitioned mode every gunicorn worker process processes jobs and refreshes tokens of its own athletes
+membership = partitions.Membership() if app.config['PARTITIONED_WORKERS'] else None
+workers = job_queue.WorkerPool(app, size=app.config['WORKERS'], batch_size=app.config['WORKER_BATCH_SIZE'],
+                               on_idle=functools.partial(backfill.step, membership), membership=membership)
+token_refresher = strava_client.TokenRefresher(app, membership=membership)
 
 
 @app.route('/')
@@ -40,6 +55,21 @@ def final():
     return render_template('final.html', athlete=session['athlete'])
 
 
+@app.route('/backfill/', methods=['GET', 'POST'])
+def backfill_activities():
+    """Start adding weather to historical activities of athlete (POST) or show progress (GET)."""
+    if 'id' not in session:
+        return abort(401)
+    if request.method == 'POST':
+        progress = backfill.start(session['id'])
+        workers.notify()
+    else:
+        progress = backfill.get(session['id'])
+    if progress is None:
+        return abort(404)
+    return jsonify(status=progress.status, scanned=progress.scanned, enqueued=progress.enqueued)
+
+
 @app.route('/authorization_successful')
 def auth():
     code = request.values.get('code', None)
@@ -67,35 +97,38 @@ def webhook():
         return jsonify(process_webhook_get())
 
 
-def process_webhook_post():
+@functools.lru_cache(maxsize=None)
+def webhook_parser():
+    from flask_restful import reqparse  # it is slow to import, so it is loaded with the first event
+
     parser = reqparse.RequestParser()
     parser.add_argument('owner_id', type=int, required=True)  # athlete's ID
-    parser.add_argument('object_type', type=str, required=True)  # we need "activity" here
+    parser.add_argument('object_type', type=str, required=True)  # "activity" or "athlete"
     parser.add_argument('object_id', type=int, required=True)  # activity's ID
     parser.add_argument('aspect_type', type=str, required=True)  # Always "create," "update," or "delete."
     parser.add_argument('updates', type=dict, required=True)  # For de-auth, there is {"authorized": "false"}
-    args = parser.parse_args()
-    app.logger.info(args)  # TODO remove after debugging
-    if args['aspect_type'] == 'create' and args['object_type'] == 'activity':
-        p = Process(target=weather.add_weather, args=(args['owner_id'], args['object_id']))
-        p.daemon = True
-        p.start()
-    if args['updates'].get('authorized', '') == 'false':
-        manage_db.delete_athlete(args['owner_id'])
+    return parser
+
+
+def process_webhook_post():
+    args = webhook_parser().parse_args()
+    if ingest.ingest([ingest.Event(**args)]):
+        workers.notify()
+        token_refresher.start()
 
 
 def process_webhook_get():
-    if strava_helpers.is_app_subscribed():
-        return {'status': 'You are already subscribed'}
     req = request.values
     mode = req.get('hub.mode', '')
     token = req.get('hub.verify_token', '')
+    # Verification request of Strava is answered without requests to Strava, it waits for 2 seconds only
     if mode == 'subscribe' and token == os.environ.get('STRAVA_WEBHOOK_TOKEN'):
-        print('WEBHOOK VERIFIED')
+        logger.info('Webhook verified')
         challenge = req.get('hub.challenge', '')
         return {'hub.challenge': challenge}
-    else:
-        return {'error': 'verification tokens does not match'}
+    if not mode and strava_helpers.is_app_subscribed():
+        return {'status': 'You are already subscribed'}
+    return {'error': 'verification tokens does not match'}
 
 
 @app.route('/features/')
@@ -115,7 +148,17 @@ def robots():
 
 @app.route('/subscribers')
 def subscribers():
-    return {'count': manage_db.get_subscribers_count()}
+    response = jsonify(count=manage_db.get_subscribers_count())
+    response.cache_control.public = True
+    response.cache_control.max_age = int(manage_db.SUBSCRIBERS_COUNT_TTL)
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Metrics of application in Prometheus text format."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 
 @app.route('/update_server', methods=['POST'])
@@ -148,4 +191,6 @@ def api_errors_handler(error):
 
 
 if __name__ == '__main__':  # pragma: no cover
+    workers.start()
+    token_refresher.start()
     app.run()
@@ -6,6 +6,8 @@ CREATE TABLE IF NOT EXISTS subscribers (
     refresh_token text NOT NULL,
     expires_at integer NOT NULL);
 
+CREATE INDEX IF NOT EXISTS subscribers_expires_at ON subscribers (expires_at);
+
 /*DROP TABLE IF EXISTS settings;*/
 
 CREATE TABLE IF NOT EXISTS settings (
@@ -15,3 +17,130 @@ CREATE TABLE IF NOT EXISTS settings (
     wind integer NOT NULL,
     aqi integer NOT NULL,
     lan text NOT NULL);
+
+/*DROP TABLE IF EXISTS jobs;*/
+
+CREATE TABLE IF NOT EXISTS jobs (
+    id integer NOT NULL PRIMARY KEY AUTOINCREMENT,
+    athlete_id integer NOT NULL,
+    activity_id integer NOT NULL,
+    status text NOT NULL DEFAULT 'pending',
+    attempts integer NOT NULL DEFAULT 0,
+    run_at integer NOT NULL,
+    locked_at integer,
+    last_error text,
+    partition integer NOT NULL DEFAULT 0);
+
+CREATE INDEX IF NOT EXISTS jobs_status_run_at ON jobs (status, run_at);
+CREATE INDEX IF NOT EXISTS jobs_partition ON jobs (partition, status, run_at);
+CREATE UNIQUE INDEX IF NOT EXISTS jobs_activity_id ON jobs (activity_id);
+CREATE INDEX IF NOT EXISTS jobs_athlete_id ON jobs (athlete_id);
+
+/*Generation of athletes data is incremented on every change and the change is logged with ID of athlete,
+so other processes evict only changed athletes from their caches. The last 10000 changes are kept.*/
+
+CREATE TABLE IF NOT EXISTS generations (
+    name text NOT NULL PRIMARY KEY,
+    value integer NOT NULL);
+
+INSERT OR IGNORE INTO generations VALUES ('athletes', 0);
+
+CREATE TABLE IF NOT EXISTS athlete_changes (
+    generation integer NOT NULL PRIMARY KEY,
+    athlete_id integer NOT NULL);
+
+/*Triggers of previous version incremented the generation only*/
+
+DROP TRIGGER IF EXISTS subscribers_insert;
+DROP TRIGGER IF EXISTS subscribers_update;
+DROP TRIGGER IF EXISTS subscribers_delete;
+DROP TRIGGER IF EXISTS settings_insert;
+DROP TRIGGER IF EXISTS settings_update;
+DROP TRIGGER IF EXISTS settings_delete;
+
+CREATE TRIGGER IF NOT EXISTS subscribers_change_insert AFTER INSERT ON subscribers
+BEGIN UPDATE generations SET value = value + 1 WHERE name = 'athletes';
+INSERT INTO athlete_changes SELECT value, NEW.id FROM generations WHERE name = 'athletes'; END;
+CREATE TRIGGER IF NOT EXISTS subscribers_change_update AFTER UPDATE ON subscribers
+BEGIN UPDATE generations SET value = value + 1 WHERE name = 'athletes';
+INSERT INTO athlete_changes SELECT value, NEW.id FROM generations WHERE name = 'athletes'; END;
+CREATE TRIGGER IF NOT EXISTS subscribers_change_delete AFTER DELETE ON subscribers
+BEGIN UPDATE generations SET value = value + 1 WHERE name = 'athletes';
+INSERT INTO athlete_changes SELECT value, OLD.id FROM generations WHERE name = 'athletes'; END;
+CREATE TRIGGER IF NOT EXISTS settings_change_insert AFTER INSERT ON settings
+BEGIN UPDATE generations SET value = value + 1 WHERE name = 'athletes';
+INSERT INTO athlete_changes SELECT value, NEW.id FROM generations WHERE name = 'athletes'; END;
+CREATE TRIGGER IF NOT EXISTS settings_change_update AFTER UPDATE ON settings
+BEGIN UPDATE generations SET value = value + 1 WHERE name = 'athletes';
+INSERT INTO athlete_changes SELECT value, NEW.id FROM generations WHERE name = 'athletes'; END;
+CREATE TRIGGER IF NOT EXISTS settings_change_delete AFTER DELETE ON settings
+BEGIN UPDATE generations SET value = value + 1 WHERE name = 'athletes';
+INSERT INTO athlete_changes SELECT value, OLD.id FROM generations WHERE name = 'athletes'; END;
+CREATE TRIGGER IF NOT EXISTS athlete_changes_prune AFTER INSERT ON athlete_changes
+BEGIN DELETE FROM athlete_changes WHERE generation <= NEW.generation - 10000; END;
+
+/*Number of subscribers is maintained by triggers, so it is read without scan of the table*/
+
+CREATE TABLE IF NOT EXISTS counters (
+    name text NOT NULL PRIMARY KEY,
+    value integer NOT NULL);
+
+INSERT OR IGNORE INTO counters SELECT 'subscribers', COUNT(*) FROM subscribers;
+
+CREATE TRIGGER IF NOT EXISTS subscribers_count_insert AFTER INSERT ON subscribers
+BEGIN UPDATE counters SET value = value + 1 WHERE name = 'subscribers'; END;
+CREATE TRIGGER IF NOT EXISTS subscribers_count_delete AFTER DELETE ON subscribers
+BEGIN UPDATE counters SET value = value - 1 WHERE name = 'subscribers'; END;
+
+/*Ledger of processed activities, it is checked before any request to Strava*/
+
+CREATE TABLE IF NOT EXISTS ledger (
+    activity_id integer NOT NULL PRIMARY KEY,
+    athlete_id integer NOT NULL,
+    status text NOT NULL,
+    started_at real NOT NULL,
+    finished_at real NOT NULL,
+    payload text);
+
+CREATE INDEX IF NOT EXISTS ledger_athlete_id ON ledger (athlete_id, finished_at);
+CREATE INDEX IF NOT EXISTS ledger_finished_at ON ledger (finished_at);
+
+/*Progress of backfill of historical activities, one record per athlete*/
+
+CREATE TABLE IF NOT EXISTS backfills (
+    athlete_id integer NOT NULL PRIMARY KEY,
+    status text NOT NULL,
+    page integer NOT NULL,
+    before integer NOT NULL,
+    after integer,
+    scanned integer NOT NULL DEFAULT 0,
+    enqueued integer NOT NULL DEFAULT 0,
+    updated_at integer NOT NULL,
+    last_error text);
+
+CREATE INDEX IF NOT EXISTS backfills_status_updated_at ON backfills (status, updated_at);
+
+/*Jobs failed permanently, they can be replayed by command flask dead-letters replay*/
+
+CREATE TABLE IF NOT EXISTS dead_letters (
+    activity_id integer NOT NULL PRIMARY KEY,
+    athlete_id integer NOT NULL,
+    attempts integer NOT NULL,
+    error_class text NOT NULL,
+    last_error text,
+    failed_at integer NOT NULL);
+
+CREATE INDEX IF NOT EXISTS dead_letters_failed_at ON dead_letters (failed_at);
+
+/*Workers of partitioned mode and leases of partitions of the queue, see utils/partitions.py*/
+
+CREATE TABLE IF NOT EXISTS workers (
+    id text NOT NULL PRIMARY KEY,
+    heartbeat_at integer NOT NULL);
+
+CREATE TABLE IF NOT EXISTS partition_leases (
+    partition integer NOT NULL PRIMARY KEY,
+    worker_id text NOT NULL,
+    expires_at integer NOT NULL);
+
+CREATE INDEX IF NOT EXISTS partition_leases_worker_id ON partition_leases (worker_id);
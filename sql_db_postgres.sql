@@ -0,0 +1,76 @@
+/*Tables of athletes for STORAGE_BACKEND=postgres, the queue of jobs is kept in SQLite (sql_db.sql)*/
+
+CREATE TABLE IF NOT EXISTS subscribers (
+    id bigint NOT NULL PRIMARY KEY,
+    access_token text NOT NULL,
+    refresh_token text NOT NULL,
+    expires_at bigint NOT NULL);
+
+CREATE INDEX IF NOT EXISTS subscribers_expires_at ON subscribers (expires_at);
+
+CREATE TABLE IF NOT EXISTS settings (
+    id bigint NOT NULL PRIMARY KEY,
+    icon integer NOT NULL,
+    humidity integer NOT NULL,
+    wind integer NOT NULL,
+    aqi integer NOT NULL,
+    lan text NOT NULL);
+
+/*Generation of athletes data is incremented on every change and the change is logged with ID of athlete,
+so other processes evict only changed athletes from their caches. The last 10000 changes are kept.
+Row of the generation is locked until commit, so changes are committed in the order of generations.*/
+
+CREATE TABLE IF NOT EXISTS generations (
+    name text NOT NULL PRIMARY KEY,
+    value bigint NOT NULL);
+
+INSERT INTO generations VALUES ('athletes', 0) ON CONFLICT DO NOTHING;
+
+CREATE TABLE IF NOT EXISTS athlete_changes (
+    generation bigint NOT NULL PRIMARY KEY,
+    athlete_id bigint NOT NULL);
+
+CREATE OR REPLACE FUNCTION increment_athletes_generation() RETURNS trigger AS $$
+DECLARE
+    changed bigint;
+BEGIN
+    UPDATE generations SET value = value + 1 WHERE name = 'athletes' RETURNING value INTO changed;
+    IF TG_OP = 'DELETE' THEN
+        INSERT INTO athlete_changes VALUES (changed, OLD.id);
+    ELSE
+        INSERT INTO athlete_changes VALUES (changed, NEW.id);
+    END IF;
+    DELETE FROM athlete_changes WHERE generation <= changed - 10000;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS subscribers_generation ON subscribers;
+CREATE TRIGGER subscribers_generation AFTER INSERT OR UPDATE OR DELETE ON subscribers
+    FOR EACH ROW EXECUTE PROCEDURE increment_athletes_generation();
+DROP TRIGGER IF EXISTS settings_generation ON settings;
+CREATE TRIGGER settings_generation AFTER INSERT OR UPDATE OR DELETE ON settings
+    FOR EACH ROW EXECUTE PROCEDURE increment_athletes_generation();
+
+/*Number of subscribers is maintained by triggers, so it is read without scan of the table*/
+
+CREATE TABLE IF NOT EXISTS counters (
+    name text NOT NULL PRIMARY KEY,
+    value bigint NOT NULL);
+
+INSERT INTO counters SELECT 'subscribers', COUNT(*) FROM subscribers ON CONFLICT DO NOTHING;
+
+CREATE OR REPLACE FUNCTION count_subscribers() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE counters SET value = value + 1 WHERE name = 'subscribers';
+    ELSE
+        UPDATE counters SET value = value - 1 WHERE name = 'subscribers';
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS subscribers_count ON subscribers;
+CREATE TRIGGER subscribers_count AFTER INSERT OR DELETE ON subscribers
+    FOR EACH ROW EXECUTE PROCEDURE count_subscribers();
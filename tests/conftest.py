@@ -5,7 +5,7 @@ import time
 import pytest
 from dotenv import load_dotenv
 
-from utils import manage_db
+from utils import manage_db, cache, rate_limit, strava_client, weather
 
 
 @pytest.fixture
@@ -37,7 +37,28 @@ def database(db_token, db_settings):
     return db
 
 
+@pytest.fixture
+def queue_db(database, monkeypatch):
+    """Database of fixture `database` used by modules which call manage_db.get_db"""
+    monkeypatch.setattr(manage_db, 'get_db', lambda: database)
+    return database
+
+
 @pytest.fixture(scope='session', autouse=True)
 def test_dot_env_mock():
     env_path = os.path.join(os.path.dirname(__file__).replace('/tests', ''), '.env')
     load_dotenv(env_path)
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    cache.clear_all()
+    manage_db._generation.update(value=None, checked_at=0.0)
+    weather.ROUTER.reset_stats()
+
+
+@pytest.fixture(autouse=True)
+def rate_limiter(monkeypatch):
+    limiter = rate_limit.RateLimiter()
+    monkeypatch.setattr(strava_client, 'RATE_LIMITER', limiter)
+    return limiter
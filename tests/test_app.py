@@ -5,8 +5,8 @@ import urllib.parse
 
 from flask import url_for
 
-from utils import weather, manage_db, strava_helpers
-from run import app as site, process_webhook_get
+from utils import weather, manage_db, strava_helpers, job_queue
+from run import app as site, process_webhook_get, workers, token_refresher
 
 
 @pytest.fixture
@@ -136,12 +136,25 @@ def test_webhook_page_get(client, monkeypatch):
     assert json.loads(response.data.decode()) == payload_to_test
 
 
-def test_process_webhook_get_subscribed(monkeypatch):
+def test_process_webhook_get_subscribed(monkeypatch, app):
     monkeypatch.setattr(strava_helpers, 'is_app_subscribed', lambda: True)
-    status = process_webhook_get()
+    with app.test_request_context('/webhook/'):
+        status = process_webhook_get()
     assert status == {'status': 'You are already subscribed'}
 
 
+def test_process_webhook_get_verification_is_local(monkeypatch, app):
+    # GIVEN status of subscription which can not be requested
+    monkeypatch.setattr(strava_helpers, 'is_app_subscribed', lambda: pytest.fail('Strava is requested'))
+    monkeypatch.setenv('STRAVA_WEBHOOK_TOKEN', 'token_for_test')
+    params = {'hub.mode': 'subscribe', 'hub.verify_token': 'token_for_test', 'hub.challenge': 'challenge_for_test'}
+    # WHEN Strava verifies the webhook
+    with app.test_request_context(f'/webhook/?{urllib.parse.urlencode(params)}'):
+        status = process_webhook_get()
+    # THEN challenge is answered without request of subscription status
+    assert status == {'hub.challenge': 'challenge_for_test'}
+
+
 def test_process_webhook_get_subscription(monkeypatch, app):
     # GIVEN a Flask application configured for testing
     monkeypatch.setattr(strava_helpers, 'is_app_subscribed', lambda: False)
@@ -191,6 +204,7 @@ def test_webhook_post(client, monkeypatch, data):
     # GIVEN a Flask application configured for testing
     monkeypatch.setattr(weather, 'add_weather', lambda *args: None)
     monkeypatch.setattr(manage_db, 'delete_athlete', lambda arg: None)
+    monkeypatch.setattr(job_queue, 'cancel', lambda *args, **kwargs: 0)
     # WHEN the '/webhook/' page is requested (GET)
     response = client.post(url_for('webhook'), headers={'Content-Type': 'application/json'}, data=json.dumps(data))
     # THEN check that the response is valid
@@ -198,6 +212,29 @@ def test_webhook_post(client, monkeypatch, data):
     assert response.data == b'webhook ok'
 
 
+def test_webhook_post_create_activity(client, monkeypatch):
+    # GIVEN a Flask application configured for testing
+    queued = []
+    monkeypatch.setattr(job_queue, 'enqueue_many', lambda activities, delay: queued.extend(activities) or 1)
+    monkeypatch.setattr(workers, 'notify', lambda: None)
+    monkeypatch.setattr(token_refresher, 'start', lambda: None)
+    data = {'aspect_type': 'create', 'object_id': 10, 'object_type': 'activity', 'owner_id': 1, 'updates': {}}
+    # WHEN the '/webhook/' page is requested (POST) with new activity
+    response = client.post(url_for('webhook'), headers={'Content-Type': 'application/json'}, data=json.dumps(data))
+    # THEN check that activity is put to the queue
+    assert response.status_code == 200
+    assert queued == [(1, 10)]
+
+
+def test_webhook_post_bad_event(client):
+    # GIVEN a Flask application configured for testing
+    data = {'aspect_type': 'create', 'object_type': 'activity', 'owner_id': 1, 'updates': {}}
+    # WHEN the '/webhook/' page is requested (POST) without activity ID
+    response = client.post(url_for('webhook'), headers={'Content-Type': 'application/json'}, data=json.dumps(data))
+    # THEN check that event is rejected
+    assert response.status_code == 400
+
+
 def test_http_404_handler(client):
     # GIVEN a Flask application configured for testing
     # WHEN another page is requested (GET)
@@ -284,3 +321,24 @@ def test_subscribers_handler(client, monkeypatch):
     # THEN check that the response is valid
     assert response.status_code == 200
     assert json.loads(response.data.decode('utf-8')) == {'count': 1}
+    assert response.cache_control.max_age == manage_db.SUBSCRIBERS_COUNT_TTL
+    # WHEN the page is requested again with ETag
+    response = client.get('/subscribers', headers={'If-None-Match': response.headers['ETag']})
+    # THEN the response has no body
+    assert response.status_code == 304
+    assert response.data == b''
+
+
+def test_metrics_handler(client, monkeypatch, database):
+    # GIVEN a Flask application with a database of jobs
+    monkeypatch.setattr(manage_db, 'get_db', lambda: database)
+    job_queue.enqueue(1, 123)
+    # WHEN the '/metrics' page is requested (GET)
+    response = client.get('/metrics')
+    # THEN metrics are in the text format of Prometheus
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    text = response.data.decode('utf-8')
+    assert '# TYPE jobs gauge' in text
+    assert 'jobs{status="pending"} 1' in text
+    assert 'cache_hits_total{cache="tokens"}' in text
@@ -0,0 +1,146 @@
+import re
+
+import pytest
+import requests
+import responses
+
+from utils import backfill, job_queue, ledger, strava_client
+from utils.exceptions import StravaAPIError
+from run import app as site
+
+ACTIVITIES_URL = re.compile(r'https://www\.strava\.com/api/v3/athlete/activities')
+
+
+@pytest.fixture
+def app():
+    return site
+
+
+def activity(activity_id, lat=55.75, date='2021-06-03', **fields):
+    return {'id': activity_id, 'start_latlng': [lat, 37.62], 'start_date': f'{date}T06:00:00Z', **fields}
+
+
+def queued_activities(database):
+    return [row[0] for row in database.execute('SELECT activity_id FROM jobs ORDER BY id')]
+
+
+@responses.activate
+def test_backfill(queue_db, db_token):
+    athlete_id = db_token[0].id
+    ledger.record(athlete_id, 5, ledger.DONE, 0)
+    responses.add(responses.GET, ACTIVITIES_URL, json=[
+        activity(1), activity(2, lat=59.94), activity(3, date='2021-06-02'), activity(4),
+        activity(5), activity(6, manual=True), activity(7, trainer=True), activity(8, type='VirtualRide'),
+        {'id': 9, 'start_latlng': [], 'start_date': '2021-06-03T06:00:00Z'},
+    ])
+    responses.add(responses.GET, ACTIVITIES_URL, json=[])
+    progress = backfill.start(athlete_id)
+    assert backfill.start(athlete_id) == progress  # backfill in progress is not restarted
+    assert backfill.step()
+    # eligible activities are grouped by place and date
+    assert queued_activities(queue_db) == [3, 1, 4, 2]
+    assert 'page=1' in responses.calls[0].request.url
+    assert f'before={progress.before}' in responses.calls[0].request.url
+    assert backfill.step()
+    progress = backfill.get(athlete_id)
+    assert (progress.status, progress.page, progress.scanned, progress.enqueued) == (backfill.DONE, 3, 9, 4)
+    assert 'page=2' in responses.calls[1].request.url
+    assert not backfill.step()
+
+
+@responses.activate
+def test_backfill_keeps_rate_reserve(queue_db, db_token, rate_limiter, monkeypatch):
+    monkeypatch.setattr(backfill, 'RESERVE', rate_limiter.limits[0])
+    backfill.start(db_token[0].id)
+    assert not backfill.step()
+    assert len(responses.calls) == 0
+
+
+@responses.activate
+def test_backfill_failed_and_resumed(queue_db, db_token):
+    athlete_id = db_token[0].id
+    backfill.start(athlete_id)
+    responses.add(responses.GET, ACTIVITIES_URL, json=[activity(1)])
+    responses.add(responses.GET, ACTIVITIES_URL, json={'message': 'Authorization Error'}, status=401)
+    responses.add(responses.GET, ACTIVITIES_URL, json=[])
+    assert backfill.step()
+    assert not backfill.step()
+    progress = backfill.get(athlete_id)
+    assert (progress.status, progress.page) == (backfill.FAILED, 2)
+    assert 'StravaAPIError' in progress.last_error
+    # WHEN backfill is started again THEN it continues from the failed page
+    assert backfill.start(athlete_id).page == 2
+    assert backfill.step()
+    assert backfill.get(athlete_id).status == backfill.DONE
+
+
+def test_backfill_unknown_athlete(queue_db):
+    backfill.start(100)
+    assert not backfill.step()
+    assert backfill.get(100).status == backfill.FAILED
+
+
+@responses.activate
+def test_backfill_network_error(queue_db, db_token):
+    responses.add(responses.GET, ACTIVITIES_URL, body=requests.ConnectionError('no network'))
+    backfill.start(db_token[0].id)
+    assert not backfill.step()
+    assert backfill.get(db_token[0].id).status == backfill.RUNNING  # it is continued later
+
+
+def test_fetch_athlete_activities_failed(queue_db):
+    with responses.RequestsMock() as mock:
+        mock.add(responses.GET, ACTIVITIES_URL, body='')
+        with pytest.raises(StravaAPIError):
+            strava_client.fetch_athlete_activities(1, {}, page=1)
+
+
+@responses.activate
+def test_backfill_command(app, queue_db, db_token):
+    responses.add(responses.GET, ACTIVITIES_URL, json=[activity(1), activity(2)])
+    responses.add(responses.GET, ACTIVITIES_URL, json=[])
+    result = app.test_cli_runner().invoke(args=['backfill', str(db_token[0].id), '--since', '2021-01-01', '--wait'])
+    assert 'Scanned 2 activities, enqueued 2.' in result.output
+    assert 'after=' in responses.calls[0].request.url
+
+
+def test_backfill_endpoint(client, queue_db, monkeypatch):
+    from run import workers
+
+    monkeypatch.setattr(workers, 'notify', lambda: None)
+    assert client.get('/backfill/').status_code == 401
+    with client.session_transaction() as session:
+        session['id'] = 1
+    assert client.get('/backfill/').status_code == 404
+    response = client.post('/backfill/')
+    assert response.json == {'status': backfill.RUNNING, 'scanned': 0, 'enqueued': 0}
+    assert client.get('/backfill/').json == response.json
+
+
+def test_worker_pool_runs_backfill_when_idle(app, queue_db, monkeypatch):
+    calls = []
+
+    def on_idle():
+        calls.append(1)
+        pool._stopped.set()
+        return False
+
+    pool = job_queue.WorkerPool(app, size=1, poll_interval=0.01, on_idle=on_idle)
+    monkeypatch.setattr(job_queue, 'claim_batch', lambda size, worker_id=None: [])
+    pool._run()
+    assert calls == [1]
+
+
+def test_worker_pool_survives_errors(app, queue_db, monkeypatch):
+    calls = []
+
+    def on_idle():
+        calls.append(1)
+        if len(calls) == 2:
+            pool._stopped.set()
+        raise requests.ConnectionError('no network')
+
+    pool = job_queue.WorkerPool(app, size=1, poll_interval=0.01, on_idle=on_idle)
+    monkeypatch.setattr(job_queue, 'claim_batch', lambda size, worker_id=None: [])
+    pool._run()
+    assert calls == [1, 1]
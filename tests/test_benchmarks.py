@@ -0,0 +1,53 @@
+import os
+
+from benchmarks import db_writes, descriptions, import_time, webhook_load
+
+# Time of import of the web application and of the worker relative to import of flask and requests, best of 5 runs.
+# Measured 1.7-2.0 and 1.4-1.5, the baseline web application was 1.8 (468 modules).
+IMPORT_BUDGET = {'run': float(os.environ.get('IMPORT_TIME_BUDGET_WEB', 2.3)),
+                 'utils.worker': float(os.environ.get('IMPORT_TIME_BUDGET_WORKER', 1.8))}
+# Number of imported modules does not depend on the machine, measured 434 and 312
+IMPORT_MODULES_BUDGET = {'run': 445, 'utils.worker': 320}
+
+
+def test_webhook_load():
+    report = webhook_load.run_benchmark(events=20, athletes=5, workers=2, batch_size=5, timeout=30)
+    assert report['processed'] == 20
+    assert report['failed'] == report['deferred'] == 0
+    assert report['upstream_calls']['GET /api/v3/activities/{id}'] == 20
+    assert report['upstream_calls']['PUT /api/v3/activities/{id}'] == 20
+    # weather is shared by activities from the same city
+    assert report['upstream_calls']['GET /v1/history.json'] <= len(webhook_load.CITIES)
+    assert report['latency_p50'] <= report['latency_p95'] <= report['latency_p99']
+    assert report['peak_rss_mb'] > 0
+
+
+def test_webhook_load_rate_limited():
+    report = webhook_load.run_benchmark(events=10, athletes=5, rate_limit_short=10, timeout=1)
+    # activities above the quota are deferred, not lost
+    assert report['processed'] <= 5
+    assert report['failed'] == 0
+    assert report['processed'] + report['deferred'] == 10
+
+
+def test_db_writes():
+    report = db_writes.run_benchmark(calls=20, batch=10)
+    assert report['refreshed tokens']['after']['statements_per_call'] < report['refreshed tokens']['before'][
+        'statements_per_call']
+    assert report['refresh of 10 tokens']['after']['statements_per_call'] == 2
+
+
+def test_import_time():
+    report = import_time.run_benchmark(repeat=5)
+    for module, budget in IMPORT_BUDGET.items():
+        assert report[module]['ratio'] < budget, f'import of {module} is too slow'
+        assert report[module]['modules'] <= IMPORT_MODULES_BUDGET[module], f'{module} imports too many modules'
+    # modules which are needed rarely are loaded on demand
+    assert not {'git', 'flask_restful'} & set(report['run']['heavy'])
+    assert not {'flask', 'flask_restful', 'git'} & set(report['utils.worker']['heavy'])
+
+
+def test_descriptions():
+    report = descriptions.run_benchmark(renders=2000)
+    assert report['mismatches'] == 0
+    assert report['after_us_per_render'] > 0
@@ -0,0 +1,87 @@
+import threading
+import time
+
+from utils import cache
+
+
+def test_lru_cache_eviction():
+    lru = cache.LRUCache(maxsize=2)
+    lru.set('a', 1)
+    lru.set('b', 2)
+    assert lru.get('a') == 1  # now 'b' is least recently used
+    lru.set('c', 3)
+    assert lru.get('b') is None
+    assert lru.get('a') == 1
+    assert lru.get('c') == 3
+    assert lru.stats() == {'hits': 3, 'misses': 1, 'size': 2}
+
+
+def test_lru_cache_ttl(monkeypatch):
+    lru = cache.LRUCache(ttl=10)
+    lru.set('a', 1)
+    assert lru.get('a') == 1
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 11)
+    assert lru.get('a', 'expired') == 'expired'
+    assert len(lru) == 0
+
+
+def test_persistent_cache(tmpdir):
+    path = str(tmpdir.join('cache.db'))
+    persistent = cache.PersistentCache(path, 'test', maxsize=2)
+    persistent.set('a', {'temp_c': 1})
+    persistent.set('b', [2])
+    persistent.set('c', 'three')
+    # WHEN cache is created again, e.g. after restart of application
+    restored = cache.PersistentCache(path, 'test', maxsize=2)
+    # THEN records are read from disk, but evicted ones are lost
+    assert restored.get('a') is None
+    assert restored.get('b') == [2]
+    assert restored.get('c') == 'three'
+    restored.clear()
+    assert cache.PersistentCache(path, 'test').get('b') is None
+
+
+def test_persistent_cache_after_fork(tmpdir, monkeypatch):
+    persistent = cache.PersistentCache(str(tmpdir.join('cache.db')), 'test')
+    persistent.set('a', 1)
+    connection = persistent._db
+    # WHEN cache is used in forked process
+    monkeypatch.setattr(cache.os, 'getpid', lambda: -1)
+    # THEN it has own connection to the file
+    assert persistent._db is not connection
+    persistent.delete('a')
+    assert persistent.get('a') is None
+
+
+def test_create_persistent(tmpdir, monkeypatch):
+    monkeypatch.setenv('CACHE_DATABASE', str(tmpdir.join('cache.db')))
+    assert isinstance(cache.create('test_persistent', persistent=True), cache.PersistentCache)
+    monkeypatch.delenv('CACHE_DATABASE')
+    assert type(cache.create('test_persistent', persistent=True)) is cache.LRUCache
+    assert 'test_persistent' in cache.CACHES
+    del cache.CACHES['test_persistent']
+
+
+def test_grid_cell():
+    assert cache.grid_cell(55.752388, 37.716457, 0.05) == cache.grid_cell(55.76, 37.72, 0.05)
+    assert cache.grid_cell(55.752388, 37.716457, 0.05) != cache.grid_cell(55.80, 37.72, 0.05)
+
+
+def test_get_or_set_single_flight():
+    lru = cache.LRUCache()
+    calls = []
+
+    def factory():
+        calls.append(1)
+        time.sleep(0.05)
+        return 'value'
+
+    threads = [threading.Thread(target=lru.get_or_set, args=('key', factory)) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert lru.get_or_set('key', factory) == 'value'
+    assert len(calls) == 1
@@ -1,7 +1,7 @@
 import sqlite3
+import threading
 
 import pytest
-from flask import g
 
 from utils import manage_db
 from run import app as site
@@ -22,6 +22,12 @@ def test_get_athlete(database, db_token, monkeypatch):
     assert actual_tokens == expected_tokens
 
 
+def test_get_expiring_athletes(database, db_token, monkeypatch):
+    monkeypatch.setattr(manage_db, 'get_db', lambda: database)
+    assert manage_db.get_expiring_athletes(db_token[1].expires_at + 1) == [db_token[1]]
+    assert manage_db.get_expiring_athletes(db_token[0].expires_at + 1) == [db_token[1], db_token[0]]
+
+
 def test_add_athlete_new(database, db_token, monkeypatch):
     # GIVEN configured database
     monkeypatch.setattr(manage_db, 'get_db', lambda: database)
@@ -145,14 +151,37 @@ def test_delete_athlete(database, monkeypatch):
     assert db_record_settings.fetchone() is None
 
 
-def test_get_db_connected(app, database):
+def test_get_db_connected(app, tmpdir):
     # GIVEN a Flask application configured for testing
+    app.config['DATABASE'] = str(tmpdir.join('test.db'))
     # WHEN get connection to database in application context
     with app.app_context():
-        g.db = database
         db = manage_db.get_db()
-    # THEN get database connection instance
+        journal_mode = db.execute('PRAGMA journal_mode').fetchone()[0]
+    with app.app_context():
+        db_next_request = manage_db.get_db()
+    connections = []
+
+    def connect_in_thread():
+        with app.app_context():
+            connections.append(manage_db.get_db())
+
+    thread = threading.Thread(target=connect_in_thread)
+    thread.start()
+    thread.join()
+    # THEN connection is reused by the thread and other threads have own connections
     assert isinstance(db, sqlite3.Connection)
+    assert journal_mode == 'wal'
+    assert db is db_next_request
+    assert connections[0] is not db
+
+
+def test_get_db_outside_app_context(tmpdir, monkeypatch):
+    monkeypatch.setattr(manage_db, '_database', str(tmpdir.join('test.db')))
+    db = manage_db.get_db()
+    assert db is manage_db.get_db()
+    manage_db.close_db()
+    assert db is not manage_db.get_db()
 
 
 def test_get_db_not_connected(app):
@@ -189,3 +218,125 @@ def test_init_db_command(app, monkeypatch):
     runner = app.test_cli_runner()
     result = runner.invoke(args=['init-db'])
     assert 'Initialized database.' in result.output
+
+
+def test_athlete_cache_read_through(database, db_token, db_settings, monkeypatch):
+    monkeypatch.setattr(manage_db, 'get_db', lambda: database)
+    manage_db.get_athlete(db_token[0].id)
+    manage_db.get_settings(db_settings.id)
+    monkeypatch.setattr(manage_db, 'INVALIDATION_INTERVAL', 3600)
+    statements = []
+    database.set_trace_callback(statements.append)
+    # WHEN athlete state is read again
+    assert manage_db.get_athlete(db_token[0].id) == db_token[0]
+    assert manage_db.get_settings(db_settings.id) == db_settings
+    manage_db.add_settings(db_settings)
+    # THEN database is not queried
+    assert statements == []
+
+
+def test_athlete_cache_write_through(database, db_token, db_settings, monkeypatch):
+    monkeypatch.setattr(manage_db, 'get_db', lambda: database)
+    manage_db.get_athlete(db_token[0].id)
+    manage_db.get_settings(db_settings.id)
+    updated_tokens = db_token[0]._replace(access_token='updated')
+    updated_settings = db_settings._replace(lan='de')
+    manage_db.add_athlete(updated_tokens)
+    manage_db.add_settings(updated_settings)
+    assert manage_db.get_athlete(db_token[0].id) == updated_tokens
+    assert manage_db.get_settings(db_settings.id) == updated_settings
+    manage_db.delete_athlete(db_token[0].id)
+    assert manage_db.get_athlete(db_token[0].id) is None
+    assert manage_db.get_settings(db_settings.id) == manage_db.DEFAULT_SETTINGS._replace(id=db_settings.id)
+
+
+def test_athlete_cache_invalidated_by_other_process(database, db_token, monkeypatch):
+    monkeypatch.setattr(manage_db, 'get_db', lambda: database)
+    monkeypatch.setattr(manage_db, 'INVALIDATION_INTERVAL', 0)
+    manage_db.get_athlete(db_token[0].id)
+    # WHEN tokens are changed by another process
+    database.execute("UPDATE subscribers SET access_token = 'changed' WHERE id = ?", (db_token[0].id,))
+    database.commit()
+    # THEN changed athlete is evicted from cache
+    assert manage_db.get_athlete(db_token[0].id).access_token == 'changed'
+
+
+def test_athlete_cache_keeps_unchanged_athletes(database, db_token, db_settings, monkeypatch):
+    monkeypatch.setattr(manage_db, 'get_db', lambda: database)
+    monkeypatch.setattr(manage_db, 'INVALIDATION_INTERVAL', 0)
+    manage_db.get_athlete(db_token[0].id)
+    manage_db.get_settings(db_settings.id)
+    # WHEN another athlete is changed
+    manage_db.add_athlete(db_token[2])
+    database.execute("UPDATE subscribers SET access_token = 'changed' WHERE id = ?", (db_token[1].id,))
+    database.commit()
+    statements = []
+    database.set_trace_callback(statements.append)
+    # THEN cached athlete is read without query of its record
+    assert manage_db.get_athlete(db_token[0].id) == db_token[0]
+    assert manage_db.get_settings(db_settings.id) == db_settings
+    assert not [statement for statement in statements if 'subscribers' in statement or 'settings' in statement]
+
+
+def test_athlete_cache_cleared_when_changes_are_pruned(database, db_token, monkeypatch):
+    monkeypatch.setattr(manage_db, 'get_db', lambda: database)
+    monkeypatch.setattr(manage_db, 'INVALIDATION_INTERVAL', 0)
+    manage_db.get_athlete(db_token[0].id)
+    # WHEN change of athlete is pruned before the check
+    database.execute("UPDATE subscribers SET access_token = 'changed' WHERE id = ?", (db_token[0].id,))
+    database.execute('INSERT INTO subscribers VALUES (?, ?, ?, ?)', db_token[2])
+    database.execute('DELETE FROM athlete_changes WHERE athlete_id = ?', (db_token[0].id,))
+    database.commit()
+    # THEN all athletes are evicted
+    assert manage_db.get_athlete(db_token[0].id).access_token == 'changed'
+
+
+def test_athlete_changes_are_pruned(database):
+    database.execute("UPDATE generations SET value = 20000 WHERE name = 'athletes'")
+    database.execute("UPDATE settings SET lan = 'de'")
+    assert [row[0] for row in database.execute('SELECT generation FROM athlete_changes')] == [20001]
+
+
+def test_add_settings_reset_to_default(database, db_settings, monkeypatch):
+    monkeypatch.setattr(manage_db, 'get_db', lambda: database)
+    default_settings = manage_db.DEFAULT_SETTINGS._replace(id=db_settings.id)
+    manage_db.add_settings(default_settings)
+    record = database.execute('SELECT * FROM settings WHERE id = ?', (db_settings.id,)).fetchone()
+    assert manage_db.Settings(*record) == default_settings
+
+
+def test_add_athletes(database, db_token, monkeypatch):
+    monkeypatch.setattr(manage_db, 'get_db', lambda: database)
+    statements = []
+    database.set_trace_callback(statements.append)
+    tokens_list = [db_token[0]._replace(access_token='new'), db_token[1], db_token[2]]
+    manage_db.add_athletes(tokens_list)
+    # all tokens are written in one transaction
+    assert [s for s in statements if s in ('BEGIN ', 'COMMIT')] == ['BEGIN ', 'COMMIT']
+    records = database.execute('SELECT * FROM subscribers ORDER BY id').fetchall()
+    assert [manage_db.Tokens(*record) for record in records] == tokens_list
+
+
+def test_make_storage():
+    assert isinstance(manage_db.make_storage({}), manage_db.SQLiteStorage)
+    assert isinstance(manage_db.make_storage({'STORAGE_BACKEND': 'sqlite'}), manage_db.SQLiteStorage)
+    with pytest.raises(ValueError):
+        manage_db.make_storage({'STORAGE_BACKEND': 'mysql'})
+
+
+def test_get_subscribers_count(database, db_token, monkeypatch):
+    monkeypatch.setattr(manage_db, 'get_db', lambda: database)
+    assert manage_db.get_subscribers_count() == 2
+    # counter is maintained by triggers, the table is not scanned
+    manage_db.add_athlete(db_token[2])
+    manage_db.add_athlete(db_token[2]._replace(access_token='updated'))
+    manage_db.delete_athlete(db_token[0].id)
+    statements = []
+    database.set_trace_callback(statements.append)
+    assert manage_db.get_storage().get_subscribers_count() == 2
+    assert 'COUNT' not in ''.join(statements)
+    # count is cached
+    manage_db.add_athlete(db_token[0])
+    assert manage_db.get_subscribers_count() == 2
+    manage_db.SUBSCRIBERS_COUNT_CACHE.clear()
+    assert manage_db.get_subscribers_count() == 3
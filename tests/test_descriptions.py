@@ -0,0 +1,49 @@
+import pytest
+
+from benchmarks import descriptions as benchmark
+from utils import descriptions
+
+WEATHER = {'condition': {'text': 'partly cloudy', 'code': 1003}, 'temp_c': 1.6, 'feelslike_c': -0.3,
+           'humidity': 75, 'wind_kph': 12.2, 'wind_degree': 350}
+AIR = {'us-epa-index': 2, 'pm2_5': 5.55, 'so2': 1.2, 'no2': 12.45, 'o3': 60.5, 'co': 210.7}
+
+
+@pytest.fixture
+def languages(monkeypatch):
+    monkeypatch.setattr(descriptions, 'LANGUAGES', dict(descriptions.LANGUAGES))
+    yield descriptions.LANGUAGES
+    descriptions._weather_templates.clear()
+    descriptions._air_templates.clear()
+
+
+def test_weather():
+    assert descriptions.weather(WEATHER, 'en') == 'Partly cloudy, 🌡\xa02°C (feels like 0°C), 💦\xa075%, 💨\xa012kph (from N).'
+    assert descriptions.weather(WEATHER, 'ru', humidity=0, wind=0) == 'Partly cloudy, 🌡\xa02°C (по ощущениям 0°C)'
+    assert descriptions.weather({**WEATHER, 'wind_kph': 0.4}, 'en', 0, 1) == \
+        'Partly cloudy, 🌡\xa02°C (feels like 0°C), 💨\xa00kph.'
+
+
+def test_air():
+    assert descriptions.air(AIR, 'en') == '\nAir 🙂 5.5(PM2.5), 1(SO₂), 12(NO₂), 60(O₃), 211(CO).'
+
+
+def test_same_as_former_implementation():
+    for before, before_args, after, after_args in benchmark.cases():
+        assert before(*before_args) == after(*after_args)
+
+
+def test_register_language(languages):
+    descriptions.weather(WEATHER, 'en')
+    compass = [f'"{{{i}}}\'' for i in range(16)]  # quotes and braces are kept as text
+    descriptions.register_language('xx', '{feels}', "k'ph", 'from"', 'Air {x}', compass)
+    assert descriptions.weather(WEATHER, 'xx') == \
+        "Partly cloudy, 🌡\xa02°C ({feels} 0°C), 💦\xa075%, 💨\xa012k'ph (from\" \"{0}')."
+    assert descriptions.air(AIR, 'xx').startswith('\nAir {x} 🙂')
+    assert descriptions.compass_direction(200, 'xx') == '"{9}\''
+    with pytest.raises(ValueError):
+        descriptions.register_language('yy', '', '', '', '', compass[1:])
+
+
+def test_unknown_language():
+    with pytest.raises(KeyError):
+        descriptions.weather(WEATHER, 'xx')
@@ -0,0 +1,36 @@
+import os
+import runpy
+
+import pytest
+
+import run
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'gunicorn.conf.py')
+
+
+@pytest.fixture
+def config():
+    return runpy.run_path(CONFIG_PATH)
+
+
+def test_config(config):
+    assert config['wsgi_app'] == 'run:app'
+    assert config['preload_app'] is True
+    assert config['max_requests'] > 0
+    assert config['max_requests_jitter'] > 0
+
+
+def test_worker_hooks(config, monkeypatch):
+    # GIVEN worker threads which are not running
+    calls = []
+    monkeypatch.setattr(run.workers, 'start', lambda: calls.append('workers.start'))
+    monkeypatch.setattr(run.workers, 'stop', lambda timeout=None: calls.append(('workers.stop', timeout)))
+    monkeypatch.setattr(run.token_refresher, 'start', lambda: calls.append('refresher.start'))
+    monkeypatch.setattr(run.token_refresher, 'stop', lambda timeout=None: calls.append('refresher.stop'))
+    # WHEN worker is forked and then exits
+    config['pre_fork'](None, None)
+    config['post_fork'](None, None)
+    config['worker_exit'](None, None)
+    # THEN threads are started in worker and jobs in progress are waited for on exit
+    assert calls == ['workers.start', 'refresher.start', 'refresher.stop',
+                     ('workers.stop', config['graceful_timeout'])]
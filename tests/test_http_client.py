@@ -0,0 +1,37 @@
+import os
+
+import responses
+
+from utils import http_client
+
+
+def test_session_is_shared():
+    assert http_client.session() is http_client.session()
+    adapter = http_client.session().get_adapter('https://www.strava.com/api/v3/athlete')
+    assert adapter._pool_maxsize == http_client.POOL_SIZES['https://www.strava.com']
+    assert adapter._pool_block
+
+
+def test_session_is_recreated_after_fork(monkeypatch):
+    session = http_client.session()
+    monkeypatch.setattr(os, 'getpid', lambda: -1)
+    assert http_client.session() is not session
+
+
+@responses.activate
+def test_request_timeout_and_latency():
+    responses.add(responses.GET, 'https://example.com/test', body='ok')
+    count = http_client.LATENCY.snapshot().get((('host', 'example.com'),), ([], 0, 0))[2]
+    assert http_client.get('https://example.com/test').text == 'ok'
+    assert http_client.LATENCY.snapshot()[(('host', 'example.com'),)][2] == count + 1
+    assert responses.calls[0].request.req_kwargs['timeout'] == (http_client.CONNECT_TIMEOUT, http_client.READ_TIMEOUT)
+
+
+@responses.activate
+def test_request_retry():
+    responses.add(responses.GET, 'https://example.com/retry', status=503)
+    responses.add(responses.GET, 'https://example.com/retry', status=429)
+    responses.add(responses.GET, 'https://example.com/retry', body='ok')
+    response = http_client.get('https://example.com/retry')
+    assert response.ok
+    assert len(responses.calls) == 3
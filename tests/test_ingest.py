@@ -0,0 +1,66 @@
+import io
+import json
+
+import pytest
+
+from utils import ingest, job_queue, manage_db
+from run import app as site
+
+
+@pytest.fixture
+def app():
+    return site
+
+
+def event(aspect_type='create', object_id=10, owner_id=1, object_type='activity', updates=None):
+    return {'aspect_type': aspect_type, 'object_id': object_id, 'object_type': object_type,
+            'owner_id': owner_id, 'updates': updates or {}}
+
+
+def test_parse_event():
+    assert ingest.parse_event(event()) == ingest.Event(1, 'activity', 10, 'create', {})
+    with pytest.raises(ValueError):
+        ingest.parse_event({'aspect_type': 'create'})
+
+
+def test_ingest_coalesce_duplicates(queue_db):
+    events = [ingest.parse_event(e) for e in (event(), event('update', updates={'title': 'Run'}), event())]
+    assert ingest.ingest(events) == 1
+    # redelivered event of already known activity
+    assert ingest.ingest([ingest.parse_event(event())]) == 0
+    job_queue.complete(job_queue.Job(1, 1, 10, 0))
+    assert ingest.ingest([ingest.parse_event(event())]) == 0
+    assert queue_db.execute('SELECT COUNT(*) FROM jobs').fetchone()[0] == 1
+
+
+def test_ingest_postpones_jobs(queue_db):
+    ingest.ingest([ingest.parse_event(event())])
+    assert job_queue.claim() is None  # job waits for other events of activity
+
+
+def test_ingest_delete_activity(queue_db):
+    events = [ingest.parse_event(e) for e in (event(object_id=10), event(object_id=20), event('delete', object_id=10))]
+    assert ingest.ingest(events) == 2
+    assert [row[0] for row in queue_db.execute('SELECT activity_id FROM jobs')] == [20]
+
+
+def test_ingest_deauthorization(queue_db, db_token):
+    events = [ingest.parse_event(event(owner_id=db_token[0].id)),
+              ingest.parse_event(event('update', db_token[0].id, db_token[0].id, 'athlete', {'authorized': 'false'}))]
+    ingest.ingest(events)
+    assert job_queue.count() == 0
+    assert manage_db.get_athlete(db_token[0].id) is None
+
+
+def test_read_events():
+    lines = io.StringIO('\n'.join(json.dumps(event(object_id=i)) for i in range(3)))
+    array = io.StringIO(json.dumps([event(object_id=i) for i in range(3)]))
+    assert ingest.read_events(lines) == ingest.read_events(array)
+
+
+def test_replay_webhooks_command(app, queue_db, tmpdir):
+    replay_file = tmpdir.join('events.json')
+    replay_file.write('\n'.join(json.dumps(event(object_id=i % 3)) for i in range(5)))
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['replay-webhooks', str(replay_file), '--batch-size', '2'])
+    assert 'Read 5 events, added 3 new jobs.' in result.output
@@ -0,0 +1,208 @@
+import time
+
+import pytest
+import requests
+
+from utils import job_queue, ledger, manage_db, retry_policy, strava_client, weather
+from utils.exceptions import RateLimitExceeded, StravaAPIError
+from run import app as site
+
+
+@pytest.fixture
+def app():
+    return site
+
+
+def test_enqueue_and_claim(queue_db):
+    job_queue.enqueue(1, 10)
+    job_queue.enqueue(2, 20, delay=100)  # not ready yet
+    assert job_queue.count() == 2
+    job = job_queue.claim()
+    assert (job.athlete_id, job.activity_id, job.attempts) == (1, 10, 0)
+    assert job_queue.claim() is None
+    assert job_queue.count(job_queue.RUNNING) == 1
+
+
+def test_claim_abandoned_job(queue_db):
+    job_queue.enqueue(1, 10)
+    job = job_queue.claim()
+    queue_db.execute('UPDATE jobs SET locked_at = ? WHERE id = ?', (int(time.time()) - job_queue.JOB_TIMEOUT - 1, job.id))
+    assert job_queue.claim() == job
+
+
+def test_prune(queue_db):
+    for activity_id in (10, 20, 30):
+        job_queue.enqueue(1, activity_id)
+    job_queue.complete(job_queue.claim())
+    job_queue.dead_letter(job_queue.claim(), 'client_error', 'error')
+    assert job_queue.prune(retention=10) == 0
+    # finished jobs are removed after retention, pending one is kept
+    assert job_queue.prune(retention=-10) == 2
+    assert [row[0] for row in queue_db.execute('SELECT activity_id FROM jobs')] == [30]
+
+
+def test_process_batch(queue_db, monkeypatch):
+    async def add_weather_mock(athlete_id, activity_id):
+        if activity_id == 20:
+            raise ValueError('test')
+
+    monkeypatch.setattr(weather, 'add_weather_async', add_weather_mock)
+    job_queue.enqueue(1, 10)
+    job_queue.enqueue(2, 20)
+    job_queue.enqueue(3, 30)
+    jobs = job_queue.claim_batch(5)
+    assert [job.activity_id for job in jobs] == [10, 20, 30]
+    job_queue.process_batch(jobs)
+    assert job_queue.count(job_queue.DONE) == 2
+    status, attempts, run_at, error = queue_db.execute('SELECT status, attempts, run_at, last_error FROM jobs '
+                                                       'WHERE activity_id = 20').fetchone()
+    assert (status, attempts, error) == (job_queue.PENDING, 1, "ValueError('test')")
+    assert run_at >= time.time() + retry_policy.DEFAULT.base_delay - 1
+
+
+def test_process_batch_rate_limited(queue_db, monkeypatch):
+    async def add_weather_mock(athlete_id, activity_id):
+        raise RateLimitExceeded(int(time.time()) + 900)
+
+    monkeypatch.setattr(weather, 'add_weather_async', add_weather_mock)
+    job_queue.enqueue(1, 10)
+    job_queue.process_batch(job_queue.claim_batch(1))
+    status, attempts, run_at = queue_db.execute('SELECT status, attempts, run_at FROM jobs').fetchone()
+    assert (status, attempts) == (job_queue.PENDING, 0)
+    assert run_at >= time.time() + 899
+
+
+def test_reprocess(app, queue_db):
+    job_queue.enqueue(1, 10)
+    job_queue.complete(job_queue.claim())
+    ledger.record(1, 10, ledger.DONE, time.time())
+    # processed activity is not enqueued again
+    assert not job_queue.enqueue(1, 10)
+    result = app.test_cli_runner().invoke(args=['reprocess', '10', '20'])
+    assert 'Enqueued 1 activities.' in result.output
+    assert not ledger.is_processed(10)
+    assert job_queue.claim().activity_id == 10
+
+
+def test_retry_max_attempts(queue_db):
+    job_queue.enqueue(1, 10)
+    job = job_queue.claim()
+    job_queue.retry(job._replace(attempts=retry_policy.DEFAULT.max_attempts - 1), 'error')
+    assert job_queue.count(job_queue.FAILED) == 1
+
+
+def job_state(db, activity_id):
+    return db.execute('SELECT status, attempts, run_at FROM jobs WHERE activity_id = ?', (activity_id,)).fetchone()
+
+
+def fail_with(monkeypatch, error):
+    async def add_weather_mock(athlete_id, activity_id):
+        raise error
+
+    monkeypatch.setattr(weather, 'add_weather_async', add_weather_mock)
+
+
+def test_process_batch_server_error(queue_db, monkeypatch):
+    fail_with(monkeypatch, StravaAPIError('test', 503))
+    job_queue.enqueue(1, 10)
+    job_queue.process_batch(job_queue.claim_batch(1))
+    status, attempts, run_at = job_state(queue_db, 10)
+    assert (status, attempts) == (job_queue.PENDING, 1)
+    assert run_at >= time.time() + retry_policy.SERVER_ERROR.base_delay - 1
+
+
+def test_process_batch_client_error(queue_db, monkeypatch):
+    # GIVEN activity which was deleted
+    fail_with(monkeypatch, StravaAPIError('test', 404))
+    job_queue.enqueue(1, 10)
+    job_queue.process_batch(job_queue.claim_batch(1))
+    # THEN it is not retried
+    assert job_state(queue_db, 10)[:2] == (job_queue.FAILED, 1)
+    assert [letter.error_class for letter in job_queue.dead_letters()] == ['client_error']
+
+
+def test_process_batch_unauthorized(queue_db, monkeypatch):
+    # GIVEN two activities of athlete rejected with 401
+    fail_with(monkeypatch, StravaAPIError('test', 401))
+    renewed = []
+    monkeypatch.setattr(strava_client, 'renew_tokens', renewed.append)
+    job_queue.enqueue(1, 10)
+    job_queue.enqueue(1, 20)
+    job_queue.process_batch(job_queue.claim_batch(2))
+    # THEN tokens are renewed once and jobs are retried soon
+    assert renewed == [1]
+    status, attempts, run_at = job_state(queue_db, 10)
+    assert (status, attempts) == (job_queue.PENDING, 1)
+    assert run_at <= time.time() + retry_policy.UNAUTHORIZED.max_delay
+
+
+def test_process_batch_access_revoked(queue_db, monkeypatch):
+    fail_with(monkeypatch, StravaAPIError('test', 401))
+
+    def renew_tokens(athlete_id):
+        raise StravaAPIError('test', 400)
+
+    monkeypatch.setattr(strava_client, 'renew_tokens', renew_tokens)
+    job_queue.enqueue(1, 10)
+    job_queue.process_batch(job_queue.claim_batch(1))
+    assert job_state(queue_db, 10)[0] == job_queue.FAILED
+    assert job_queue.count_dead_letters() == {'unauthorized': 1}
+
+
+@pytest.mark.parametrize('renewal_error', [StravaAPIError('test', 503), requests.ConnectionError('no network')])
+def test_process_batch_renewal_failed(queue_db, monkeypatch, renewal_error):
+    # GIVEN activity rejected with 401 and OAuth server which is not available
+    fail_with(monkeypatch, StravaAPIError('test', 401))
+
+    def renew_tokens(athlete_id):
+        raise renewal_error
+
+    monkeypatch.setattr(strava_client, 'renew_tokens', renew_tokens)
+    job_queue.enqueue(1, 10)
+    job_queue.process_batch(job_queue.claim_batch(1))
+    # THEN activity is retried later
+    assert job_state(queue_db, 10)[:2] == (job_queue.PENDING, 1)
+    assert job_queue.count_dead_letters() == {}
+
+
+def test_dead_letters_replay(app, queue_db):
+    # GIVEN activities failed permanently
+    for activity_id in (10, 20, 30):
+        job_queue.enqueue(activity_id // 10, activity_id)
+        job = job_queue.claim()
+        job_queue.retry(job._replace(attempts=retry_policy.DEFAULT.max_attempts - 1), 'error')
+    job_queue.dead_letter(job._replace(attempts=1), 'server_error', 'error')
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['dead-letters', 'list', '--limit', '1'])
+    assert result.output.splitlines()[0] == 'error: 2, server_error: 1'
+    assert len(result.output.splitlines()) == 2
+    # WHEN they are replayed
+    result = runner.invoke(args=['dead-letters', 'replay', '--error-class', 'error'])
+    assert 'Enqueued 2 activities.' in result.output
+    # THEN they are processed again from the first attempt
+    assert job_state(queue_db, 10)[:2] == (job_queue.PENDING, 0)
+    assert job_queue.count_dead_letters() == {'server_error': 1}
+    assert job_queue.replay_dead_letters([30]) == 1
+    assert job_queue.dead_letters() == []
+
+
+def test_worker_pool(app, tmpdir, monkeypatch):
+    processed = []
+
+    async def add_weather_mock(*args):
+        processed.append(args)
+
+    monkeypatch.setattr(weather, 'add_weather_async', add_weather_mock)
+    app.config['DATABASE'] = str(tmpdir.join('queue.db'))
+    with app.app_context():
+        manage_db.init_db()
+        job_queue.enqueue(1, 10)
+        job_queue.enqueue(2, 20)
+    pool = job_queue.WorkerPool(app, size=2, batch_size=1, poll_interval=0.01)
+    pool.notify()
+    deadline = time.time() + 5
+    while len(processed) < 2 and time.time() < deadline:
+        time.sleep(0.01)
+    pool.stop()
+    assert sorted(processed) == [(1, 10), (2, 20)]
+    assert not pool.running
@@ -0,0 +1,47 @@
+import time
+
+import pytest
+
+from utils import ledger
+from run import app as site
+
+
+@pytest.fixture
+def app():
+    return site
+
+
+def test_record(queue_db):
+    started_at = time.time()
+    assert not ledger.is_processed(10)
+    ledger.record(1, 10, ledger.DONE, started_at, {'description': '☀️ +20°C'})
+    assert ledger.is_processed(10)
+    entry = ledger.get(10)
+    assert (entry.athlete_id, entry.status, entry.payload) == (1, ledger.DONE, {'description': '☀️ +20°C'})
+    assert started_at <= entry.finished_at
+    assert ledger.get(20) is None
+
+
+def test_stats(queue_db):
+    ledger.record(1, 10, ledger.DONE, time.time() - 2)
+    ledger.record(1, 11, ledger.DONE, time.time())
+    ledger.record(2, 20, ledger.SKIPPED, time.time())
+    stats = ledger.stats()
+    assert stats[ledger.DONE]['count'] == 2
+    assert stats[ledger.SKIPPED]['count'] == 1
+    assert stats[ledger.DONE]['avg_seconds'] == pytest.approx(1, abs=0.5)
+    assert ledger.stats(time.time() + 1) == {}
+
+
+def test_forget(queue_db):
+    for athlete_id, activity_id in [(1, 10), (1, 11), (2, 20), (2, 21)]:
+        ledger.record(athlete_id, activity_id, ledger.DONE, time.time())
+    assert sorted(ledger.forget([20, 30], athlete_id=1)) == [(1, 10), (1, 11), (2, 20)]
+    assert not ledger.is_processed(10)
+    assert ledger.is_processed(21)
+
+
+def test_ledger_stats_command(app, queue_db):
+    ledger.record(1, 10, ledger.DONE, time.time())
+    result = app.test_cli_runner().invoke(args=['ledger-stats'])
+    assert 'done: 1 activities' in result.output
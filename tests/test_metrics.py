@@ -0,0 +1,97 @@
+import asyncio
+import logging
+import os
+
+import pytest
+
+from utils import metrics, tracing
+
+
+def test_counter():
+    counter = metrics.Counter('test_total', 'Test counter')
+    counter.inc(status='done')
+    counter.inc(2, status='done')
+    counter.inc(status='skipped')
+    assert counter.snapshot() == {(('status', 'done'),): 3, (('status', 'skipped'),): 1}
+
+
+def test_render(monkeypatch):
+    histogram = metrics.Histogram('test_seconds', 'Test histogram', buckets=(0.1, 1, float('inf')))
+    histogram.observe(0.05, stage='get')
+    histogram.observe(0.5, stage='get')
+    counter = metrics.Counter('test_total', 'Test counter')
+    counter.inc(stage='get "x"')
+    monkeypatch.setattr(metrics, 'METRICS', {'test_seconds': histogram})
+    monkeypatch.setattr(metrics, 'COLLECTORS', [lambda: [counter]])
+    monkeypatch.setattr(metrics, 'PROCESS_COLLECTORS', [])
+    assert metrics.render().splitlines() == [
+        '# HELP test_seconds Test histogram',
+        '# TYPE test_seconds histogram',
+        'test_seconds_bucket{stage="get",le="0.1"} 1',
+        'test_seconds_bucket{stage="get",le="1"} 2',
+        'test_seconds_bucket{stage="get",le="+Inf"} 2',
+        'test_seconds_sum{stage="get"} 0.55',
+        'test_seconds_count{stage="get"} 2',
+        '# HELP test_total Test counter',
+        '# TYPE test_total counter',
+        'test_total{stage="get \\"x\\""} 1',
+    ]
+
+
+def test_metrics_of_processes(tmpdir, monkeypatch):
+    monkeypatch.setattr(metrics, 'COLLECTORS', [])
+    monkeypatch.setattr(metrics, 'PROCESS_COLLECTORS', [])
+    monkeypatch.setattr(metrics, 'METRICS_DIR', str(tmpdir))
+
+    def process_metrics(total, seconds, value):
+        counter = metrics.Counter('test_total', 'Test counter')
+        counter.inc(total, status='done')
+        histogram = metrics.Histogram('test_seconds', 'Test histogram', buckets=(1, float('inf')))
+        histogram.observe(seconds)
+        gauge = metrics.Gauge('test_gauge', 'Test gauge')
+        gauge.set(value)
+        monkeypatch.setattr(metrics, 'METRICS', {metric.name: metric for metric in (counter, histogram, gauge)})
+
+    # GIVEN metrics saved by another process which has finished
+    process_metrics(2, 0.5, 3)
+    metrics.dump()
+    os.rename(tmpdir.join(f'process-{metrics.process_id()}.json'), tmpdir.join('process-999999999-finished.json'))
+    # WHEN metrics are scraped from the current process
+    process_metrics(1, 2, 4)
+    for _ in range(2):
+        lines = metrics.render().splitlines()
+        # THEN counters and histograms of both processes are summed, gauge of finished process is dropped
+        assert 'test_total{status="done"} 3' in lines
+        assert 'test_seconds_count 2' in lines
+        assert 'test_seconds_bucket{le="1"} 1' in lines
+        assert [line for line in lines if line.startswith('test_gauge{')] == [f'test_gauge{{pid="{os.getpid()}"}} 4']
+        # metrics of finished process are kept in one file with metrics of all finished processes
+        assert sorted(path.basename for path in tmpdir.listdir(fil='*.json')) == [
+            metrics.FINISHED_FILE, f'process-{metrics.process_id()}.json']
+    metrics.clear_dir()
+    assert not tmpdir.listdir(fil='*.json')
+
+
+def test_span():
+    before = tracing.STAGE_LATENCY.snapshot().get((('stage', 'test_span'),), (None, 0, 0))[2]
+    with tracing.span('test_span'):
+        pass
+    with pytest.raises(ValueError):
+        with tracing.span('test_span'):
+            raise ValueError
+    assert tracing.STAGE_LATENCY.snapshot()[(('stage', 'test_span'),)][2] == before + 2
+    assert tracing.STAGE_ERRORS.snapshot()[(('stage', 'test_span'),)] >= 1
+
+
+def test_trace_id_in_logs(caplog):
+    tracing.init_logging()
+    logger = logging.getLogger('test_tracing')
+
+    async def log():
+        await asyncio.to_thread(logger.warning, 'in thread')
+
+    with caplog.at_level(logging.WARNING), tracing.trace(123) as trace_id:
+        asyncio.run(log())
+    assert trace_id.startswith('123-')
+    assert [record.trace_id for record in caplog.records] == [trace_id]
+    assert tracing.trace_id.get() == '-'
@@ -0,0 +1,132 @@
+import sqlite3
+import threading
+import time
+
+from utils import backfill, job_queue, manage_db, partitions, strava_client
+
+
+def test_assign_moves_only_partitions_of_changed_workers():
+    two = partitions.assign(['a', 'b'])
+    three = partitions.assign(['a', 'b', 'c'])
+    # every partition has exactly one owner
+    assert sorted(p for owned in three.values() for p in owned) == list(range(partitions.PARTITIONS))
+    # new worker takes partitions from others, other partitions stay where they were
+    assert three['a'] <= two['a'] and three['b'] <= two['b']
+    assert three['c'] == (two['a'] - three['a']) | (two['b'] - three['b'])
+    assert three['c']
+    # when worker leaves, its partitions are split between the rest
+    assert partitions.assign(['a', 'b']) == two
+    assert partitions.assign([]) == {}
+
+
+def test_membership_rebalances_when_worker_joins_and_leaves(queue_db):
+    first, second = partitions.Membership('first'), partitions.Membership('second')
+    assert first.heartbeat() == frozenset(range(partitions.PARTITIONS))
+    # partitions of the second worker are leased by the first one until it releases them
+    assert second.heartbeat() == frozenset()
+    assigned = partitions.assign(['first', 'second'])
+    assert first.heartbeat() == assigned['first']
+    assert second.heartbeat() == assigned['second']
+    assert partitions.leases() == {'first': sorted(assigned['first']), 'second': sorted(assigned['second'])}
+    second.leave()
+    assert first.heartbeat() == frozenset(range(partitions.PARTITIONS))
+
+
+def test_membership_takes_expired_leases(queue_db):
+    dead, alive = partitions.Membership('dead'), partitions.Membership('alive')
+    dead.heartbeat()
+    alive.heartbeat()
+    # dead worker does not renew its record and leases
+    expired = int(time.time()) - partitions.LEASE_TTL - 1
+    queue_db.execute('UPDATE workers SET heartbeat_at = ? WHERE id = ?', (expired, 'dead'))
+    queue_db.execute('UPDATE partition_leases SET expires_at = ? WHERE worker_id = ?', (expired, 'dead'))
+    assert alive.heartbeat() == frozenset(range(partitions.PARTITIONS))
+
+
+def test_lost_partitions_are_forgotten(queue_db):
+    lost = []
+    first = partitions.Membership('first', on_lost=lost.append)
+    first.heartbeat()
+    partitions.Membership('second').heartbeat()
+    owned = first.heartbeat()
+    assert lost == [frozenset(range(partitions.PARTITIONS)) - owned]
+
+
+def test_forget_partitions():
+    manage_db.TOKENS_CACHE.set(1, 'tokens_1')
+    manage_db.TOKENS_CACHE.set(2, 'tokens_2')
+    manage_db.SETTINGS_CACHE.set(1, 'settings_1')
+    partitions.forget_partitions({partitions.partition_of(1)})
+    assert manage_db.TOKENS_CACHE.get(1) is None and manage_db.SETTINGS_CACHE.get(1) is None
+    assert manage_db.TOKENS_CACHE.get(2) == 'tokens_2'
+
+
+def test_keep_alive_logs_failed_heartbeat(monkeypatch, caplog):
+    def locked():
+        raise sqlite3.OperationalError('database is locked')
+
+    monkeypatch.setattr(manage_db, 'get_db', locked)
+    partitions.Membership('first').keep_alive()
+    assert 'database is locked' in caplog.text
+
+
+def test_claim_jobs_of_owned_partitions(queue_db):
+    first, second = partitions.Membership('first'), partitions.Membership('second')
+    first.heartbeat()
+    second.heartbeat()
+    first.heartbeat()
+    second.heartbeat()
+    athletes = {membership.worker_id: next(a for a in range(1, 1000) if membership.owns(a))
+                for membership in (first, second)}
+    job_queue.enqueue(athletes['first'], 10)
+    job_queue.enqueue(athletes['second'], 20)
+    assert job_queue.claim('second').activity_id == 20
+    assert job_queue.claim('second') is None
+    assert job_queue.claim('first').activity_id == 10
+    # without membership any job is taken
+    job_queue.enqueue(athletes['second'], 30)
+    assert job_queue.claim().activity_id == 30
+
+
+def test_refresher_and_backfill_take_owned_athletes(queue_db, monkeypatch):
+    membership = partitions.Membership('first')
+    membership.owned = frozenset({partitions.partition_of(2)})
+    refreshed = []
+    monkeypatch.setattr(strava_client, 'refresh_tokens_once', lambda tokens, athlete_id: refreshed.append(athlete_id))
+    monkeypatch.setattr(manage_db, 'add_athletes', lambda tokens_list: None)
+    strava_client.TokenRefresher(None, membership=membership).refresh_expiring()
+    assert refreshed == [2]
+    backfill.start(1)
+    assert backfill.step(membership) is False  # backfill of athlete of another partition is not taken
+
+
+def test_init_db_adds_partitions_to_old_queue(tmpdir, monkeypatch):
+    monkeypatch.setattr(manage_db, '_database', str(tmpdir.join('old.db')))
+    db = manage_db.get_db()
+    db.execute('CREATE TABLE jobs (id integer NOT NULL PRIMARY KEY AUTOINCREMENT, athlete_id integer NOT NULL, '
+               'activity_id integer NOT NULL, status text NOT NULL DEFAULT \'pending\', '
+               'attempts integer NOT NULL DEFAULT 0, run_at integer NOT NULL, locked_at integer, last_error text)')
+    db.execute('INSERT INTO jobs (athlete_id, activity_id, run_at) VALUES (?, ?, ?)', (partitions.PARTITIONS + 5, 10, 0))
+    db.commit()
+    manage_db.init_db()
+    assert db.execute('SELECT partition FROM jobs').fetchone()[0] == 5
+    manage_db.close_db()
+
+
+def test_partitioned_worker_pool(tmpdir, monkeypatch):
+    # GIVEN pool of partitioned workers and a job in the queue
+    monkeypatch.setattr(manage_db, '_database', str(tmpdir.join('worker.db')))
+    manage_db.init_db()
+    membership = partitions.Membership('first')
+    pool = job_queue.WorkerPool(None, size=1, poll_interval=0.01, membership=membership)
+    processed = threading.Event()
+    monkeypatch.setattr(job_queue, 'process_batch', lambda jobs: processed.set())
+    job_queue.enqueue(1, 123)
+    # WHEN pool is started
+    pool.start()
+    # THEN it takes all partitions and processes the job, partitions are released on stop
+    assert processed.wait(5)
+    assert membership.owned == frozenset(range(partitions.PARTITIONS))
+    pool.stop(5)
+    assert partitions.leases() == {None: list(range(partitions.PARTITIONS))}
+    manage_db.close_db()
@@ -0,0 +1,57 @@
+import time
+
+import pytest
+import responses
+
+from utils import rate_limit, strava_client
+from utils.exceptions import RateLimitExceeded
+
+
+def test_acquire_exhausted():
+    limiter = rate_limit.RateLimiter(short_limit=2, long_limit=10)
+    limiter.acquire()
+    limiter.acquire()
+    assert limiter.remaining() == (0, 8)
+    assert rate_limit.BUDGET.snapshot()[(('window', '15min'),)] == 0
+    with pytest.raises(RateLimitExceeded) as e:
+        limiter.acquire()
+    assert e.value.retry_at % rate_limit.SHORT_WINDOW == 0
+    assert 0 < e.value.retry_at - time.time() <= rate_limit.SHORT_WINDOW
+
+
+def test_daily_limit_exhausted():
+    limiter = rate_limit.RateLimiter(short_limit=10, long_limit=1)
+    limiter.acquire()
+    with pytest.raises(RateLimitExceeded) as e:
+        limiter.acquire()
+    assert e.value.retry_at % rate_limit.LONG_WINDOW == 0
+
+
+def test_window_refill(monkeypatch):
+    limiter = rate_limit.RateLimiter(short_limit=1, long_limit=10)
+    limiter.acquire()
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + rate_limit.SHORT_WINDOW)
+    limiter.acquire()
+    assert limiter.remaining() == (0, 8)
+
+
+def test_update_from_headers():
+    limiter = rate_limit.RateLimiter()
+    limiter.update({'X-RateLimit-Limit': '100,1000', 'X-RateLimit-Usage': '99,500'})
+    assert limiter.remaining() == (1, 500)
+    limiter.update({'X-RateLimit-Limit': 'wrong'})
+    assert limiter.remaining() == (1, 500)
+
+
+@responses.activate
+def test_strava_request_rate_limited():
+    responses.add(responses.GET, 'https://www.strava.com/api/v3/athlete', status=429,
+                  headers={'X-RateLimit-Limit': '100,1000', 'X-RateLimit-Usage': '101,500'})
+    with pytest.raises(RateLimitExceeded):
+        strava_client.request('GET', 'https://www.strava.com/api/v3/athlete')
+    assert len(responses.calls) == 1  # Strava quota is not retried by HTTP client
+    # budget is exhausted, so next request is not sent at all
+    with pytest.raises(RateLimitExceeded):
+        strava_client.request('GET', 'https://www.strava.com/api/v3/athlete')
+    assert len(responses.calls) == 1
@@ -0,0 +1,25 @@
+import pytest
+
+from utils import retry_policy
+from utils.exceptions import StravaAPIError, RateLimitExceeded, WeatherAPIError
+
+
+@pytest.mark.parametrize('error, policy', [
+    (RateLimitExceeded(0), retry_policy.RATE_LIMITED),
+    (StravaAPIError('test', 401), retry_policy.UNAUTHORIZED),
+    (StravaAPIError('test', 404), retry_policy.CLIENT_ERROR),
+    (StravaAPIError('test', 503), retry_policy.SERVER_ERROR),
+    (StravaAPIError('test'), retry_policy.DEFAULT),
+    (WeatherAPIError('test'), retry_policy.WEATHER_ERROR),
+    (ValueError('test'), retry_policy.DEFAULT),
+])
+def test_policy_for(error, policy):
+    assert retry_policy.policy_for(error) is policy
+
+
+def test_delay():
+    policy = retry_policy.Policy('test', 5, 10, 100)
+    for attempts, base in ((0, 10), (1, 20), (3, 80), (4, 100), (10, 100)):
+        delays = [retry_policy.delay(policy, attempts) for _ in range(50)]
+        assert all(base <= delay <= base * (1 + retry_policy.JITTER) for delay in delays)
+        assert len(set(delays)) > 1  # retries of jobs failed at once are spread
@@ -0,0 +1,82 @@
+import os
+
+import pytest
+
+from utils import manage_db
+
+DSN = os.environ.get('TEST_DATABASE_URL')
+
+
+@pytest.fixture(params=['sqlite', 'postgres'])
+def storage(request, db_token, db_settings):
+    """Every implementation of manage_db.Storage with tokens of two athletes and settings of the first one."""
+    if request.param == 'sqlite':
+        request.getfixturevalue('queue_db')
+        yield manage_db.SQLiteStorage()
+        return
+    pytest.importorskip('psycopg2')
+    if not DSN:
+        pytest.skip('TEST_DATABASE_URL with PostgreSQL database for tests is not set')
+    from utils.pg_storage import PostgresStorage
+
+    storage = PostgresStorage(DSN, maxconn=2)
+    storage.init_db()
+    with storage.cursor() as cur:
+        cur.execute('DELETE FROM subscribers; DELETE FROM settings')
+    storage.add_athletes(db_token[:2])
+    storage.add_settings(db_settings)
+    yield storage
+    storage.close()
+
+
+def test_storage_is_abstract():
+    with pytest.raises(TypeError):
+        manage_db.Storage()
+
+
+def test_get_athlete(storage, db_token):
+    assert storage.get_athlete(db_token[0].id) == db_token[0]
+    assert storage.get_athlete(db_token[2].id) is None
+
+
+def test_get_expiring_athletes(storage, db_token):
+    assert storage.get_expiring_athletes(db_token[1].expires_at + 1) == [db_token[1]]
+    assert storage.get_expiring_athletes(db_token[0].expires_at + 1) == [db_token[1], db_token[0]]
+
+
+def test_add_athletes(storage, db_token):
+    generation = storage.generation()
+    storage.add_athletes(db_token[:2])
+    # unchanged records are not written
+    assert storage.generation() == generation
+    updated_tokens = db_token[0]._replace(access_token='updated')
+    storage.add_athletes([updated_tokens, db_token[2]])
+    assert storage.get_athlete(updated_tokens.id) == updated_tokens
+    assert storage.get_athlete(db_token[2].id) == db_token[2]
+    assert storage.generation() > generation
+    assert [athlete_id for _, athlete_id in storage.changes(generation)] == [updated_tokens.id, db_token[2].id]
+    assert storage.get_subscribers_count() == 3
+
+
+def test_add_settings(storage, db_settings):
+    updated_settings = db_settings._replace(lan='de')
+    storage.add_settings(updated_settings)
+    assert storage.get_settings(db_settings.id) == updated_settings
+    # default settings of new athlete are not stored
+    storage.add_settings(manage_db.DEFAULT_SETTINGS._replace(id=2))
+    assert storage.get_settings(2) is None
+
+
+def test_delete_athlete(storage, db_settings):
+    generation = storage.generation()
+    storage.delete_athlete(db_settings.id)
+    assert storage.get_athlete(db_settings.id) is None
+    assert storage.get_settings(db_settings.id) is None
+    assert storage.get_subscribers_count() == 1
+    assert {athlete_id for _, athlete_id in storage.changes(generation)} == {db_settings.id}
+
+
+def test_module_functions_use_storage(storage, db_token, monkeypatch):
+    monkeypatch.setattr(manage_db, '_storage', storage)
+    assert manage_db.get_athlete(db_token[0].id) == db_token[0]
+    assert manage_db.get_subscribers_count() == 2
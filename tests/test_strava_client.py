@@ -1,10 +1,14 @@
+import asyncio
 import json
+import sqlite3
+import threading
 import time
 
 import pytest
+import requests
 import responses
 
-from utils import manage_db, strava_client
+from utils import manage_db, strava_client, http_client
 from utils.exceptions import StravaAPIError
 
 
@@ -55,9 +59,33 @@ def test_strava_client_modify_activity_failed(database, db_token, monkeypatch):
     responses.add(responses.PUT, f'https://www.strava.com/api/v3/activities/{activity_id}', status=500)
     monkeypatch.setattr(manage_db, 'get_db', lambda: database)
     client = strava_client.StravaClient(athlete_tokens.id, activity_id)
-    with pytest.raises(StravaAPIError):
+    with pytest.raises(StravaAPIError) as e:
         client.modify_activity({'description': 'test'})
-    assert len(responses.calls) == 1
+    assert e.value.status == 500
+    assert len(responses.calls) == http_client.RETRIES + 1  # server errors are retried
+
+
+@responses.activate
+def test_fetch_activity_unauthorized():
+    responses.add(responses.GET, 'https://www.strava.com/api/v3/activities/1', status=401,
+                  json={'message': 'Authorization Error'})
+    with pytest.raises(StravaAPIError) as e:
+        strava_client.fetch_activity(1, 1, {})
+    assert e.value.status == 401
+
+
+@responses.activate
+def test_renew_tokens(database, db_token, monkeypatch):
+    # GIVEN tokens which are not expired, but rejected by Strava
+    monkeypatch.setattr(manage_db, 'get_db', lambda: database)
+    new_tokens = {'access_token': 'new_access', 'refresh_token': 'new_refresh', 'expires_at': 2 ** 31}
+    responses.add(responses.POST, 'https://www.strava.com/oauth/token', json=new_tokens)
+    strava_client.REFRESHED_TOKENS.set(db_token[0].id, db_token[0])
+    # WHEN tokens are renewed
+    tokens = strava_client.renew_tokens(db_token[0].id)
+    # THEN new tokens are requested and saved
+    assert tokens == manage_db.Tokens(db_token[0].id, 'new_access', 'new_refresh', 2 ** 31)
+    assert manage_db.get_athlete(db_token[0].id) == tokens
 
 
 @responses.activate
@@ -96,3 +124,103 @@ def test_strava_client_update_tokens_failed(database, db_token, monkeypatch):
     record = cur.execute(f'SELECT * FROM subscribers WHERE id = {athlete_id}')
     actual_tokens = manage_db.Tokens(*record.fetchone())
     assert actual_tokens == db_token[1]
+
+
+@responses.activate
+def test_async_strava_client(database, monkeypatch):
+    activity_id = 1
+    athlete_id = 2  # tokens are expired
+    responses.add(responses.POST, 'https://www.strava.com/oauth/token',
+                  body=json.dumps({'access_token': 'new_access_token',
+                                   'refresh_token': 'new_refresh_token',
+                                   'expires_at': int(time.time()) + 100}))
+    responses.add(responses.GET, f'https://www.strava.com/api/v3/activities/{activity_id}', json={'id': activity_id})
+    responses.add(responses.PUT, f'https://www.strava.com/api/v3/activities/{activity_id}', body='ok')
+    monkeypatch.setattr(manage_db, 'get_db', lambda: database)
+
+    async def process():
+        client = await strava_client.AsyncStravaClient.create(athlete_id, activity_id)
+        activity = await client.get_activity()
+        await client.modify_activity({'description': 'test'})
+        return activity
+
+    assert asyncio.run(process()) == {'id': activity_id}
+    assert len(responses.calls) == 3
+    assert responses.calls[2].request.headers['Authorization'] == 'Bearer new_access_token'
+    assert manage_db.get_athlete(athlete_id).access_token == 'new_access_token'
+
+
+def test_refresh_tokens_once(db_token, monkeypatch):
+    calls = []
+    tokens = db_token[1]
+
+    def refresh_tokens_mock(old_tokens, athlete_id):
+        calls.append(athlete_id)
+        time.sleep(0.05)
+        return old_tokens._replace(access_token='new_access_token', expires_at=int(time.time()) + 100)
+
+    monkeypatch.setattr(strava_client, 'refresh_tokens', refresh_tokens_mock)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(strava_client.refresh_tokens_once(tokens, tokens.id)))
+               for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert calls == [tokens.id]
+    assert len(set(results)) == 1
+    assert results[0].access_token == 'new_access_token'
+    # lock of athlete is removed when it is not used
+    assert strava_client._refresh_locks == {}
+
+
+@responses.activate
+def test_token_refresher(database, db_token, monkeypatch):
+    responses.add(responses.POST, 'https://www.strava.com/oauth/token',
+                  body=json.dumps({'access_token': 'new_access_token',
+                                   'refresh_token': 'new_refresh_token',
+                                   'expires_at': int(time.time()) + 21600}))
+    monkeypatch.setattr(manage_db, 'get_db', lambda: database)
+    strava_client.TokenRefresher(None).refresh_expiring()
+    # tokens of athletes 1 and 2 expire within margin
+    assert len(responses.calls) == 2
+    assert manage_db.get_athlete(db_token[0].id).access_token == 'new_access_token'
+    assert manage_db.get_athlete(db_token[1].id).refresh_token == 'new_refresh_token'
+
+
+@responses.activate
+def test_token_refresher_skips_revoked_access(database, db_token, monkeypatch):
+    responses.add(responses.POST, 'https://www.strava.com/oauth/token', status=400, json={'message': 'Bad Request'})
+    responses.add(responses.POST, 'https://www.strava.com/oauth/token', body=requests.ConnectionError('no network'))
+    monkeypatch.setattr(manage_db, 'get_db', lambda: database)
+    refresher = strava_client.TokenRefresher(None)
+    refresher.refresh_expiring()
+    assert len(responses.calls) == 2
+    # rejected refresh token is not used again, network error is retried
+    refresher.refresh_expiring()
+    assert len(responses.calls) == 3
+    assert strava_client.REJECTED_TOKENS.get(db_token[1].id) == db_token[1].refresh_token
+    # rejection is forgotten when refresh succeeds on demand
+    responses.add(responses.POST, 'https://www.strava.com/oauth/token',
+                  json={'access_token': 'new_access_token', 'refresh_token': 'new_refresh_token',
+                        'expires_at': int(time.time()) + 21600})
+    strava_client.renew_tokens(db_token[1].id)
+    assert strava_client.REJECTED_TOKENS.get(db_token[1].id) is None
+
+
+def test_rejected_tokens_expire(db_token, monkeypatch):
+    monkeypatch.setattr(strava_client.REJECTED_TOKENS, 'ttl', 0.01)
+    strava_client.REJECTED_TOKENS.set(db_token[1].id, db_token[1].refresh_token)
+    time.sleep(0.02)
+    assert strava_client.REJECTED_TOKENS.get(db_token[1].id) is None
+
+
+def test_token_refresher_survives_errors(monkeypatch):
+    refresher = strava_client.TokenRefresher(None, interval=0)
+
+    def locked():
+        refresher._stopped.set()
+        raise sqlite3.OperationalError('database is locked')
+
+    monkeypatch.setattr(refresher, 'refresh_expiring', locked)
+    refresher._run()
@@ -1,8 +1,11 @@
 import json
 
+import pytest
 import responses
+from click.testing import CliRunner
 
-from utils import strava_helpers
+from utils import cli, strava_helpers
+from utils.exceptions import StravaAPIError
 
 
 @responses.activate
@@ -38,3 +41,57 @@ def test_is_app_subscribed_wrong():
     subscription_status = strava_helpers.is_app_subscribed()
     assert isinstance(subscription_status, bool)
     assert not subscription_status
+
+
+@responses.activate
+def test_is_app_subscribed_cached():
+    """Status is requested from Strava once"""
+    responses.add(responses.GET, 'https://www.strava.com/api/v3/push_subscriptions', json=[{'id': 1}])
+    assert strava_helpers.is_app_subscribed()
+    assert strava_helpers.is_app_subscribed()
+    assert len(responses.calls) == 1
+    assert strava_helpers.get_subscription(refresh=True) == {'id': 1}
+    assert len(responses.calls) == 2
+
+
+@responses.activate
+def test_is_app_subscribed_error_not_cached():
+    """Bad answer of Strava is not cached"""
+    responses.add(responses.GET, 'https://www.strava.com/api/v3/push_subscriptions', body='')
+    responses.add(responses.GET, 'https://www.strava.com/api/v3/push_subscriptions', json=[{'id': 1}])
+    assert not strava_helpers.is_app_subscribed()
+    assert strava_helpers.is_app_subscribed()
+
+
+@responses.activate
+def test_create_and_delete_subscription():
+    responses.add(responses.GET, 'https://www.strava.com/api/v3/push_subscriptions', json=[])
+    responses.add(responses.POST, 'https://www.strava.com/api/v3/push_subscriptions', json={'id': 7})
+    responses.add(responses.DELETE, 'https://www.strava.com/api/v3/push_subscriptions/7', status=204)
+    assert not strava_helpers.is_app_subscribed()
+    subscription = strava_helpers.create_subscription('https://example.com/webhook')
+    assert subscription == {'id': 7, 'callback_url': 'https://example.com/webhook'}
+    assert strava_helpers.is_app_subscribed()
+    strava_helpers.delete_subscription(7)
+    assert not strava_helpers.is_app_subscribed()
+    assert [call.request.method for call in responses.calls] == ['GET', 'POST', 'DELETE', 'GET']
+
+
+@responses.activate
+def test_create_subscription_error():
+    responses.add(responses.POST, 'https://www.strava.com/api/v3/push_subscriptions', status=400,
+                  json={'message': 'Bad Request'})
+    with pytest.raises(StravaAPIError):
+        strava_helpers.create_subscription('https://example.com/webhook')
+
+
+@responses.activate
+def test_subscription_command():
+    responses.add(responses.GET, 'https://www.strava.com/api/v3/push_subscriptions',
+                  json=[{'id': 7, 'callback_url': 'https://example.com/webhook'}])
+    responses.add(responses.DELETE, 'https://www.strava.com/api/v3/push_subscriptions/7', status=204)
+    runner = CliRunner()
+    result = runner.invoke(cli.subscription_command, ['verify'])
+    assert result.output == 'Subscription 7 sends events to https://example.com/webhook.\n'
+    result = runner.invoke(cli.subscription_command, ['delete'])
+    assert result.output == 'Subscription 7 is deleted.\n'
@@ -1,3 +1,4 @@
+import asyncio
 import re
 import time
 
@@ -7,8 +8,8 @@ from datetime import datetime, timedelta
 import pytest
 import responses
 
-from utils import weather, manage_db
-from utils.exceptions import StravaAPIError
+from utils import weather, manage_db, http_client, ledger
+from utils.exceptions import StravaAPIError, WeatherAPIError
 
 LAT = 55.752388  # Moscow latitude default
 LNG = 37.716457  # Moscow longitude default
@@ -19,6 +20,10 @@ directions_to_try = [(0, 'N', 'С'), (7, 'N', 'С'), (11, 'N', 'С'), (12, 'NNE'
 directions_ids = [f'{d[0]:<3}: {d[1]:>3}' for d in directions_to_try]
 
 
+# Ledger of processed activities is kept in database
+pytestmark = pytest.mark.usefixtures('queue_db')
+
+
 class MockResponse:
     """Class to mock http responses"""
     def __init__(self, ok=True):
@@ -43,17 +48,20 @@ class MockResponse:
 
 
 class StravaClientMock(ABC):
-    """Class to mock StravaClient class from utilities module"""
+    """Class to mock AsyncStravaClient class from utilities module"""
     def __init__(self, athlete_id, activity_id):
         self.athlete_id = athlete_id
         self.activity_id = activity_id
 
-    @property
-    def get_activity(self):  # pragma: no cover
+    @classmethod
+    async def create(cls, athlete_id, activity_id):
+        return cls(athlete_id, activity_id)
+
+    async def get_activity(self):  # pragma: no cover
         pass
 
     @staticmethod
-    def modify_activity(payload):
+    async def modify_activity(payload):
         return MockResponse(True) if isinstance(payload, dict) else MockResponse(False)
 
 
@@ -70,8 +78,7 @@ activities_to_try = [
 @pytest.fixture(params=activities_to_try)
 def strava_client_mock(request):
     class StravaClient(StravaClientMock):
-        @property
-        def get_activity(self):
+        async def get_activity(self):
             return request.param
 
     return StravaClient
@@ -100,13 +107,57 @@ def test_get_weather_description():
 
 
 def test_get_weather_description_no_wind(monkeypatch):
-    monkeypatch.setattr('requests.get', lambda *args: MockResponse())
+    monkeypatch.setattr(http_client, 'get', lambda *args: MockResponse())
     settings = manage_db.DEFAULT_SETTINGS
     descr = weather.get_weather_description(LAT, LNG, TIME, settings)
     print(descr)
     assert re.fullmatch(r'Weather description, 🌡.-15°C \(по ощущениям 23°C\), 💦.64%, 💨.0м/с.', descr)
 
 
+def test_day_weather_cached(monkeypatch):
+    calls = []
+    monkeypatch.setattr(http_client, 'get', lambda *args: calls.append(args) or MockResponse())
+    hits = weather.HISTORY_CACHE.hits
+    first = weather.hour_weather(LAT, LNG, TIME, 'en')
+    # activity started nearby later at the same day
+    second = weather.hour_weather(LAT + 0.001, LNG - 0.001, TIME.replace(hour=23, minute=59), 'en')
+    assert first == second
+    assert len(calls) == 1
+    assert 'hour=' not in calls[0][0]
+    assert weather.HISTORY_CACHE.hits == hits + 1
+    weather.hour_weather(LAT, LNG, TIME, 'ru')
+    assert len(calls) == 2
+
+
+def test_day_weather_refreshes_forecast(monkeypatch):
+    calls = []
+    monkeypatch.setattr(http_client, 'get', lambda *args: calls.append(args) or MockResponse())
+    # the day was requested before the hour of activity was over
+    now = time.time()
+    monkeypatch.setattr(weather.time, 'time', lambda: now - weather.FORECAST_REFRESH - 1)
+    weather.day_weather(LAT, LNG, '2021-06-03', 'en', until=now - 10)
+    monkeypatch.setattr(weather.time, 'time', lambda: now)
+    weather.day_weather(LAT, LNG, '2021-06-03', 'en', until=now - 10)
+    assert len(calls) == 2
+    # response fetched after the hour is kept
+    weather.day_weather(LAT, LNG, '2021-06-03', 'en', until=now - 10)
+    weather.day_weather(LAT, LNG, '2021-06-03', 'en')
+    assert len(calls) == 2
+
+
+def test_hour_weather_interpolation(monkeypatch):
+    hours = [{'condition': {'text': 'clear', 'code': 1000}, 'temp_c': 10, 'feelslike_c': 8,
+              'humidity': 50, 'wind_kph': 10, 'wind_degree': 350, 'time': '00:00'},
+             {'condition': {'text': 'cloudy', 'code': 1006}, 'temp_c': 12, 'feelslike_c': 12,
+              'humidity': 61, 'wind_kph': 20, 'wind_degree': 30, 'time': '01:00'}]
+    monkeypatch.setattr(weather.ROUTER, 'history', lambda *args: hours)
+    w = weather.hour_weather(LAT, LNG, datetime(2021, 6, 3, 0, 15), 'en')
+    assert w == {'condition': {'text': 'clear', 'code': 1000}, 'temp_c': 10.5, 'feelslike_c': 9,
+                 'humidity': 53, 'wind_kph': 12.5, 'wind_degree': 0}
+    assert weather.hour_weather(LAT, LNG, datetime(2021, 6, 3, 0, 45), 'en')['condition']['code'] == 1006
+    assert weather.hour_weather(LAT, LNG, datetime(2021, 6, 3, 1, 30), 'en')['temp_c'] == 12
+
+
 @responses.activate
 def test_get_weather_description_bad_response():
     """Case when something wrong with openweatherapi response"""
@@ -121,6 +172,19 @@ def test_get_air_description():
     assert re.fullmatch(r'\nВоздух . \d+(\.\d)?\(PM2\.5\), \d+\(SO₂\), \d+\(NO₂\), \d+(\.\d)?\(O₃\), \d+\(CO\)\.', description)
 
 
+def test_current_air_cached(monkeypatch):
+    calls = []
+    air = {'us-epa-index': 1, 'pm2_5': 1.5, 'so2': 1, 'no2': 2, 'o3': 3, 'co': 4}
+    monkeypatch.setattr(weather, 'air_info', lambda params: calls.append(params) or air)
+    descriptions = {weather.get_air_description(LAT + d, LNG - d, lan) for d in (0, 0.01) for lan in ('ru', 'en')}
+    assert descriptions == {'\nВоздух 😃 1.5(PM2.5), 1(SO₂), 2(NO₂), 3(O₃), 4(CO).',
+                            '\nAir 😃 1.5(PM2.5), 1(SO₂), 2(NO₂), 3(O₃), 4(CO).'}
+    assert len(calls) == 1
+    weather.current_air(LAT + 1, LNG)
+    assert len(calls) == 2
+    assert weather.AIR_CACHE.stats()['size'] == 2
+
+
 def test_add_weather_bad_activity(strava_client_mock, monkeypatch):
     """Run method for next cases:
 
@@ -130,7 +194,7 @@ def test_add_weather_bad_activity(strava_client_mock, monkeypatch):
     - icon in activity name is already set.
     In all this cases there is no needed to add the weather information to this activity."""
 
-    monkeypatch.setattr(weather, 'StravaClient', strava_client_mock)
+    monkeypatch.setattr(weather, 'AsyncStravaClient', strava_client_mock)
     monkeypatch.setattr(manage_db, 'get_settings', lambda *args: manage_db.DEFAULT_SETTINGS._replace(icon=1))
     monkeypatch.setattr(weather, 'get_weather_description', lambda *args: '')
     monkeypatch.setattr(weather, 'get_weather_icon', lambda *args: 'icon')
@@ -164,14 +228,131 @@ def test_add_weather_success(monkeypatch, output_settings):
     In all this cases weather was successfully added."""
 
     class StravaClient(StravaClientMock):
-        @property
-        def get_activity(self):
+        async def get_activity(self):
             return {'start_latlng': [LAT, LNG], 'elapsed_time': 1,
                     'start_date': time.strftime('%Y-%m-%dT%H:%M:%SZ'), 'name': 'Activity name'}
 
-    monkeypatch.setattr(weather, 'StravaClient', StravaClient)
+    monkeypatch.setattr(weather, 'AsyncStravaClient', StravaClient)
     monkeypatch.setattr(manage_db, 'get_settings', lambda *args: output_settings)
-    monkeypatch.setattr(weather, 'get_weather_description', lambda *args: '')
+    monkeypatch.setattr(weather, 'get_weather_description', lambda *args: 'Clear')
     monkeypatch.setattr(weather, 'get_air_description', lambda *args: '')
     monkeypatch.setattr(weather, 'get_weather_icon', lambda *args: 'icon')
     assert weather.add_weather(0, 0) is None
+
+
+@pytest.mark.parametrize('output_settings', settings_to_try[:2])
+def test_add_weather_no_weather(monkeypatch, output_settings):
+    """Activity is not modified if weather is not available, the job is retried later"""
+
+    class StravaClient(StravaClientMock):
+        async def get_activity(self):
+            return {'start_latlng': [LAT, LNG], 'elapsed_time': 1,
+                    'start_date': time.strftime('%Y-%m-%dT%H:%M:%SZ'), 'name': 'Activity name'}
+
+        async def modify_activity(self, payload):
+            pytest.fail('activity is modified')
+
+    monkeypatch.setattr(weather, 'AsyncStravaClient', StravaClient)
+    monkeypatch.setattr(manage_db, 'get_settings', lambda *args: output_settings)
+    monkeypatch.setattr(weather, 'get_weather_description', lambda *args: '')
+    monkeypatch.setattr(weather, 'get_air_description', lambda *args: 'air')
+    monkeypatch.setattr(weather, 'get_weather_icon', lambda *args: None)
+    with pytest.raises(WeatherAPIError):
+        weather.add_weather(0, 0)
+
+
+def test_get_weather_icon_unknown_condition(monkeypatch):
+    monkeypatch.setattr(weather, 'hour_weather', lambda *args: {'condition': {'code': 1009}})
+    assert weather.get_weather_icon(LAT, LNG, TIME) == '☁'
+    monkeypatch.setattr(weather, 'hour_weather', lambda *args: {'condition': {'code': 9999}})
+    assert weather.get_weather_icon(LAT, LNG, TIME) == ''
+
+
+def test_add_weather_no_icon(monkeypatch):
+    """Activity with weather condition without icon is skipped, not retried"""
+
+    class StravaClient(StravaClientMock):
+        async def get_activity(self):
+            return {'start_latlng': [LAT, LNG], 'elapsed_time': 1,
+                    'start_date': time.strftime('%Y-%m-%dT%H:%M:%SZ'), 'name': 'Activity name'}
+
+        async def modify_activity(self, payload):
+            pytest.fail('activity is modified')
+
+    monkeypatch.setattr(weather, 'AsyncStravaClient', StravaClient)
+    monkeypatch.setattr(manage_db, 'get_settings', lambda *args: manage_db.DEFAULT_SETTINGS._replace(icon=1))
+    monkeypatch.setattr(weather, 'get_weather_icon', lambda *args: '')
+    weather.add_weather(1, 10)
+    assert ledger.get(10).status == ledger.SKIPPED
+
+
+def test_process_activities(monkeypatch):
+    in_progress = []
+    max_in_progress = []
+
+    async def add_weather_mock(athlete_id, activity_id):
+        in_progress.append(activity_id)
+        max_in_progress.append(len(in_progress))
+        await asyncio.sleep(0.01)
+        in_progress.remove(activity_id)
+        if activity_id == 3:
+            raise StravaAPIError('test')
+
+    monkeypatch.setattr(weather, 'add_weather_async', add_weather_mock)
+    results = asyncio.run(weather.process_activities([(0, i) for i in range(10)], concurrency=4))
+    assert max(max_in_progress) == 4
+    assert [isinstance(result, StravaAPIError) for result in results] == [i == 3 for i in range(10)]
+
+
+def test_add_weather_async_concurrent_requests(monkeypatch):
+    """Weather and air quality are requested at the same time"""
+    started = []
+
+    class StravaClient(StravaClientMock):
+        async def get_activity(self):
+            return {'start_latlng': [LAT, LNG], 'elapsed_time': 1,
+                    'start_date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), 'name': 'Activity name'}
+
+        @staticmethod
+        async def modify_activity(payload):
+            assert payload == {'description': 'weather' + 'air'}
+
+    def slow_request(result):
+        def request(*args):
+            started.append(time.perf_counter())
+            time.sleep(0.1)
+            return result
+        return request
+
+    monkeypatch.setattr(weather, 'AsyncStravaClient', StravaClient)
+    monkeypatch.setattr(manage_db, 'get_settings', lambda *args: manage_db.DEFAULT_SETTINGS)
+    monkeypatch.setattr(weather, 'get_weather_description', slow_request('weather'))
+    monkeypatch.setattr(weather, 'get_air_description', slow_request('air'))
+    weather.add_weather(0, 0)
+    assert len(started) == 2
+    assert abs(started[0] - started[1]) < 0.05
+
+
+def test_add_weather_records_ledger(monkeypatch):
+    class StravaClient(StravaClientMock):
+        async def get_activity(self):
+            return {'start_latlng': [LAT, LNG], 'elapsed_time': 1,
+                    'start_date': time.strftime('%Y-%m-%dT%H:%M:%SZ'), 'name': 'Activity name'}
+
+    monkeypatch.setattr(weather, 'AsyncStravaClient', StravaClient)
+    monkeypatch.setattr(manage_db, 'get_settings', lambda *args: manage_db.DEFAULT_SETTINGS._replace(icon=1))
+    monkeypatch.setattr(weather, 'get_weather_icon', lambda *args: 'icon')
+    weather.add_weather(1, 10)
+    entry = ledger.get(10)
+    assert (entry.status, entry.payload) == (ledger.DONE, {'name': 'icon Activity name'})
+
+
+def test_add_weather_already_processed(monkeypatch):
+    class StravaClient(StravaClientMock):
+        @classmethod
+        async def create(cls, athlete_id, activity_id):  # pragma: no cover
+            raise AssertionError('Strava must not be requested')
+
+    monkeypatch.setattr(weather, 'AsyncStravaClient', StravaClient)
+    ledger.record(1, 10, ledger.SKIPPED, time.time())
+    assert weather.add_weather(1, 10) is None
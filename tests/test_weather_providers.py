@@ -0,0 +1,122 @@
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+import responses
+
+from utils import weather_providers
+from utils.weather_providers import Router, Provider, WeatherAPIProvider, OpenMeteoProvider
+
+
+class FakeProvider(Provider):
+    def __init__(self, name, latency=0.0, error=None):
+        self.name = name
+        super().__init__()
+        self.latency = latency
+        self.error = error
+        self.calls = 0
+        self.finished = threading.Event()
+
+    def history(self, lat, lon, date, lan):
+        self.calls += 1
+        time.sleep(self.latency)
+        self.finished.set()
+        if self.error:
+            raise self.error
+        return [{'provider': self.name}]
+
+
+@responses.activate
+def test_weatherapi_provider():
+    hours = [{'condition': {'text': 'Sunny', 'code': 1000}, 'temp_c': 20}] * 24
+    responses.add(responses.GET, re.compile(r'https://weather\.test/v1/history\.json\?.*'),
+                  json={'forecast': {'forecastday': [{'hour': hours}]}})
+    assert WeatherAPIProvider('https://weather.test/v1', 'key').history(55.75, 37.62, '2021-06-03', 'en') == hours
+    assert 'dt=2021-06-03' in responses.calls[0].request.url
+    assert 'key=key' in responses.calls[0].request.url
+
+
+@responses.activate
+def test_open_meteo_provider():
+    responses.add(responses.GET, re.compile(r'https://meteo\.test/v1/forecast\?.*'), json={'hourly': {
+        'time': ['2021-06-03T00:00', '2021-06-03T01:00'], 'weather_code': [0, 63], 'temperature_2m': [10.5, 11],
+        'apparent_temperature': [9, 10], 'relative_humidity_2m': [60, 65], 'wind_speed_10m': [7.2, 9],
+        'wind_direction_10m': [180, 190]}})
+    date = (datetime.now(timezone.utc) - timedelta(days=2)).strftime('%Y-%m-%d')
+    hours = OpenMeteoProvider('https://meteo.test/v1').history(55.75, 37.62, date, 'ru')
+    assert hours[0] == {'condition': {'text': 'Ясно', 'code': 1000}, 'temp_c': 10.5, 'feelslike_c': 9,
+                        'humidity': 60, 'wind_kph': 7.2, 'wind_degree': 180}
+    assert hours[1]['condition'] == {'text': 'Умеренный дождь', 'code': 1189}
+    assert f'start_date={date}&end_date={date}' in responses.calls[0].request.url
+
+
+@responses.activate
+def test_open_meteo_provider_archive():
+    responses.add(responses.GET, re.compile(r'https://archive\.test/v1/archive\?.*'), json={'hourly': {
+        'weather_code': [0], 'temperature_2m': [10.5], 'apparent_temperature': [9], 'relative_humidity_2m': [60],
+        'wind_speed_10m': [7.2], 'wind_direction_10m': [180]}})
+    provider = OpenMeteoProvider('https://meteo.test/v1', 'https://archive.test/v1')
+    assert provider.history(55.75, 37.62, '2021-06-03', 'en')[0]['temp_c'] == 10.5
+    assert 'start_date=2021-06-03' in responses.calls[0].request.url
+
+
+@responses.activate
+def test_open_meteo_provider_no_data():
+    responses.add(responses.GET, re.compile(r'https://meteo\.test/v1/forecast\?.*'), json={'hourly': {
+        'weather_code': [None], 'temperature_2m': [None], 'apparent_temperature': [None],
+        'relative_humidity_2m': [None], 'wind_speed_10m': [None], 'wind_direction_10m': [None]}})
+    with pytest.raises(ValueError):
+        OpenMeteoProvider('https://meteo.test/v1').history(55.75, 37.62, datetime.now().strftime('%Y-%m-%d'), 'en')
+
+
+def test_router_primary():
+    primary, secondary = FakeProvider('primary'), FakeProvider('secondary')
+    assert Router([primary, secondary]).history(0, 0, '2021-06-03', 'en') == [{'provider': 'primary'}]
+    assert (primary.calls, secondary.calls) == (1, 0)
+    assert primary.stats.requests == 1
+
+
+def test_router_hedged_request():
+    primary, secondary = FakeProvider('primary', latency=0.3), FakeProvider('secondary')
+    router = Router([primary, secondary], hedge_delay=0.05)
+    started = time.perf_counter()
+    assert router.history(0, 0, '2021-06-03', 'en') == [{'provider': 'secondary'}]
+    assert time.perf_counter() - started < 0.2
+    # slow request is finished in background and counted in statistics
+    primary.finished.wait(1)
+    time.sleep(0.01)
+    assert router.stats()['primary']['requests'] == 1
+    # faster provider is preferred now
+    assert router.ranked() == [secondary, primary]
+
+
+def test_router_fallback_on_error():
+    primary, secondary = FakeProvider('primary', error=KeyError('hour')), FakeProvider('secondary')
+    router = Router([primary, secondary], hedge_delay=0)
+    assert router.history(0, 0, '2021-06-03', 'en') == [{'provider': 'secondary'}]
+    assert router.stats()['primary']['errors'] == 1
+
+
+def test_router_all_failed():
+    primary = FakeProvider('primary', error=KeyError('primary'))
+    secondary = FakeProvider('secondary', error=ValueError('secondary'))
+    with pytest.raises(KeyError):
+        Router([primary, secondary]).history(0, 0, '2021-06-03', 'en')
+    assert (primary.calls, secondary.calls) == (1, 1)
+
+
+def test_router_ranking():
+    fast, slow, failing = FakeProvider('fast'), FakeProvider('slow'), FakeProvider('failing')
+    router = Router([slow, failing, fast])
+    fast.stats.observe(0.2, ok=True)
+    slow.stats.observe(1.0, ok=True)
+    failing.stats.observe(0.1, ok=False)
+    assert router.ranked() == [fast, slow, failing]
+
+
+def test_create_router():
+    router = weather_providers.create_router(['weatherapi', ' open-meteo', ''], hedge_delay=2)
+    assert [provider.name for provider in router.providers] == ['weatherapi', 'open-meteo']
+    assert router.hedge_delay == 2
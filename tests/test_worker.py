@@ -0,0 +1,62 @@
+import threading
+import time
+
+from utils import job_queue, manage_db, strava_client, worker
+
+
+class StoppedEvent(threading.Event):
+    def __init__(self):
+        super().__init__()
+        self.set()
+
+
+def test_worker_main(monkeypatch):
+    # GIVEN worker which gets SIGTERM at once
+    monkeypatch.setattr(manage_db, '_database', manage_db._database)
+    monkeypatch.setattr(manage_db, '_storage', manage_db._storage)
+    monkeypatch.setenv('DATABASE', 'worker.db')
+    monkeypatch.setattr(worker.signal, 'signal', lambda *args: None)
+    monkeypatch.setattr(worker.threading, 'Event', StoppedEvent)
+    calls = []
+    monkeypatch.setattr(job_queue.WorkerPool, 'start', lambda self: calls.append(('start', self.app, self.size)))
+    monkeypatch.setattr(job_queue.WorkerPool, 'stop', lambda self, timeout=None: calls.append('stop'))
+    monkeypatch.setattr(strava_client.TokenRefresher, 'start', lambda self: None)
+    monkeypatch.setattr(strava_client.TokenRefresher, 'stop', lambda self, timeout=None: None)
+    # WHEN worker is started
+    assert worker.main(['--size', '3']) == 0
+    # THEN threads work without Flask application with the database from environment
+    assert calls == [('start', None, 3), 'stop']
+    assert manage_db._database.endswith('worker.db')
+
+
+def test_worker_pool_without_app(tmpdir, monkeypatch):
+    # GIVEN pool of workers without Flask application and database set by manage_db.configure
+    monkeypatch.setattr(manage_db, '_database', manage_db._database)
+    monkeypatch.setattr(manage_db, '_storage', manage_db._storage)
+    manage_db.configure({'DATABASE': str(tmpdir.join('worker.db'))})
+    manage_db.init_db()
+    pool = job_queue.WorkerPool(None, size=1, poll_interval=0.01)
+    processed = threading.Event()
+    monkeypatch.setattr(job_queue, 'process_batch', lambda jobs: processed.set())
+    job_queue.enqueue(1, 123)
+    # WHEN pool is started
+    pool.start()
+    # THEN jobs are processed
+    assert processed.wait(5)
+    pool.stop(5)
+    manage_db.close_db()
+
+
+def test_worker_pool_stop_timeout_is_shared():
+    # GIVEN pool of threads which do not finish their jobs
+    pool = job_queue.WorkerPool(None, size=3)
+    busy = threading.Event()
+    pool._threads = [threading.Thread(target=busy.wait, daemon=True) for _ in range(3)]
+    for thread in pool._threads:
+        thread.start()
+    # WHEN pool is stopped with timeout
+    started = time.monotonic()
+    pool.stop(0.2)
+    # THEN all threads are waited for within the timeout
+    assert time.monotonic() - started < 0.4
+    busy.set()
@@ -0,0 +1,9 @@
+import os
+
+# Settings from .env are loaded before modules of package read them. On hosts where the environment
+# is set without the file python-dotenv is not imported at all.
+_dotenv_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '.env')
+if os.path.exists(_dotenv_path):
+    from dotenv import load_dotenv
+
+    load_dotenv(_dotenv_path)
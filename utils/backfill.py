@@ -0,0 +1,97 @@
+import os
+import time
+from collections import namedtuple
+
+import requests
+
+from utils import cache, job_queue, ledger, manage_db, strava_client, weather
+from utils.exceptions import StravaAPIError, RateLimitExceeded
+
+Backfill = namedtuple('Backfill', 'athlete_id status page before after scanned enqueued updated_at last_error')
+
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'  # it can be started again
+
+PAGE_SIZE = int(os.environ.get('BACKFILL_PAGE_SIZE', 50))
+# Backfill does not use the last requests of the Strava budget, they are left for new activities
+RESERVE = int(os.environ.get('BACKFILL_RATE_RESERVE', 50))
+WAIT_INTERVAL = 10  # seconds between attempts to continue backfill when the budget is exhausted
+
+
+def start(athlete_id: int, after: int = None) -> Backfill:
+    """Start backfill of athlete's activities or return the one in progress. Activities are taken from
+    the newest one at the moment of start down to the time after. Failed backfill continues from the page
+    where it stopped.
+
+    :param athlete_id: Strava athlete ID
+    :param after: Unix time, older activities are not processed
+    :return: named tuple Backfill
+    """
+    current = get(athlete_id)
+    if current and current.status == RUNNING:
+        return current
+    db = manage_db.get_db()
+    now = int(time.time())
+    if current and current.status == FAILED:
+        db.execute('UPDATE backfills SET status = ?, updated_at = ? WHERE athlete_id = ?', (RUNNING, now, athlete_id))
+        db.commit()
+        return get(athlete_id)
+    db.execute('INSERT OR REPLACE INTO backfills (athlete_id, status, page, before, after, updated_at) '
+               'VALUES (?, ?, 1, ?, ?, ?)', (athlete_id, RUNNING, now, after, now))
+    db.commit()
+    return get(athlete_id)
+
+
+def get(athlete_id: int):
+    """Return progress of backfill of athlete or None."""
+    record = manage_db.get_db().execute('SELECT * FROM backfills WHERE athlete_id = ?', (athlete_id,)).fetchone()
+    if record:
+        return Backfill(*record)
+
+
+def eligible(activity: dict) -> bool:
+    """Check that weather can be added to activity by its summary."""
+    return not (activity.get('manual') or activity.get('trainer') or activity.get('type') == 'VirtualRide'
+                or not activity.get('start_latlng') or ledger.is_processed(activity['id']))
+
+
+def weather_key(activity: dict) -> tuple:
+    """Activities with the same key share one request of weather history: cell of grid and date."""
+    lat, lon = activity['start_latlng']
+    return (*cache.grid_cell(lat, lon, weather.GRID_STEP), activity.get('start_date', '')[:10])
+
+
+def step(membership=None) -> bool:
+    """Take one page of activities of the least recently advanced backfill and put eligible activities
+    to the queue. Activities are enqueued grouped by place and date, so workers process them together
+    and share weather history. Progress is saved after every page, so backfill continues after restart.
+
+    :param membership: partitions.Membership of worker, only backfills of athletes of its partitions are taken
+    :return: True if backfill made progress
+    """
+    db = manage_db.get_db()
+    records = db.execute('SELECT * FROM backfills WHERE status = ? ORDER BY updated_at', (RUNNING,)).fetchall()
+    record = next((record for record in records if membership is None or membership.owns(record[0])), None)
+    if not record or min(strava_client.RATE_LIMITER.remaining()) <= RESERVE:
+        return False
+    backfill = Backfill(*record)
+    try:
+        headers = strava_client.auth_headers(backfill.athlete_id)
+        activities = strava_client.fetch_athlete_activities(backfill.athlete_id, headers, backfill.page, PAGE_SIZE,
+                                                            backfill.before, backfill.after)
+    except (RateLimitExceeded, requests.RequestException):
+        return False  # it is continued when the budget is renewed or network is available
+    except StravaAPIError as e:
+        db.execute('UPDATE backfills SET status = ?, updated_at = ?, last_error = ? WHERE athlete_id = ?',
+                   (FAILED, int(time.time()), repr(e), backfill.athlete_id))
+        db.commit()
+        return False
+    selected = sorted((activity for activity in activities if eligible(activity)), key=weather_key)
+    enqueued = job_queue.enqueue_many([(backfill.athlete_id, activity['id']) for activity in selected])
+    db.execute('UPDATE backfills SET status = ?, page = ?, scanned = scanned + ?, enqueued = enqueued + ?, '
+               'updated_at = ?, last_error = NULL WHERE athlete_id = ?',
+               (RUNNING if activities else DONE, backfill.page + 1, len(activities), max(enqueued, 0),
+                int(time.time()), backfill.athlete_id))
+    db.commit()
+    return True
@@ -0,0 +1,211 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from utils import metrics
+
+CACHES = {}  # all caches created by the application, by name
+
+
+class LRUCache:
+    """Thread-safe in-memory cache with limited size and optional time to live of records.
+    Least recently used records are evicted first.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+        self._loading = {}
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._get(key)
+            if value is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._set(key, value, time.time() + self.ttl if self.ttl else None)
+
+    def get_or_set(self, key, factory):
+        """Return cached value or make it with factory() and cache it. Concurrent callers which
+        miss the same key wait for a single call of factory.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+        with self._lock:
+            loading = self._loading.setdefault(key, threading.Lock())
+        with loading:
+            try:
+                with self._lock:
+                    value = self._get(key)
+                if value is None:
+                    value = factory()
+                    self.set(key, value)
+                return value
+            finally:
+                with self._lock:
+                    self._loading.pop(key, None)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def evict(self, predicate) -> int:
+        """Delete records whose keys match predicate(key).
+
+        :return: number of deleted records
+        """
+        with self._lock:
+            keys = [key for key in self._data if predicate(key)]
+            for key in keys:
+                self.delete(key)
+        return len(keys)
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self)}
+
+    def _get(self, key):
+        record = self._data.get(key)
+        if record is None:
+            return
+        value, expires_at = record
+        if expires_at is not None and expires_at < time.time():
+            del self._data[key]
+            return
+        self._data.move_to_end(key)
+        return value
+
+    def _set(self, key, value, expires_at):
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+
+class PersistentCache(LRUCache):
+    """LRU cache which keeps records in SQLite file as well, so they survive restarts
+    of application. Values must be JSON serializable.
+    """
+
+    def __init__(self, path: str, table: str, maxsize: int = 1024, ttl: float = None):
+        super().__init__(maxsize, ttl)
+        self.table = table
+        self.path = path
+        self._connection = None
+        self._pid = None
+        self._db.execute(f'CREATE TABLE IF NOT EXISTS {table} ('
+                         'key text NOT NULL PRIMARY KEY, value text NOT NULL, expires_at real, used_at real NOT NULL);')
+        self._db.execute(f'CREATE INDEX IF NOT EXISTS {table}_used_at ON {table} (used_at);')
+        self._db.commit()
+
+    @property
+    def _db(self) -> sqlite3.Connection:
+        """Connection of the current process, connection of parent process must not be used after fork."""
+        if self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._pid = os.getpid()
+        return self._connection
+
+    def clear(self):
+        with self._lock:
+            super().clear()
+            self._db.execute(f'DELETE FROM {self.table}')
+            self._db.commit()
+
+    def delete(self, key):
+        with self._lock:
+            super().delete(key)
+            self._db.execute(f'DELETE FROM {self.table} WHERE key = ?', (key,))
+            self._db.commit()
+
+    def _get(self, key):
+        value = super()._get(key)
+        if value is not None:
+            return value
+        now = time.time()
+        record = self._db.execute(f'SELECT value, expires_at FROM {self.table} WHERE key = ? '
+                                  'AND (expires_at IS NULL OR expires_at >= ?)', (key, now)).fetchone()
+        if record is None:
+            return
+        self._db.execute(f'UPDATE {self.table} SET used_at = ? WHERE key = ?', (now, key))
+        self._db.commit()
+        value = json.loads(record[0])
+        super()._set(key, value, record[1])
+        return value
+
+    def _set(self, key, value, expires_at):
+        super()._set(key, value, expires_at)
+        self._db.execute(f'INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?, ?)',
+                         (key, json.dumps(value), expires_at, time.time()))
+        self._db.execute(f'DELETE FROM {self.table} WHERE key IN '
+                         f'(SELECT key FROM {self.table} ORDER BY used_at DESC LIMIT -1 OFFSET ?)', (self.maxsize,))
+        self._db.commit()
+
+
+def create(name: str, maxsize: int = 1024, ttl: float = None, persistent: bool = False):
+    """Make new cache and register it. Persistent caches are stored in the file CACHE_DATABASE
+    if it is set in the environment, otherwise they are kept in memory only.
+
+    :param name: unique name of cache, it is used as table name for persistent cache
+    :param maxsize: max number of records
+    :param ttl: time to live of records in seconds, records never expire if None
+    :param persistent: keep records on disk
+    :return: cache instance
+    """
+    path = os.environ.get('CACHE_DATABASE')
+    if persistent and path:
+        CACHES[name] = PersistentCache(path, name, maxsize, ttl)
+    else:
+        CACHES[name] = LRUCache(maxsize, ttl)
+    return CACHES[name]
+
+
+def clear_all():
+    for cache in CACHES.values():
+        cache.clear()
+
+
+def collect_metrics() -> list:
+    """Hits, misses and size of all caches for /metrics."""
+    hits = metrics.Counter('cache_hits_total', 'Number of cache hits')
+    misses = metrics.Counter('cache_misses_total', 'Number of cache misses')
+    size = metrics.Gauge('cache_size', 'Number of records in cache')
+    for name, cache in CACHES.items():
+        stats = cache.stats()
+        hits.inc(stats['hits'], cache=name)
+        misses.inc(stats['misses'], cache=name)
+        size.set(stats['size'], cache=name)
+    return [hits, misses, size]
+
+
+metrics.PROCESS_COLLECTORS.append(collect_metrics)
+
+
+def grid_cell(lat: float, lon: float, step: float) -> tuple:
+    """Quantize coordinates to the cell of geographical grid.
+
+    :param lat: latitude
+    :param lon: longitude
+    :param step: size of grid cell in degrees
+    :return: tuple of integer cell indexes
+    """
+    return round(float(lat) / step), round(float(lon) / step)
@@ -0,0 +1,167 @@
+import functools
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from utils import backfill, ingest, job_queue, ledger, manage_db, partitions, strava_client, strava_helpers
+
+
+def init_app(app):
+    """Register commands of application, e.g. flask init-db."""
+    for command in (init_db_command, run_workers_command, reprocess_command, replay_webhooks_command,
+                    ledger_stats_command, backfill_command, subscription_command, dead_letters_command,
+                    partitions_command):
+        app.cli.add_command(command)
+
+
+@click.command('init-db')
+@with_appcontext
+def init_db_command():
+    """Clear existing database and create new table."""
+    manage_db.init_db()
+    click.echo('Initialized database.')
+
+
+@click.command('run-workers')
+@click.option('--size', default=2, show_default=True, help='Number of worker threads.')
+@click.option('--batch-size', default=10, show_default=True, help='Number of jobs processed concurrently by a thread.')
+@click.option('--partitioned', is_flag=True, help='Process only athletes of partitions owned by this process.')
+@with_appcontext
+def run_workers_command(size, batch_size, partitioned):
+    """Process queued activities until interrupted."""
+    app = current_app._get_current_object()
+    membership = partitions.Membership() if partitioned else None
+    pool = job_queue.WorkerPool(app, size, batch_size, on_idle=functools.partial(backfill.step, membership),
+                                membership=membership)
+    pool.start()
+    refresher = strava_client.TokenRefresher(app, membership=membership)
+    refresher.start()
+    click.echo(f'Started {size} workers.')
+    try:
+        while pool.running:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        refresher.stop()
+        pool.stop()
+
+
+@click.command('partitions')
+@with_appcontext
+def partitions_command():
+    """Show partitions of the queue owned by workers."""
+    for worker_id, owned in sorted(partitions.leases().items(), key=lambda item: item[0] or ''):
+        click.echo(f"{worker_id or 'no owner'}: {len(owned)} partitions {owned}")
+
+
+@click.command('reprocess')
+@click.argument('activity_ids', nargs=-1, type=int)
+@click.option('--athlete', type=int, help='Reprocess all activities of the athlete.')
+@with_appcontext
+def reprocess_command(activity_ids, athlete):
+    """Add weather to already processed ACTIVITY_IDS again."""
+    click.echo(f'Enqueued {job_queue.reprocess(activity_ids, athlete)} activities.')
+
+
+@click.command('replay-webhooks')
+@click.argument('file', type=click.File('r'))
+@click.option('--batch-size', default=500, show_default=True, help='Number of events saved in one transaction.')
+@with_appcontext
+def replay_webhooks_command(file, batch_size):
+    """Put events of Strava webhook from FILE to the queue."""
+    events = ingest.read_events(file)
+    new_jobs = sum(ingest.ingest(events[i:i + batch_size]) for i in range(0, len(events), batch_size))
+    click.echo(f'Read {len(events)} events, added {new_jobs} new jobs.')
+
+
+@click.command('ledger-stats')
+@click.option('--hours', default=24, show_default=True, help='Period of statistics.')
+@with_appcontext
+def ledger_stats_command(hours):
+    """Show number of processed activities by status."""
+    for status, values in sorted(ledger.stats(time.time() - hours * 3600).items()):
+        click.echo(f"{status}: {values['count']} activities, {values['avg_seconds']:.2f} s on average")
+
+
+@click.command('backfill')
+@click.argument('athlete_id', type=int)
+@click.option('--since', type=click.DateTime(formats=['%Y-%m-%d']), help='Skip activities before this date.')
+@click.option('--wait', is_flag=True, help='Scan all pages now, waiting for the rate budget if needed.')
+@with_appcontext
+def backfill_command(athlete_id, since, wait):
+    """Add weather to historical activities of ATHLETE_ID. Activities are processed by workers."""
+    progress = backfill.start(athlete_id, int(since.timestamp()) if since else None)
+    click.echo(f'Backfill of athlete {athlete_id} is at page {progress.page}.')
+    while wait and progress.status == backfill.RUNNING:
+        if not backfill.step():
+            time.sleep(backfill.WAIT_INTERVAL)
+        progress = backfill.get(athlete_id)
+    if progress.status == backfill.FAILED:
+        click.echo(f'Failed to get activities: {progress.last_error}')
+    click.echo(f'Scanned {progress.scanned} activities, enqueued {progress.enqueued}.')
+
+
+@click.group('subscription')
+def subscription_command():
+    """Manage push subscription of APP to Strava Webhook events."""
+
+
+@subscription_command.command('create')
+@click.argument('callback_url')
+def create_subscription_command(callback_url):
+    """Subscribe to events, Strava sends them to CALLBACK_URL."""
+    subscription = strava_helpers.create_subscription(callback_url)
+    click.echo(f"Subscription {subscription['id']} is created.")
+
+
+@subscription_command.command('verify')
+def verify_subscription_command():
+    """Show current subscription requested from Strava."""
+    subscription = strava_helpers.get_subscription(refresh=True)
+    if subscription is None:
+        click.echo('Failed to get subscription status from Strava.')
+    elif subscription:
+        click.echo(f"Subscription {subscription['id']} sends events to {subscription.get('callback_url')}.")
+    else:
+        click.echo('APP is not subscribed.')
+
+
+@subscription_command.command('delete')
+def delete_subscription_command():
+    """Unsubscribe from events."""
+    subscription = strava_helpers.get_subscription(refresh=True)
+    if not subscription:
+        click.echo('APP is not subscribed.')
+        return
+    strava_helpers.delete_subscription(subscription['id'])
+    click.echo(f"Subscription {subscription['id']} is deleted.")
+
+
+@click.group('dead-letters')
+def dead_letters_command():
+    """Activities which failed permanently."""
+
+
+@dead_letters_command.command('list')
+@click.option('--limit', default=20, show_default=True, help='Number of the latest records.')
+@click.option('--error-class', help='Only records with this class of error, e.g. server_error.')
+@with_appcontext
+def list_dead_letters_command(limit, error_class):
+    """Show number of dead letters by class of error and the latest ones."""
+    counts = job_queue.count_dead_letters()
+    click.echo(', '.join(f'{name}: {number}' for name, number in sorted(counts.items())) or 'No dead letters.')
+    for letter in job_queue.dead_letters(limit, error_class):
+        failed_at = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(letter.failed_at))
+        click.echo(f'{failed_at} activity {letter.activity_id} of athlete {letter.athlete_id}, '
+                   f'{letter.attempts} attempts, {letter.error_class}: {letter.last_error}')
+
+
+@dead_letters_command.command('replay')
+@click.argument('activity_ids', nargs=-1, type=int)
+@click.option('--athlete', type=int, help='Replay activities of the athlete only.')
+@click.option('--error-class', help='Replay activities failed with this class of error only.')
+@with_appcontext
+def replay_dead_letters_command(activity_ids, athlete, error_class):
+    """Put dead letters (all or ACTIVITY_IDS) to the queue again."""
+    click.echo(f'Enqueued {job_queue.replay_dead_letters(activity_ids, athlete, error_class)} activities.')
@@ -0,0 +1,111 @@
+"""Rendering of weather and air quality descriptions. Function of rendering is made once for every
+combination of language and settings: phrases of language are put into its format strings, so a description
+is made without lookups of phrases and checks of settings. New language is added by register_language,
+code of rendering does not depend on languages.
+"""
+from collections import namedtuple
+
+Language = namedtuple('Language', 'feels_like kph wind_from air compass')
+
+LANGUAGES = {}
+COMPASS_SECTOR = 360 / 16
+# Air Quality Index: 1 = Good, 2 = Moderate, 3 = Unhealthy for sensitive, 4 = Unhealthy, 5 = Very Poor, 6 = Hazardous
+AQI_EMOJI = ('😃', '🙂', '😐', '🙁', '😨', '🤢')
+
+_weather_templates = {}  # (lan, humidity, wind) -> function of rendering
+_air_templates = {}  # lan -> function of rendering
+
+
+def register_language(code: str, feels_like: str, kph: str, wind_from: str, air: str, compass):
+    """Add language of descriptions.
+
+    :param code: code of language as in settings of athlete, e.g. 'en'
+    :param feels_like: phrase before apparent temperature
+    :param kph: unit of wind speed
+    :param wind_from: preposition before wind direction
+    :param air: word before air quality
+    :param compass: 16 names of wind directions clockwise from the north
+    """
+    if len(compass) != 16:
+        raise ValueError('Compass must have 16 directions')
+    # the last sector is the north again, so degrees from 348.75 to 360 need no modulo
+    LANGUAGES[code] = Language(feels_like, kph, wind_from, air, (*compass, compass[0]))
+    _weather_templates.clear()
+    _air_templates.clear()
+
+
+def compass_direction(degree: float, lan: str = 'en') -> str:
+    return LANGUAGES[lan].compass[int((degree % 360) / COMPASS_SECTOR + 0.5)]
+
+
+def _escape(phrase: str) -> str:
+    return phrase.replace('{', '{{').replace('}', '}}')
+
+
+def weather_template(lan: str, humidity: bool, wind: bool):
+    """Make function which makes description of weather in language with optional humidity and wind.
+
+    :return: function of dictionary with fields of hour weather (see weather_providers.Provider)
+    """
+    t = LANGUAGES[lan]
+    text = f'{{text}}, 🌡\xa0{{temp}}°C ({_escape(t.feels_like)} {{feels_like}}°C)'
+    if humidity:
+        text += ', 💦\xa0{humidity}%'
+    if wind:
+        text += f', 💨\xa0{{speed}}{_escape(t.kph)}'
+    calm = text + '.'
+    windy = text + f' ({_escape(t.wind_from)} {{direction}}).'
+    compass = t.compass
+
+    def render(w):
+        feels_like = format(w['feelslike_c'], '.0f')
+        fields = {'text': w['condition']['text'].capitalize(), 'temp': format(w['temp_c'], '.0f'),
+                  'feels_like': '0' if feels_like == '-0' else feels_like}
+        if humidity:
+            fields['humidity'] = w['humidity']
+        if not wind:
+            return text.format_map(fields)
+        fields['speed'] = format(w['wind_kph'], '.0f')
+        if fields['speed'] == '0':
+            return calm.format_map(fields)
+        fields['direction'] = compass[int((w['wind_degree'] % 360) / COMPASS_SECTOR + 0.5)]
+        return windy.format_map(fields)
+
+    return render
+
+
+def air_template(lan: str):
+    """Make function which makes description of air quality in language.
+
+    :return: function of dictionary with air quality (us-epa-index, pm2_5, so2, no2, o3, co)
+    """
+    text = (f'\n{_escape(LANGUAGES[lan].air)} {{aqi}} {{pm2_5:.1f}}(PM2.5), {{so2:.0f}}(SO₂), {{no2:.0f}}(NO₂), '
+            '{o3:.0f}(O₃), {co:.0f}(CO).')
+
+    def render(aq):
+        return text.format(aqi=AQI_EMOJI[aq['us-epa-index'] - 1], pm2_5=aq['pm2_5'], so2=aq['so2'], no2=aq['no2'],
+                           o3=aq['o3'], co=aq['co'])
+
+    return render
+
+
+def weather(w: dict, lan: str, humidity: bool = True, wind: bool = True) -> str:
+    """Description of weather, see weather_template."""
+    render = _weather_templates.get((lan, humidity, wind))
+    if render is None:
+        render = _weather_templates[lan, humidity, wind] = weather_template(lan, bool(humidity), bool(wind))
+    return render(w)
+
+
+def air(aq: dict, lan: str) -> str:
+    """Description of air quality, see air_template."""
+    render = _air_templates.get(lan)
+    if render is None:
+        render = _air_templates[lan] = air_template(lan)
+    return render(aq)
+
+
+register_language('ru', 'по ощущениям', 'км/ч', 'с', 'Воздух',
+                  ("С", "ССВ", "СВ", "ВСВ", "В", "ВЮВ", "ЮВ", "ЮЮВ", "Ю", "ЮЮЗ", "ЮЗ", "ЗЮЗ", "З", "ЗСЗ", "СЗ", "ССЗ"))
+register_language('en', 'feels like', 'kph', 'from', 'Air',
+                  ("N", "NNE", "NE", "ENE", "E", "ESE", "SE", "SSE", "S", "SSW", "SW", "WSW", "W", "WNW", "NW", "NNW"))
@@ -1,5 +1,23 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
 class StravaAPIError(Exception):
-    def __init__(self, message='Strava API error'):
+    """Failed request to Strava, status is HTTP status of response if Strava answered."""
+
+    def __init__(self, message='Strava API error', status: int = None):
         self.message = message
-        print('ERROR:', message)
+        self.status = status
+        logger.error(message)
         super().__init__(self.message)
+
+
+class RateLimitExceeded(StravaAPIError):
+    def __init__(self, retry_at: int):
+        self.retry_at = retry_at
+        super().__init__(f'Strava rate limit exceeded, retry at {retry_at}', status=429)
+
+
+class WeatherAPIError(Exception):
+    """No weather for activity, all providers failed."""
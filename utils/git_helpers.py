@@ -2,10 +2,10 @@ import hashlib
 import hmac
 import os
 
-import git
-
 
 def pull():  # pragma: no cover
+    import git  # GitPython is slow to import and it is needed for deploy only
+
     repo = git.Repo(os.getenv('APP_PATH'))
     repo.remotes.origin.pull()
 
@@ -0,0 +1,76 @@
+import os
+import threading
+import time
+import urllib.parse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from utils import metrics
+
+CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 3.05))
+READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 10))
+RETRIES = int(os.environ.get('HTTP_RETRIES', 3))
+BACKOFF_FACTOR = float(os.environ.get('HTTP_BACKOFF_FACTOR', 0.5))  # sleep 0.5, 1, 2... seconds between retries
+POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 10))
+# Hosts which get the most of requests have own pools of connections
+POOL_SIZES = {
+    'https://www.strava.com': int(os.environ.get('HTTP_STRAVA_POOL_SIZE', 20)),
+    'https://api.weatherapi.com': int(os.environ.get('HTTP_WEATHER_POOL_SIZE', 20)),
+}
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Strava responds 429 when the quota window is exhausted, there is no sense to retry it in a few seconds
+HOST_RETRY_STATUSES = {'https://www.strava.com': (500, 502, 503, 504)}
+
+LATENCY = metrics.histogram('http_request_duration_seconds', 'Latency of requests to external APIs by host')
+
+_session = None
+_session_pid = None
+_lock = threading.Lock()
+
+
+class PooledSession(requests.Session):
+    """Session with default timeouts which collects latencies of requests."""
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+        started = time.perf_counter()
+        try:
+            return super().request(method, url, **kwargs)
+        finally:
+            LATENCY.observe(time.perf_counter() - started, host=urllib.parse.urlsplit(url).hostname)
+
+
+def _make_adapter(pool_size: int, retry_statuses=RETRY_STATUSES) -> HTTPAdapter:
+    retry = Retry(total=RETRIES, backoff_factor=BACKOFF_FACTOR, status_forcelist=retry_statuses, raise_on_status=False)
+    # threads wait for a free connection instead of opening new ones which are discarded after the request
+    return HTTPAdapter(pool_connections=len(POOL_SIZES) + 1, pool_maxsize=pool_size, max_retries=retry, pool_block=True)
+
+
+def session() -> requests.Session:
+    """Return process-wide session, which keeps connections alive. New session is made in forked process,
+    because sockets of parent process can not be shared.
+    """
+    global _session, _session_pid
+    with _lock:
+        if _session is None or _session_pid != os.getpid():
+            _session = PooledSession()
+            _session.mount('https://', _make_adapter(POOL_SIZE))
+            _session.mount('http://', _make_adapter(POOL_SIZE))
+            for prefix, pool_size in POOL_SIZES.items():
+                _session.mount(prefix, _make_adapter(pool_size, HOST_RETRY_STATUSES.get(prefix, RETRY_STATUSES)))
+            _session_pid = os.getpid()
+        return _session
+
+
+def get(url, **kwargs) -> requests.Response:
+    return session().get(url, **kwargs)
+
+
+def post(url, **kwargs) -> requests.Response:
+    return session().post(url, **kwargs)
+
+
+def put(url, **kwargs) -> requests.Response:
+    return session().put(url, **kwargs)
@@ -0,0 +1,57 @@
+import json
+import os
+from collections import namedtuple
+
+from utils import job_queue, manage_db
+
+Event = namedtuple('Event', 'owner_id object_type object_id aspect_type updates')
+
+# Strava often sends "update" events right after "create", e.g. when the title is edited on the phone.
+# Processing of new activity is postponed to coalesce all these events in one job.
+COALESCE_WINDOW = int(os.environ.get('WEBHOOK_COALESCE_WINDOW', 10))
+
+
+def parse_event(record: dict) -> Event:
+    """Make Event from the payload of Strava webhook.
+
+    :raise ValueError: if some of the fields are missing or have wrong type
+    """
+    try:
+        return Event(int(record['owner_id']), str(record['object_type']), int(record['object_id']),
+                     str(record['aspect_type']), dict(record.get('updates') or {}))
+    except (KeyError, TypeError) as e:
+        raise ValueError(f'Bad webhook event {record}: {e!r}')
+
+
+def ingest(events) -> int:
+    """Turn webhook events to jobs. New activities are enqueued (already known ones are ignored),
+    pending jobs of deleted activities are cancelled, deauthorized athletes are removed.
+
+    :param events: list of named tuples Event
+    :return: number of new jobs
+    """
+    created, deleted, deauthorized = [], [], []
+    for event in events:
+        if event.object_type == 'activity' and event.aspect_type == 'create':
+            created.append((event.owner_id, event.object_id))
+        elif event.object_type == 'activity' and event.aspect_type == 'delete':
+            deleted.append(event.object_id)
+        if event.updates.get('authorized', '') == 'false':
+            deauthorized.append(event.owner_id)
+    new_jobs = job_queue.enqueue_many(created, COALESCE_WINDOW) if created else 0
+    if deleted:
+        job_queue.cancel(deleted)
+    for athlete_id in deauthorized:
+        job_queue.cancel(athlete_id=athlete_id)
+        manage_db.delete_athlete(athlete_id)
+    return new_jobs
+
+
+def read_events(file) -> list:
+    """Read events saved as JSON array or as one JSON object per line."""
+    content = file.read().strip()
+    if content.startswith('['):
+        records = json.loads(content)
+    else:
+        records = [json.loads(line) for line in content.splitlines() if line.strip()]
+    return [parse_event(record) for record in records]
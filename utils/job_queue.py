@@ -0,0 +1,373 @@
+import asyncio
+import contextlib
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+
+import requests
+
+from utils import ledger, manage_db, metrics, partitions, retry_policy, strava_client, weather
+from utils.exceptions import StravaAPIError
+
+Job = namedtuple('Job', 'id athlete_id activity_id attempts')
+DeadLetter = namedtuple('DeadLetter', 'activity_id athlete_id attempts error_class last_error failed_at')
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+JOB_TIMEOUT = 600  # running job is considered abandoned (worker died) after this time
+# Finished jobs keep repeated events of activity out of the queue, later the ledger does it (and dead letters
+# keep failed ones), so they are removed after this number of seconds
+JOB_RETENTION = int(os.environ.get('JOB_RETENTION', 7 * 24 * 3600))
+PRUNE_INTERVAL = 3600  # seconds between removals of old jobs by idle workers
+
+RETRIES = metrics.counter('job_retries_total', 'Number of failed attempts of jobs by class of error')
+logger = logging.getLogger(__name__)
+
+
+def enqueue(athlete_id: int, activity_id: int, delay: int = 0) -> bool:
+    """Put activity to the queue of jobs. Job will be processed by the worker pool.
+    Activity which is already in the queue (or was processed) is ignored.
+
+    :param athlete_id: Strava athlete ID
+    :param activity_id: Strava activity ID
+    :param delay: number of seconds to postpone processing
+    :return: True if new job was added
+    """
+    return enqueue_many([(athlete_id, activity_id)], delay) == 1
+
+
+def enqueue_many(activities, delay: int = 0) -> int:
+    """Put many activities to the queue in one transaction.
+
+    :param activities: iterable of pairs (athlete_id, activity_id)
+    :param delay: number of seconds to postpone processing
+    :return: number of new jobs
+    """
+    run_at = int(time.time()) + delay
+    db = manage_db.get_db()
+    cur = db.executemany('INSERT OR IGNORE INTO jobs (athlete_id, activity_id, status, run_at, partition) '
+                         'VALUES (?, ?, ?, ?, ?)',
+                         [(athlete_id, activity_id, PENDING, run_at, partitions.partition_of(athlete_id))
+                          for athlete_id, activity_id in activities])
+    db.commit()
+    return cur.rowcount
+
+
+def cancel(activity_ids=(), athlete_id: int = None) -> int:
+    """Remove pending jobs of deleted activities or of athlete who revoked access.
+
+    :param activity_ids: list of Strava activity IDs
+    :param athlete_id: Strava athlete ID
+    :return: number of removed jobs
+    """
+    db = manage_db.get_db()
+    cur = db.executemany('DELETE FROM jobs WHERE activity_id = ? AND status = ?',
+                         [(activity_id, PENDING) for activity_id in activity_ids])
+    removed = max(cur.rowcount, 0)
+    if athlete_id is not None:
+        removed += db.execute('DELETE FROM jobs WHERE athlete_id = ? AND status = ?', (athlete_id, PENDING)).rowcount
+    db.commit()
+    return removed
+
+
+def reprocess(activity_ids=(), athlete_id: int = None) -> int:
+    """Remove activities from the ledger of processed ones and put them to the queue again.
+
+    :param activity_ids: list of Strava activity IDs
+    :param athlete_id: Strava athlete ID, all processed activities of athlete are taken
+    :return: number of new jobs
+    """
+    entries = ledger.forget(activity_ids, athlete_id)
+    if not entries:
+        return 0
+    db = manage_db.get_db()
+    db.executemany('DELETE FROM jobs WHERE activity_id = ? AND status IN (?, ?)',
+                   [(activity_id, DONE, FAILED) for _, activity_id in entries])
+    db.commit()
+    return enqueue_many(entries)
+
+
+def claim(worker_id: str = None):
+    """Take the oldest job that is ready to run and mark it as running. Jobs abandoned by dead
+    workers are taken again after JOB_TIMEOUT.
+
+    :param worker_id: ID of partitioned worker, only jobs of partitions leased by it are taken
+    :return: named tuple Job or None if queue is empty
+    """
+    db = manage_db.get_db()
+    now = int(time.time())
+    query = ('SELECT id, athlete_id, activity_id, attempts FROM jobs '
+             'WHERE ((status = ? AND run_at <= ?) OR (status = ? AND locked_at < ?))')
+    params = [PENDING, now, RUNNING, now - JOB_TIMEOUT]
+    if worker_id is not None:
+        query += ' AND partition IN (SELECT partition FROM partition_leases WHERE worker_id = ? AND expires_at >= ?)'
+        params += [worker_id, now]
+    record = db.execute(query + ' ORDER BY run_at, id LIMIT 1;', params).fetchone()
+    if not record:
+        return
+    job = Job(*record)
+    cur = db.execute('UPDATE jobs SET status = ?, locked_at = ? WHERE id = ? AND (status = ? OR locked_at < ?);',
+                     (RUNNING, now, job.id, PENDING, now - JOB_TIMEOUT))
+    db.commit()
+    if cur.rowcount:
+        return job
+
+
+def complete(job: Job):
+    db = manage_db.get_db()
+    db.execute('UPDATE jobs SET status = ?, locked_at = NULL WHERE id = ?', (DONE, job.id))
+    db.commit()
+
+
+def retry(job: Job, error: str, policy: retry_policy.Policy = retry_policy.DEFAULT, delay: float = None):
+    """Schedule next attempt of the failed job with exponential backoff and jitter. After max_attempts
+    of the policy job is marked as failed and put to dead letters.
+
+    :param job: named tuple Job
+    :param error: description of the error
+    :param policy: named tuple retry_policy.Policy
+    :param delay: seconds before the next attempt instead of the delay of policy
+    """
+    attempts = job.attempts + 1
+    RETRIES.inc(error_class=policy.name)
+    if attempts >= policy.max_attempts:
+        return dead_letter(job._replace(attempts=attempts), policy.name, error)
+    run_at = int(time.time() + (retry_policy.delay(policy, job.attempts) if delay is None else delay))
+    db = manage_db.get_db()
+    db.execute('UPDATE jobs SET status = ?, attempts = ?, run_at = ?, locked_at = NULL, last_error = ? WHERE id = ?',
+               (PENDING, attempts, run_at, error, job.id))
+    db.commit()
+
+
+def dead_letter(job: Job, error_class: str, error: str):
+    """Mark the job as failed and save it in dead letters, so it can be replayed later.
+
+    :param job: named tuple Job with number of all attempts
+    :param error_class: name of retry policy
+    :param error: description of the last error
+    """
+    db = manage_db.get_db()
+    db.execute('UPDATE jobs SET status = ?, attempts = ?, locked_at = NULL, last_error = ? WHERE id = ?',
+               (FAILED, job.attempts, error, job.id))
+    db.execute('INSERT OR REPLACE INTO dead_letters VALUES (?, ?, ?, ?, ?, ?)',
+               (job.activity_id, job.athlete_id, job.attempts, error_class, error, int(time.time())))
+    db.commit()
+    logger.error('Activity ID=%s is put to dead letters after %s attempts: %s', job.activity_id, job.attempts, error)
+
+
+def dead_letters(limit: int = None, error_class: str = None) -> list:
+    """Return dead letters, the latest first.
+
+    :param limit: max number of records
+    :param error_class: name of retry policy, all records if None
+    :return: list of named tuples DeadLetter
+    """
+    db = manage_db.get_db()
+    rows = db.execute('SELECT * FROM dead_letters WHERE ? IS NULL OR error_class = ? ORDER BY failed_at DESC LIMIT ?',
+                      (error_class, error_class, -1 if limit is None else limit)).fetchall()
+    return [DeadLetter(*row) for row in rows]
+
+
+def count_dead_letters() -> dict:
+    """Number of dead letters by class of error."""
+    db = manage_db.get_db()
+    return dict(db.execute('SELECT error_class, COUNT(*) FROM dead_letters GROUP BY error_class').fetchall())
+
+
+def replay_dead_letters(activity_ids=(), athlete_id: int = None, error_class: str = None) -> int:
+    """Put dead letters to the queue again with zero attempts. All dead letters are replayed if there are no filters.
+
+    :param activity_ids: list of Strava activity IDs
+    :param athlete_id: Strava athlete ID
+    :param error_class: name of retry policy
+    :return: number of new jobs
+    """
+    letters = [letter for letter in dead_letters(error_class=error_class)
+               if (not activity_ids or letter.activity_id in activity_ids)
+               and (athlete_id is None or letter.athlete_id == athlete_id)]
+    if not letters:
+        return 0
+    db = manage_db.get_db()
+    db.executemany('DELETE FROM jobs WHERE activity_id = ? AND status = ?',
+                   [(letter.activity_id, FAILED) for letter in letters])
+    db.executemany('DELETE FROM dead_letters WHERE activity_id = ?', [(letter.activity_id,) for letter in letters])
+    db.commit()
+    return enqueue_many([(letter.athlete_id, letter.activity_id) for letter in letters])
+
+
+def defer(job: Job, run_at: int):
+    """Postpone the job without counting an attempt, e.g. until rate limit window is over."""
+    db = manage_db.get_db()
+    db.execute('UPDATE jobs SET status = ?, run_at = ?, locked_at = NULL WHERE id = ?', (PENDING, run_at, job.id))
+    db.commit()
+
+
+def prune(retention: int = JOB_RETENTION) -> int:
+    """Remove done and failed jobs scheduled more than retention seconds ago.
+
+    :return: number of removed jobs
+    """
+    db = manage_db.get_db()
+    cur = db.execute('DELETE FROM jobs WHERE status IN (?, ?) AND run_at < ?', (DONE, FAILED, int(time.time()) - retention))
+    db.commit()
+    return cur.rowcount
+
+
+def count(status: str = PENDING) -> int:
+    db = manage_db.get_db()
+    return db.execute('SELECT COUNT(*) FROM jobs WHERE status = ?', (status,)).fetchone()[0]
+
+
+def collect_metrics() -> list:
+    """Number of jobs by status for /metrics, pending ones are the depth of the queue."""
+    jobs = metrics.Gauge('jobs', 'Number of jobs in the queue by status')
+    for status in (PENDING, RUNNING, DONE, FAILED):
+        jobs.set(0, status=status)
+    db = manage_db.get_db()
+    for status, number in db.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status'):
+        jobs.set(number, status=status)
+    letters = metrics.Gauge('dead_letters', 'Number of activities failed permanently by class of error')
+    for error_class, number in count_dead_letters().items():
+        letters.set(number, error_class=error_class)
+    return [jobs, letters]
+
+
+metrics.COLLECTORS.append(collect_metrics)
+
+
+def claim_batch(size: int, worker_id: str = None) -> list:
+    jobs = []
+    while len(jobs) < size:
+        job = claim(worker_id)
+        if not job:
+            break
+        jobs.append(job)
+    return jobs
+
+
+def process_batch(jobs: list):
+    """Add weather to activities of the jobs concurrently in one event loop and record results in the queue.
+    Failed jobs are retried by the policy of error, see utils/retry_policy.py.
+    """
+    results = asyncio.run(weather.process_activities([(job.athlete_id, job.activity_id) for job in jobs]))
+    renewed = {}  # tokens are renewed once for all rejected jobs of athlete
+    for job, error in zip(jobs, results):
+        if error is None:
+            complete(job)
+            continue
+        policy = retry_policy.policy_for(error)
+        if policy is retry_policy.RATE_LIMITED:
+            defer(job, error.retry_at + int(retry_policy.delay(policy, 0)))
+            continue
+        logger.error('Job ID=%s for activity ID=%s failed: %r', job.id, job.activity_id, error)
+        if policy is retry_policy.UNAUTHORIZED:
+            if job.athlete_id not in renewed:
+                renewed[job.athlete_id] = renew_tokens(job.athlete_id)
+            renewal_error = renewed[job.athlete_id]
+            if isinstance(renewal_error, StravaAPIError) and strava_client.access_revoked(renewal_error):
+                dead_letter(job._replace(attempts=job.attempts + 1), policy.name, repr(error))
+                continue
+            if renewal_error is not None:  # e.g. OAuth server is not available, tokens are renewed on next attempt
+                error, policy = renewal_error, retry_policy.policy_for(renewal_error)
+        retry(job, repr(error), policy)
+
+
+def renew_tokens(athlete_id: int):
+    """Refresh tokens rejected by Strava.
+
+    :return: None if tokens are renewed, otherwise the error of refresh
+    """
+    try:
+        strava_client.renew_tokens(athlete_id)
+    except (StravaAPIError, requests.RequestException) as e:
+        return e
+
+
+class WorkerPool:
+    """Fixed number of threads draining the queue of jobs. Every thread takes up to batch_size jobs
+    at once and processes them concurrently. Threads are started lazily, so an application that
+    never receives activities does not spawn them. When the queue is empty, a worker calls on_idle
+    (if it is given) to produce low priority jobs, e.g. backfill of old activities. Without Flask
+    application (app is None) the database configured by manage_db.configure is used.
+    With membership (see utils/partitions.py) the pool takes jobs of its partitions only.
+    """
+
+    def __init__(self, app, size: int = 2, batch_size: int = 10, poll_interval: float = 5, on_idle=None,
+                 membership=None):
+        self.app = app
+        self.size = size
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.on_idle = on_idle
+        self.membership = membership
+        self._pruned_at = 0.0
+        self._threads = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return any(thread.is_alive() for thread in self._threads)
+
+    def start(self):
+        with self._lock:
+            if self.running or self.size < 1:
+                return
+            self._stopped.clear()
+            self._threads = [threading.Thread(target=self._run, name=f'worker-{i}', daemon=True)
+                             for i in range(self.size)]
+            for thread in self._threads:
+                thread.start()
+
+    def notify(self):
+        """Wake up idle workers because there is a new job in the queue."""
+        self.start()
+        self._wakeup.set()
+
+    def stop(self, timeout: float = None):
+        """Let workers finish current jobs and stop them.
+
+        :param timeout: max number of seconds to wait for all threads, jobs which are not finished
+            by then are taken by other workers after JOB_TIMEOUT
+        """
+        self._stopped.set()
+        self._wakeup.set()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(None if deadline is None else max(deadline - time.monotonic(), 0))
+        if self.membership and self._threads:
+            with self.app.app_context() if self.app else contextlib.nullcontext():
+                self.membership.leave()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                if self._work():
+                    continue
+            except Exception:
+                # e.g. database is locked, the thread keeps working, jobs in progress are retaken after JOB_TIMEOUT
+                logger.exception('Worker failed.')
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    def _work(self) -> bool:
+        """Process one batch of jobs or call on_idle. Return True if there may be more work at once."""
+        with self.app.app_context() if self.app else contextlib.nullcontext():
+            worker_id = None
+            if self.membership:
+                self.membership.keep_alive()
+                worker_id = self.membership.worker_id
+            jobs = claim_batch(self.batch_size, worker_id)
+            if jobs:
+                process_batch(jobs)
+                return True
+            if time.monotonic() - self._pruned_at > PRUNE_INTERVAL:
+                self._pruned_at = time.monotonic()
+                prune()
+            return bool(self.on_idle and self.on_idle())
@@ -0,0 +1,71 @@
+import json
+import time
+from collections import namedtuple
+
+from utils import manage_db
+
+Entry = namedtuple('Entry', 'activity_id athlete_id status started_at finished_at payload')
+
+DONE = 'done'  # weather was added to activity
+SKIPPED = 'skipped'  # activity is manual, indoor, without coordinates or already has weather
+
+
+def is_processed(activity_id: int) -> bool:
+    """Check if activity was already processed, it is one lookup by primary key."""
+    db = manage_db.get_db()
+    return db.execute('SELECT 1 FROM ledger WHERE activity_id = ?', (activity_id,)).fetchone() is not None
+
+
+def record(athlete_id: int, activity_id: int, status: str, started_at: float, payload: dict = None):
+    """Save result of processing of activity.
+
+    :param athlete_id: Strava athlete ID
+    :param activity_id: Strava activity ID
+    :param status: DONE or SKIPPED
+    :param started_at: Unix time when processing was started
+    :param payload: data written to activity
+    """
+    db = manage_db.get_db()
+    db.execute('INSERT OR REPLACE INTO ledger VALUES (?, ?, ?, ?, ?, ?)',
+               (activity_id, athlete_id, status, started_at, time.time(),
+                None if payload is None else json.dumps(payload, ensure_ascii=False)))
+    db.commit()
+
+
+def get(activity_id: int):
+    """Return named tuple Entry or None if activity was not processed."""
+    db = manage_db.get_db()
+    row = db.execute('SELECT * FROM ledger WHERE activity_id = ?', (activity_id,)).fetchone()
+    if row:
+        entry = Entry(*row)
+        return entry._replace(payload=entry.payload and json.loads(entry.payload))
+
+
+def stats(since: float = 0) -> dict:
+    """Count processed activities and average time of processing by status.
+
+    :param since: Unix time, only activities processed after it are counted
+    :return: dictionary status -> {'count': int, 'avg_seconds': float}
+    """
+    db = manage_db.get_db()
+    rows = db.execute('SELECT status, COUNT(*), AVG(finished_at - started_at) FROM ledger '
+                      'WHERE finished_at >= ? GROUP BY status', (since,)).fetchall()
+    return {status: {'count': number, 'avg_seconds': avg} for status, number, avg in rows}
+
+
+def forget(activity_ids=(), athlete_id: int = None) -> list:
+    """Remove records of activities, so they can be processed again.
+
+    :param activity_ids: list of Strava activity IDs
+    :param athlete_id: Strava athlete ID, all activities of athlete are removed
+    :return: list of pairs (athlete_id, activity_id) of removed records
+    """
+    db = manage_db.get_db()
+    entries = db.execute('SELECT athlete_id, activity_id FROM ledger WHERE athlete_id = ?', (athlete_id,)).fetchall()
+    for activity_id in activity_ids:
+        entries += db.execute('SELECT athlete_id, activity_id FROM ledger WHERE activity_id = ?',
+                              (activity_id,)).fetchall()
+    entries = [tuple(entry) for entry in entries]
+    db.executemany('DELETE FROM ledger WHERE activity_id = ?', [(activity_id,) for _, activity_id in entries])
+    db.commit()
+    return entries
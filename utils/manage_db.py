@@ -1,43 +1,313 @@
+import os
 import sqlite3
+import sys
+import threading
+import time
+from abc import ABC, abstractmethod
 from collections import namedtuple
 
-import click
-from flask import current_app, g
-from flask.cli import with_appcontext
+from utils import cache
 
 Tokens = namedtuple('Tokens', 'id access_token refresh_token expires_at')
 Settings = namedtuple('Settings', 'id icon hum wind aqi lan')
 DEFAULT_SETTINGS = Settings(0, 0, 1, 1, 1, 'ru')
+# Directory of application with SQL scripts
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# WAL journal lets readers work concurrently with a writer, busy_timeout makes writers wait for each other
+# instead of failing with "database is locked". Negative cache_size is in KiB.
+PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA busy_timeout = 5000',
+    'PRAGMA cache_size = -8000',
+    'PRAGMA temp_store = MEMORY',
+)
+CACHED_STATEMENTS = 256
+
+# Tokens and settings are read for every activity, so they are kept in memory. Writes of this process update
+# the caches, writes of other processes (workers) are detected by the generation counter, which is incremented
+# by triggers of tables subscribers and settings and checked not more often than INVALIDATION_INTERVAL seconds.
+# Triggers log IDs of changed athletes, so only their records are evicted from the caches.
+ATHLETE_CACHE_SIZE = int(os.environ.get('ATHLETE_CACHE_SIZE', 10000))
+INVALIDATION_INTERVAL = float(os.environ.get('ATHLETE_CACHE_INVALIDATION_INTERVAL', 1))
+TOKENS_CACHE = cache.create('tokens', maxsize=ATHLETE_CACHE_SIZE)
+SETTINGS_CACHE = cache.create('settings', maxsize=ATHLETE_CACHE_SIZE)
+SUBSCRIBERS_COUNT_TTL = float(os.environ.get('SUBSCRIBERS_COUNT_TTL', 60))
+SUBSCRIBERS_COUNT_CACHE = cache.create('subscribers_count', maxsize=1, ttl=SUBSCRIBERS_COUNT_TTL)
+
+_database = None  # path to database for use outside of application context, it is set by init_app
+_local = threading.local()
+_generation = {'value': None, 'checked_at': 0.0}
+_generation_lock = threading.Lock()
+
+
+def connect(path) -> sqlite3.Connection:
+    db = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES, cached_statements=CACHED_STATEMENTS)
+    db.row_factory = sqlite3.Row
+    for pragma in PRAGMAS:
+        db.execute(pragma)
+    return db
+
+
+def app_config():
+    """Return config of the current Flask application or None outside of application context.
+    Flask is not imported here, so workers started without web application do not load it.
+    """
+    flask = sys.modules.get('flask')
+    if flask is not None and flask.has_app_context():
+        return flask.current_app.config
 
 
 def get_db():
-    if 'db' not in g:
-        g.db = sqlite3.connect(current_app.config['DATABASE'], detect_types=sqlite3.PARSE_DECLTYPES)
-        g.db.row_factory = sqlite3.Row
-    return g.db
+    """Return connection to database for the current thread. Connections are kept open between requests
+    and jobs, so prepared statements are reused. Database is taken from config of current application
+    or from the application passed to init_app if there is no application context.
+
+    :return: sqlite3.Connection
+    """
+    config = app_config()
+    path = config['DATABASE'] if config else _database
+    if getattr(_local, 'pid', None) != os.getpid():
+        # connections of parent process must not be used after fork
+        _local.pid = os.getpid()
+        _local.connections = {}
+    db = _local.connections.get(path)
+    if db is None:
+        db = _local.connections[path] = connect(path)
+    return db
+
+
+class Storage(ABC):
+    """Interface of storage of athletes' tokens and settings. Functions of this module cache records
+    in memory and delegate to the storage selected by STORAGE_BACKEND in config of application.
+    """
+
+    @abstractmethod
+    def get_athlete(self, athlete_id: int):
+        """Return named tuple Tokens or None if athlete is not subscribed."""
+
+    @abstractmethod
+    def get_expiring_athletes(self, before: int) -> list:
+        """Return list of Tokens with access tokens expiring before the given Unix time, ordered by expires_at."""
+
+    @abstractmethod
+    def add_athletes(self, tokens_list):
+        """Insert or update tokens of many athletes in one transaction, unchanged records are not written."""
+
+    @abstractmethod
+    def add_settings(self, settings: Settings):
+        """Insert or update settings, default settings of new athlete are not stored."""
+
+    @abstractmethod
+    def get_settings(self, athlete_id: int):
+        """Return named tuple Settings or None if athlete has default settings."""
+
+    @abstractmethod
+    def get_subscribers_count(self) -> int:
+        """Return number of subscribed athletes."""
+
+    @abstractmethod
+    def delete_athlete(self, athlete_id: int):
+        """Remove tokens and settings of athlete."""
+
+    @abstractmethod
+    def generation(self):
+        """Return counter of changes of tokens and settings, None if it is not supported."""
+
+    @abstractmethod
+    def changes(self, after: int) -> list:
+        """Return list of pairs (generation, athlete ID) of changes made after the given generation,
+        ordered by generation. Old changes are pruned, so the list may start later than after + 1.
+        """
+
+    @abstractmethod
+    def init_db(self):
+        """Create tables of storage if they do not exist."""
+
+
+# Upserts write a record in one statement and do not touch the row (and do not fire triggers) if nothing is changed
+UPSERT_ATHLETE = (
+    'INSERT INTO subscribers VALUES(?, ?, ?, ?) ON CONFLICT(id) DO UPDATE SET '
+    'access_token = excluded.access_token, refresh_token = excluded.refresh_token, expires_at = excluded.expires_at '
+    'WHERE (access_token, refresh_token, expires_at) IS NOT '
+    '(excluded.access_token, excluded.refresh_token, excluded.expires_at);'
+)
+UPSERT_SETTINGS = (
+    'INSERT INTO settings VALUES(?, ?, ?, ?, ?, ?) ON CONFLICT(id) DO UPDATE SET '
+    'icon = excluded.icon, humidity = excluded.humidity, wind = excluded.wind, aqi = excluded.aqi, lan = excluded.lan '
+    'WHERE (icon, humidity, wind, aqi, lan) IS NOT '
+    '(excluded.icon, excluded.humidity, excluded.wind, excluded.aqi, excluded.lan);'
+)
+# Default settings are not stored for new athletes, so existing record is only updated
+UPDATE_SETTINGS = (
+    'UPDATE settings SET icon = ?, humidity = ?, wind = ?, aqi = ?, lan = ? '
+    'WHERE id = ? AND (icon, humidity, wind, aqi, lan) IS NOT (?, ?, ?, ?, ?);'
+)
+
+
+class SQLiteStorage(Storage):
+    """Storage in SQLite database of application, see get_db."""
+
+    def get_athlete(self, athlete_id: int):
+        record_db = get_db().execute('SELECT * FROM subscribers WHERE id = ?', (athlete_id,)).fetchone()
+        if record_db:
+            return Tokens(*record_db)
+
+    def get_expiring_athletes(self, before: int) -> list:
+        db = get_db()
+        records = db.execute('SELECT * FROM subscribers WHERE expires_at < ? ORDER BY expires_at', (before,))
+        return [Tokens(*record) for record in records.fetchall()]
+
+    def add_athletes(self, tokens_list):
+        db = get_db()
+        db.executemany(UPSERT_ATHLETE, tokens_list)
+        db.commit()
+
+    def add_settings(self, settings: Settings):
+        db = get_db()
+        if settings[1:] == DEFAULT_SETTINGS[1:]:
+            db.execute(UPDATE_SETTINGS, (*settings[1:], settings.id, *settings[1:]))
+        else:
+            db.execute(UPSERT_SETTINGS, settings)
+        db.commit()
+
+    def get_settings(self, athlete_id: int):
+        sel = get_db().execute('SELECT * FROM settings WHERE id = ?;', (athlete_id,)).fetchone()
+        if sel:
+            return Settings(*sel)
+
+    def get_subscribers_count(self) -> int:
+        db = get_db()
+        record = db.execute("SELECT value FROM counters WHERE name = 'subscribers'").fetchone()
+        if record is None:  # counter is not initialized
+            record = db.execute('SELECT COUNT(*) FROM subscribers').fetchone()
+        return record[0]
+
+    def delete_athlete(self, athlete_id: int):
+        db = get_db()
+        cur = db.cursor()
+        cur.execute('DELETE FROM subscribers WHERE id = ?', (athlete_id,))
+        cur.execute('DELETE FROM settings WHERE id = ?', (athlete_id,))
+        db.commit()
+
+    def generation(self):
+        record = get_db().execute("SELECT value FROM generations WHERE name = 'athletes'").fetchone()
+        return record[0] if record else None
+
+    def changes(self, after: int) -> list:
+        return get_db().execute('SELECT generation, athlete_id FROM athlete_changes WHERE generation > ? '
+                                'ORDER BY generation', (after,)).fetchall()
+
+    def init_db(self):
+        db = get_db()
+        columns = [row[1] for row in db.execute('PRAGMA table_info(jobs)')]
+        if columns and 'partition' not in columns:
+            # queue made by previous version, its jobs are put to partitions of athletes
+            from utils.partitions import PARTITIONS
+            db.execute('ALTER TABLE jobs ADD COLUMN partition integer NOT NULL DEFAULT 0')
+            db.execute('UPDATE jobs SET partition = athlete_id % ?', (PARTITIONS,))
+            db.commit()
+        with open(os.path.join(ROOT_PATH, 'sql_db.sql'), encoding='utf8') as f:
+            db.executescript(f.read())
+
+
+_storage = SQLiteStorage()
+
+
+def make_storage(config) -> Storage:
+    """Create storage selected by STORAGE_BACKEND: 'sqlite' (default) or 'postgres' with DSN in DATABASE_URL."""
+    backend = config.get('STORAGE_BACKEND') or 'sqlite'
+    if backend == 'sqlite':
+        return SQLiteStorage()
+    if backend == 'postgres':
+        from utils.pg_storage import PostgresStorage
+        return PostgresStorage(config['DATABASE_URL'])
+    raise ValueError(f'Unknown storage backend {backend!r}')
+
+
+def get_storage() -> Storage:
+    return _storage
+
+
+def changed_athletes(after):
+    """Find athletes changed after the given generation.
+
+    :param after: generation of the last check or None
+    :return: tuple (generation, set of athlete IDs), athletes are None if all of them must be dropped from caches:
+        on the first check, if changes are not supported or if some of them were pruned
+    """
+    storage = get_storage()
+    if after is None:
+        return storage.generation(), None
+    changes = storage.changes(after)
+    if not changes:
+        return after, set()
+    if changes[0][0] > after + 1:
+        return changes[-1][0], None
+    return changes[-1][0], {athlete_id for _, athlete_id in changes}
+
+
+def check_generation():
+    """Evict tokens and settings of athletes changed by other processes from the caches. Storage is
+    queried not more often than INVALIDATION_INTERVAL seconds.
+    """
+    now = time.monotonic()
+    if now - _generation['checked_at'] < INVALIDATION_INTERVAL:
+        return
+    with _generation_lock:
+        if now - _generation['checked_at'] < INVALIDATION_INTERVAL:
+            return
+        try:
+            value, athletes = changed_athletes(_generation['value'])
+        except sqlite3.OperationalError:  # database is not initialized yet
+            value, athletes = None, None
+        if athletes is None:
+            TOKENS_CACHE.clear()
+            SETTINGS_CACHE.clear()
+        for athlete_id in athletes or ():
+            TOKENS_CACHE.delete(athlete_id)
+            SETTINGS_CACHE.delete(athlete_id)
+        _generation['value'] = value
+        _generation['checked_at'] = now
 
 
 def get_athlete(athlete_id: int):
-    db = get_db()
-    cur = db.cursor()
-    record_db = cur.execute('SELECT * FROM subscribers WHERE id = ?', (athlete_id,)).fetchone()
-    if record_db:
-        return Tokens(*record_db)
+    check_generation()
+    tokens = TOKENS_CACHE.get(athlete_id)
+    if tokens is not None:
+        return tokens
+    tokens = get_storage().get_athlete(athlete_id)
+    if tokens:
+        TOKENS_CACHE.set(athlete_id, tokens)
+        return tokens
+
+
+def get_expiring_athletes(before: int) -> list:
+    """Find athletes whose access tokens expire before the given time.
+
+    :param before: Unix time
+    :return: list of named tuples Tokens
+    """
+    return get_storage().get_expiring_athletes(before)
 
 
 def add_athlete(tokens: Tokens):
-    tokens_db = get_athlete(tokens.id)
-    db = get_db()
-    cur = db.cursor()
-    if not tokens_db:
-        sql = 'INSERT INTO subscribers VALUES(?, ?, ?, ?)'
-        cur.execute(sql, tokens)
-    elif tokens.access_token != tokens_db.access_token:
-        sql = f'UPDATE subscribers SET access_token = ?, refresh_token = ?, expires_at = ? WHERE id = {tokens.id};'
-        cur.execute(sql, tokens[1:])
-    else:
+    add_athletes([tokens])
+
+
+def add_athletes(tokens_list):
+    """Write tokens of many athletes in one transaction, e.g. after refresh of expiring tokens.
+
+    :param tokens_list: list of named tuples Tokens
+    """
+    check_generation()
+    changed = [tokens for tokens in tokens_list if TOKENS_CACHE.get(tokens.id) != tokens]
+    if not changed:
         return
-    db.commit()
+    get_storage().add_athletes(changed)
+    for tokens in changed:
+        TOKENS_CACHE.set(tokens.id, tokens)
 
 
 def add_settings(settings: Settings):
@@ -45,19 +315,11 @@ def add_settings(settings: Settings):
 
     :param settings: named tuple Settings
     """
-    db = get_db()
-    cur = db.cursor()
-    settings_db = cur.execute('SELECT * FROM settings WHERE id = ?', (settings.id,)).fetchone()
-    if settings_db:
-        if settings == Settings(*settings_db):
-            return
-        sql = f'UPDATE settings SET icon = ?, humidity = ?, wind = ?, aqi = ?, lan = ? WHERE id = {settings.id};'
-        cur.execute(sql, settings[1:])
-    else:
-        if settings[1:] == DEFAULT_SETTINGS[1:]:
-            return
-        cur.execute('INSERT INTO settings VALUES(?, ?, ?, ?, ?, ?)', settings)
-    db.commit()
+    check_generation()
+    if SETTINGS_CACHE.get(settings.id) == settings:
+        return
+    get_storage().add_settings(settings)
+    SETTINGS_CACHE.set(settings.id, settings)
 
 
 def get_settings(athlete_id: int):
@@ -67,22 +329,19 @@ def get_settings(athlete_id: int):
     :param athlete_id: integer Strava athlete id
     :return: named tuple Settings
     """
-    db = get_db()
-    cur = db.cursor()
-    sel = cur.execute('SELECT * FROM settings WHERE id = ?;', (athlete_id,)).fetchone()
-    if sel:
-        return Settings(*sel)
-    else:
-        return DEFAULT_SETTINGS._replace(id=athlete_id)
+    check_generation()
+    settings = SETTINGS_CACHE.get(athlete_id)
+    if settings is not None:
+        return settings
+    settings = get_storage().get_settings(athlete_id) or DEFAULT_SETTINGS._replace(id=athlete_id)
+    SETTINGS_CACHE.set(athlete_id, settings)
+    return settings
 
 
 def get_subscribers_count():
-    """Count total count of application users
+    """Count total count of application users. Value is cached for SUBSCRIBERS_COUNT_TTL seconds.
     """
-    db = get_db()
-    cur = db.cursor()
-    result = cur.execute('SELECT COUNT(*) FROM subscribers').fetchone()
-    return result[0]
+    return SUBSCRIBERS_COUNT_CACHE.get_or_set('count', get_storage().get_subscribers_count)
 
 
 def delete_athlete(athlete_id: int):
@@ -90,43 +349,36 @@ def delete_athlete(athlete_id: int):
 
     :param athlete_id: Strava athlete id
     """
-    db = get_db()
-    cur = db.cursor()
-    cur.execute('DELETE FROM subscribers WHERE id = ?', (athlete_id,))
-    cur.execute('DELETE FROM settings WHERE id = ?', (athlete_id,))
-    db.commit()
-
-
-def init_app(app):
-    app.teardown_appcontext(close_db)
-    app.cli.add_command(init_db_command)
+    get_storage().delete_athlete(athlete_id)
+    TOKENS_CACHE.delete(athlete_id)
+    SETTINGS_CACHE.delete(athlete_id)
 
 
-def init_db():
-    """Initial function for database creation."""
-    db = get_db()
-    with current_app.open_resource('sql_db.sql') as f:
-        db.executescript(f.read().decode('utf8'))
+def configure(config):
+    """Select database and storage by settings DATABASE, STORAGE_BACKEND and DATABASE_URL.
 
+    :param config: mapping of settings, e.g. config of Flask application
+    """
+    global _database, _storage
+    _database = config['DATABASE']
+    _storage = make_storage(config)
 
-def close_db(e=None):
-    db = g.pop('db', None)
-    if db is not None:
-        db.close()
 
+def init_app(app):
+    configure(app.config)
 
-@click.command('init-db')
-@with_appcontext
-def init_db_command():
-    """Clear existing database and create new table."""
-    init_db()
-    click.echo('Initialized database.')
 
+def init_db():
+    """Initial function for database creation. SQLite database is always created, because it keeps
+    the queue of jobs, other storage creates own tables.
+    """
+    SQLiteStorage().init_db()
+    if not isinstance(get_storage(), SQLiteStorage):
+        get_storage().init_db()
 
-if __name__ == '__main__':  # pragma: no cover
-    import os
-    from dotenv import load_dotenv
 
-    dotenv_path = os.path.join(os.path.dirname(__file__), '../.env')
-    if os.path.exists(dotenv_path):
-        load_dotenv(dotenv_path)
+def close_db():
+    """Close all connections of the current thread."""
+    for db in getattr(_local, 'connections', {}).values():
+        db.close()
+    _local.connections = {}
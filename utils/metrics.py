@@ -0,0 +1,291 @@
+import atexit
+import bisect
+import fcntl
+import glob
+import json
+import os
+import threading
+import time
+import uuid
+
+METRICS = {}  # all metrics of the application, by name
+COLLECTORS = []  # functions which return metrics computed at the moment of scraping, e.g. size of queue
+PROCESS_COLLECTORS = []  # functions which return metrics of the current process, e.g. statistics of its caches
+# Every process of application (gunicorn workers, python -m utils.worker) saves own metrics to the file
+# process-<pid>-<random ID>.json in this directory, and /metrics returns their sum, so it does not depend
+# on the process which answers. Counters and histograms of finished processes are added to FINISHED_FILE and
+# their files are removed, gauges are returned with label pid for live processes only.
+METRICS_DIR = os.environ.get('METRICS_DIR')
+FINISHED_FILE = 'finished.json'
+DUMP_INTERVAL = float(os.environ.get('METRICS_DUMP_INTERVAL', 5))
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+
+class Counter:
+    """Value which only goes up (e.g. number of processed activities) split by labels."""
+    type = 'counter'
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self._values)
+
+    def merge(self, values: dict):
+        """Add snapshot of counter of another process."""
+        for key, value in values.items():
+            self.inc(value, **dict(key))
+
+
+def counter(name: str, description: str) -> Counter:
+    if name not in METRICS:
+        METRICS[name] = Counter(name, description)
+    return METRICS[name]
+
+
+class Histogram:
+    """Distribution of observed values (e.g. latencies in seconds) split by labels."""
+    type = 'histogram'
+
+    def __init__(self, name: str, description: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts, total, count = self._values.get(key, ([0] * len(self.buckets), 0, 0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    def snapshot(self) -> dict:
+        """Return dictionary where key is tuple of label pairs and value is tuple
+        of (counts per bucket, sum of values, count of values).
+        """
+        with self._lock:
+            return {key: (list(counts), total, count) for key, (counts, total, count) in self._values.items()}
+
+    def merge(self, values: dict):
+        """Add snapshot of histogram of another process."""
+        with self._lock:
+            for key, (counts, total, count) in values.items():
+                before, before_total, before_count = self._values.get(key, ([0] * len(self.buckets), 0, 0))
+                self._values[key] = ([a + b for a, b in zip(before, counts)], before_total + total, before_count + count)
+
+
+def histogram(name: str, description: str, buckets=DEFAULT_BUCKETS) -> Histogram:
+    if name not in METRICS:
+        METRICS[name] = Histogram(name, description, buckets)
+    return METRICS[name]
+
+
+class Gauge:
+    """Value which can go up and down (e.g. size of queue) split by labels."""
+    type = 'gauge'
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self._values = {}
+
+    def set(self, value: float, **labels):
+        self._values[tuple(sorted(labels.items()))] = value
+
+    def snapshot(self) -> dict:
+        return dict(self._values)
+
+
+def gauge(name: str, description: str) -> Gauge:
+    if name not in METRICS:
+        METRICS[name] = Gauge(name, description)
+    return METRICS[name]
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _labels(key, **extra) -> str:
+    pairs = [*key, *extra.items()]
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}' if pairs else ''
+
+
+def _number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def process_metrics() -> list:
+    """Metrics of the current process."""
+    metrics = list(METRICS.values())
+    for collect in PROCESS_COLLECTORS:
+        metrics.extend(collect())
+    return metrics
+
+
+_process = {'pid': None, 'id': None}
+
+
+def process_id() -> str:
+    """Unique ID of the current process, PID of finished process may be taken by a new one."""
+    if _process['pid'] != os.getpid():
+        _process.update(pid=os.getpid(), id=f'{os.getpid()}-{uuid.uuid4().hex[:8]}')
+    return _process['id']
+
+
+def _serialize(metrics) -> dict:
+    return {metric.name: {'type': metric.type, 'description': metric.description,
+                          'buckets': getattr(metric, 'buckets', None),
+                          'values': [[key, value] for key, value in metric.snapshot().items()]}
+            for metric in metrics}
+
+
+def _save(path: str, data: dict):
+    with open(path + '.tmp', 'w', encoding='utf8') as f:
+        json.dump(data, f)
+    os.replace(path + '.tmp', path)
+
+
+def _load(path: str):
+    try:
+        with open(path, encoding='utf8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return
+
+
+def _merge(merged: dict, data: dict, **labels):
+    """Add metrics saved by dump to dictionary of metrics by name. Gauges are added only with labels."""
+    for name, record in data.items():
+        values = {tuple(map(tuple, key)): value for key, value in record['values']}
+        if record['type'] == 'counter':
+            merged.setdefault(name, Counter(name, record['description'])).merge(values)
+        elif record['type'] == 'histogram':
+            merged.setdefault(name, Histogram(name, record['description'], record['buckets'])).merge(values)
+        elif labels:
+            gauge = merged.setdefault(name, Gauge(name, record['description']))
+            for key, value in values.items():
+                gauge.set(value, **dict(key), **labels)
+
+
+def dump():
+    """Save metrics of the current process to METRICS_DIR."""
+    _save(os.path.join(METRICS_DIR, f'process-{process_id()}.json'), _serialize(process_metrics()))
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _process_files() -> dict:
+    """Return dictionary process ID -> (PID, path to file with its metrics)."""
+    files = {}
+    for path in sorted(glob.glob(os.path.join(METRICS_DIR, 'process-*.json'))):
+        process = os.path.basename(path)[len('process-'):-len('.json')]
+        files[process] = (int(process.split('-')[0]), path)
+    return files
+
+
+def fold():
+    """Add counters and histograms of finished processes to FINISHED_FILE and remove their files, so the number
+    of files does not grow when workers are restarted. IDs of folded processes are kept until their files are
+    removed, so metrics are not added twice if removal fails. It must be called under the lock of METRICS_DIR.
+    """
+    files = _process_files()
+    dead = {process: path for process, (pid, path) in files.items() if not _alive(pid)}
+    if not dead:
+        return
+    path = os.path.join(METRICS_DIR, FINISHED_FILE)
+    finished = _load(path) or {'folded': [], 'metrics': {}}
+    folded = set(finished['folded']) & set(files)
+    new = [process for process in dead if process not in folded]
+    if new:
+        merged = {}
+        _merge(merged, finished['metrics'])
+        for process in new:
+            _merge(merged, _load(dead[process]) or {})
+        _save(path, {'folded': sorted(folded | set(new)), 'metrics': _serialize(merged.values())})
+    for process_path in dead.values():
+        os.remove(process_path)
+
+
+def merged_metrics() -> list:
+    """Sum of metrics of all processes saved in METRICS_DIR, metrics of the current process are saved first."""
+    dump()
+    merged = {}
+    with open(os.path.join(METRICS_DIR, 'metrics.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)  # other processes may fold the same files
+        fold()
+        _merge(merged, (_load(os.path.join(METRICS_DIR, FINISHED_FILE)) or {}).get('metrics', {}))
+        for pid, path in _process_files().values():
+            _merge(merged, _load(path) or {}, **({'pid': pid} if _alive(pid) else {}))
+    return list(merged.values())
+
+
+def start_dumping(interval: float = DUMP_INTERVAL):
+    """Save metrics of the current process to METRICS_DIR every interval seconds and at exit.
+    It does nothing if METRICS_DIR is not set.
+    """
+    if not METRICS_DIR:
+        return
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                dump()
+            except OSError:
+                continue  # e.g. disk is full, metrics are saved on the next attempt
+
+    threading.Thread(target=run, name='metrics-dump', daemon=True).start()
+    atexit.register(dump)
+
+
+def clear_dir():
+    """Remove metrics of processes of previous run, e.g. when gunicorn is started."""
+    if METRICS_DIR:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        for path in glob.glob(os.path.join(METRICS_DIR, '*.json')):
+            os.remove(path)
+
+
+def render() -> str:
+    """Return all metrics and metrics of collectors in the text format of Prometheus."""
+    metrics = merged_metrics() if METRICS_DIR else process_metrics()
+    for collect in COLLECTORS:
+        metrics.extend(collect())
+    lines = []
+    for metric in metrics:
+        lines.append(f'# HELP {metric.name} {metric.description}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        for key, value in sorted(metric.snapshot().items()):
+            if metric.type != 'histogram':
+                lines.append(f'{metric.name}{_labels(key)} {_number(value)}')
+                continue
+            counts, total, count = value
+            cumulative = 0
+            for bucket, bucket_count in zip(metric.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{metric.name}_bucket{_labels(key, le=_number(bucket))} {cumulative}')
+            lines.append(f'{metric.name}_sum{_labels(key)} {_number(total)}')
+            lines.append(f'{metric.name}_count{_labels(key)} {count}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,169 @@
+"""Partitioned mode of workers: athletes are split into fixed number of partitions by owner_id and every
+partition is processed by one worker (thread pool of one process) at a time. The worker keeps the tokens
+and settings of its athletes in memory and is the only one which refreshes their tokens, so workers
+do not compete for the same athletes.
+
+Workers register themselves in the table workers and renew the record every HEARTBEAT_INTERVAL seconds.
+Partitions are assigned to live workers by rendezvous hashing, every worker computes the same assignment
+from the list of workers, and takes leases of its partitions. Lease of another worker is taken only
+after the owner released it (it sees the new worker on its heartbeat) or after it expired (owner died),
+so when workers join or leave, only partitions of changed workers move.
+"""
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import zlib
+
+from utils import manage_db, metrics, strava_client
+
+# Number of partitions must be the same for all workers and must not be changed while there are queued jobs
+PARTITIONS = int(os.environ.get('QUEUE_PARTITIONS', 64))
+HEARTBEAT_INTERVAL = float(os.environ.get('PARTITION_HEARTBEAT_INTERVAL', 10))
+LEASE_TTL = int(os.environ.get('PARTITION_LEASE_TTL', 30))  # worker is considered dead after this time
+
+OWNED = metrics.gauge('owned_partitions', 'Number of partitions of the queue owned by worker process')
+MOVED = metrics.counter('partition_moves_total', 'Number of partitions acquired and lost by worker process')
+logger = logging.getLogger(__name__)
+
+
+def partition_of(athlete_id: int) -> int:
+    """Partition of athlete, it is computed in SQL as well: athlete_id % PARTITIONS."""
+    return athlete_id % PARTITIONS
+
+
+def weight(worker_id: str, partition: int) -> int:
+    return zlib.crc32(f'{worker_id}/{partition}'.encode())
+
+
+def owner(partition: int, workers) -> str:
+    """Worker with the highest weight of partition, only its partitions move when a worker leaves."""
+    return max(workers, key=lambda worker_id: (weight(worker_id, partition), worker_id))
+
+
+def assign(workers) -> dict:
+    """Split partitions between workers.
+
+    :param workers: list of IDs of live workers
+    :return: dictionary worker ID -> set of partitions
+    """
+    assignment = {worker_id: set() for worker_id in workers}
+    if assignment:
+        for partition in range(PARTITIONS):
+            assignment[owner(partition, assignment)].add(partition)
+    return assignment
+
+
+def forget_partitions(partitions):
+    """Drop cached tokens and settings of athletes of lost partitions, their new owner may change them."""
+    def lost(athlete_id):
+        return partition_of(athlete_id) in partitions
+
+    for cache in (manage_db.TOKENS_CACHE, manage_db.SETTINGS_CACHE, strava_client.REFRESHED_TOKENS):
+        cache.evict(lost)
+
+
+class Membership:
+    """Membership of the worker process in the group of partitioned workers.
+
+    :param worker_id: unique ID of worker, by default it is made of host name and process ID
+    :param on_lost: function called with the set of partitions taken by other workers
+    """
+
+    def __init__(self, worker_id: str = None, on_lost=forget_partitions):
+        self.on_lost = on_lost
+        self.owned = frozenset()
+        self._worker_id = worker_id
+        self._id = None
+        self._pid = None
+        self._beat_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def worker_id(self) -> str:
+        """ID is made in the process which uses it, so processes forked from one master get different IDs."""
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._id = self._worker_id or f'{socket.gethostname()}-{self._pid}'
+            self.owned = frozenset()
+            self._beat_at = 0.0
+        return self._id
+
+    def owns(self, athlete_id: int) -> bool:
+        return partition_of(athlete_id) in self.owned
+
+    def heartbeat(self) -> frozenset:
+        """Renew record of worker and leases, take free partitions assigned to this worker and release
+        partitions assigned to other workers.
+
+        :return: set of owned partitions
+        """
+        worker_id = self.worker_id
+        with self._lock:
+            now = int(time.time())
+            db = manage_db.get_db()
+            db.execute('INSERT OR REPLACE INTO workers VALUES (?, ?)', (worker_id, now))
+            db.execute('DELETE FROM workers WHERE heartbeat_at < ?', (now - LEASE_TTL,))
+            workers = [row[0] for row in db.execute('SELECT id FROM workers')]
+            assigned = assign(workers)[worker_id]
+            held = {row[0] for row in db.execute('SELECT partition FROM partition_leases WHERE worker_id = ?',
+                                                 (worker_id,))}
+            db.executemany('DELETE FROM partition_leases WHERE partition = ? AND worker_id = ?',
+                           [(partition, worker_id) for partition in held - assigned])
+            db.executemany('INSERT INTO partition_leases VALUES (?, ?, ?) ON CONFLICT(partition) DO UPDATE SET '
+                           'worker_id = excluded.worker_id, expires_at = excluded.expires_at '
+                           'WHERE partition_leases.worker_id = excluded.worker_id OR partition_leases.expires_at < ?',
+                           [(partition, worker_id, now + LEASE_TTL, now) for partition in assigned])
+            db.commit()
+            owned = frozenset(row[0] for row in db.execute(
+                'SELECT partition FROM partition_leases WHERE worker_id = ?', (worker_id,)))
+            lost, acquired = self.owned - owned, owned - self.owned
+            self.owned = owned
+            self._beat_at = time.monotonic()
+        if lost or acquired:
+            logger.info('Worker %s owns %s partitions: %s acquired, %s lost.',
+                        worker_id, len(owned), len(acquired), len(lost))
+            MOVED.inc(len(acquired), direction='acquired')
+            MOVED.inc(len(lost), direction='lost')
+        OWNED.set(len(owned))
+        if lost and self.on_lost:
+            self.on_lost(lost)
+        return owned
+
+    def keep_alive(self):
+        """Make heartbeat if HEARTBEAT_INTERVAL passed since the last one. Failed heartbeat is logged only,
+        worker keeps processing jobs of its partitions until the leases expire.
+        """
+        if self._pid == os.getpid() and time.monotonic() - self._beat_at < HEARTBEAT_INTERVAL:
+            return
+        try:
+            self.heartbeat()
+        except sqlite3.Error as e:
+            logger.error('Heartbeat of worker %s failed: %r', self.worker_id, e)
+
+    def leave(self):
+        """Remove worker and its leases, so other workers take its partitions on their next heartbeat."""
+        worker_id = self.worker_id
+        with self._lock:
+            db = manage_db.get_db()
+            db.execute('DELETE FROM partition_leases WHERE worker_id = ?', (worker_id,))
+            db.execute('DELETE FROM workers WHERE id = ?', (worker_id,))
+            db.commit()
+            self.owned = frozenset()
+        OWNED.set(0)
+
+
+def leases() -> dict:
+    """Current owners of partitions.
+
+    :return: dictionary worker ID -> list of partitions, partitions without owner are under None
+    """
+    db = manage_db.get_db()
+    owners = dict(db.execute('SELECT partition, worker_id FROM partition_leases WHERE expires_at >= ?',
+                             (int(time.time()),)).fetchall())
+    result = {}
+    for partition in range(PARTITIONS):
+        result.setdefault(owners.get(partition), []).append(partition)
+    return result
@@ -0,0 +1,78 @@
+import threading
+import time
+
+from utils import metrics
+from utils.exceptions import RateLimitExceeded
+
+SHORT_WINDOW = 15 * 60  # Strava resets short term usage every 15 minutes (0, 15, 30, 45 minutes of hour)
+LONG_WINDOW = 24 * 3600  # and long term usage at midnight UTC
+
+BUDGET = metrics.gauge('strava_rate_limit_remaining', 'Requests to Strava API left in the current window')
+
+
+class RateLimiter:
+    """Bucket of requests to Strava API for 15 minutes and daily windows. Every request takes a token
+    from both buckets, buckets are refilled when window is over. Limits and usage reported by Strava
+    in X-RateLimit-Limit and X-RateLimit-Usage headers (e.g. "200,2000" and "35,850") have priority
+    over local counting, because other processes use the same application quota.
+    """
+
+    def __init__(self, short_limit: int = 200, long_limit: int = 2000):
+        self.limits = [short_limit, long_limit]
+        self.usage = [0, 0]
+        self._windows = self._current_windows()
+        self._lock = threading.Lock()
+        self._publish()
+
+    @staticmethod
+    def _current_windows(now: float = None) -> list:
+        now = time.time() if now is None else now
+        return [int(now // SHORT_WINDOW), int(now // LONG_WINDOW)]
+
+    def _roll(self):
+        windows = self._current_windows()
+        for i, window in enumerate(windows):
+            if window != self._windows[i]:
+                self.usage[i] = 0
+        self._windows = windows
+
+    def _publish(self):
+        BUDGET.set(self.limits[0] - self.usage[0], window='15min')
+        BUDGET.set(self.limits[1] - self.usage[1], window='daily')
+
+    def retry_at(self) -> int:
+        """Time when the exhausted window will be refilled."""
+        if self.usage[1] >= self.limits[1]:
+            return (self._windows[1] + 1) * LONG_WINDOW
+        return (self._windows[0] + 1) * SHORT_WINDOW
+
+    def remaining(self) -> tuple:
+        with self._lock:
+            self._roll()
+            return self.limits[0] - self.usage[0], self.limits[1] - self.usage[1]
+
+    def acquire(self):
+        """Take a token for one request.
+
+        :raise RateLimitExceeded: if there are no requests left in the current window
+        """
+        with self._lock:
+            self._roll()
+            if self.usage[0] >= self.limits[0] or self.usage[1] >= self.limits[1]:
+                raise RateLimitExceeded(self.retry_at())
+            self.usage[0] += 1
+            self.usage[1] += 1
+            self._publish()
+
+    def update(self, headers):
+        """Synchronize limits and usage with values from headers of Strava response."""
+        try:
+            limits = [int(value) for value in headers['X-RateLimit-Limit'].split(',')[:2]]
+            usage = [int(value) for value in headers['X-RateLimit-Usage'].split(',')[:2]]
+        except (KeyError, ValueError):
+            return
+        with self._lock:
+            self._roll()
+            self.limits = limits
+            self.usage = usage
+            self._publish()
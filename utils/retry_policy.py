@@ -0,0 +1,50 @@
+"""Policies of retries of failed jobs by class of error. Delay grows exponentially with the number
+of attempts and a random part is added to it, so jobs failed at the same time are not retried at once.
+"""
+import os
+import random
+from collections import namedtuple
+
+from utils.exceptions import StravaAPIError, RateLimitExceeded, WeatherAPIError
+
+Policy = namedtuple('Policy', 'name max_attempts base_delay max_delay')
+
+# Share of delay added at random
+JITTER = float(os.environ.get('RETRY_JITTER', 0.5))
+
+DEFAULT = Policy('error', 5, 60, 3600)
+# Strava is down or overloaded
+SERVER_ERROR = Policy('server_error', 6, 60, 3600)
+# Access token was rejected, it is renewed before the next attempt
+UNAUTHORIZED = Policy('unauthorized', 3, 5, 60)
+# Activity was deleted or athlete has no access to it, next attempts will fail as well
+CLIENT_ERROR = Policy('client_error', 1, 0, 0)
+# All weather providers failed
+WEATHER_ERROR = Policy('weather_error', 5, 300, 6 * 3600)
+# Rate limit of Strava is exceeded, job waits for the next window (a few seconds more) and attempt is not counted
+RATE_LIMITED = Policy('rate_limited', None, 10, 10)
+
+
+def policy_for(error: Exception) -> Policy:
+    if isinstance(error, RateLimitExceeded):
+        return RATE_LIMITED
+    if isinstance(error, WeatherAPIError):
+        return WEATHER_ERROR
+    if isinstance(error, StravaAPIError) and error.status:
+        if error.status == 401:
+            return UNAUTHORIZED
+        if error.status >= 500:
+            return SERVER_ERROR
+        if error.status >= 400:
+            return CLIENT_ERROR
+    return DEFAULT
+
+
+def delay(policy: Policy, attempts: int) -> float:
+    """Seconds before the next attempt.
+
+    :param policy: named tuple Policy
+    :param attempts: number of failed attempts before this one
+    """
+    base = min(policy.base_delay * 2 ** attempts, policy.max_delay)
+    return base + random.uniform(0, base * JITTER)
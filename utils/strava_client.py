@@ -1,17 +1,177 @@
+import asyncio
+import contextlib
+import logging
 import os
+import threading
 import time
 
 import requests
 
-from utils import manage_db
-from utils.exceptions import StravaAPIError
+from utils import manage_db, http_client, cache, tracing
+from utils.exceptions import StravaAPIError, RateLimitExceeded
+from utils.rate_limit import RateLimiter
+
+STRAVA_URL = os.environ.get('STRAVA_URL', 'https://www.strava.com')
+# One budget of requests for all workers of the process
+RATE_LIMITER = RateLimiter(int(os.environ.get('STRAVA_RATE_LIMIT_SHORT', 200)),
+                           int(os.environ.get('STRAVA_RATE_LIMIT_LONG', 2000)))
+# Strava gives new access token only if the current one expires in less than an hour
+REFRESH_MARGIN = int(os.environ.get('TOKEN_REFRESH_MARGIN', 3000))
+REFRESHED_TOKENS = cache.create('refreshed_tokens', maxsize=10000, ttl=REFRESH_MARGIN)
+# Strava answers so to refresh token of athlete who revoked access of application
+REVOKED_STATUSES = (400, 401)
+# Refresh tokens rejected by Strava are not refreshed in background until athlete authorizes again
+# (refresh token is changed), refresh succeeds on demand or this number of seconds passes. The latter
+# is for errors which are not revocation of access, e.g. wrong client credentials.
+REJECTED_TOKEN_TTL = int(os.environ.get('REJECTED_TOKEN_TTL', 6 * 3600))
+REJECTED_TOKENS = cache.create('rejected_refresh_tokens', maxsize=10000, ttl=REJECTED_TOKEN_TTL)
+logger = logging.getLogger(__name__)
+
+_refresh_locks = {}  # athlete ID -> (lock, number of threads which use it), locks are removed when unused
+_refresh_locks_guard = threading.Lock()
+
+
+def request(method: str, url: str, **kwargs):
+    """Make request to Strava within rate limits of application.
+
+    :raise RateLimitExceeded: if the budget of requests is exhausted
+    """
+    RATE_LIMITER.acquire()
+    response = http_client.session().request(method, url, **kwargs)
+    RATE_LIMITER.update(response.headers)
+    if response.status_code == 429:
+        raise RateLimitExceeded(RATE_LIMITER.retry_at())
+    return response
+
+
+def refresh_tokens(tokens, athlete_id):
+    """Get new tokens from Strava using refresh token.
+
+    :param tokens: named tuple Tokens with expired access token
+    :param athlete_id: Strava athlete ID
+    :return: named tuple Tokens
+    """
+    params = {
+        "client_id": os.environ.get('STRAVA_CLIENT_ID'),
+        "client_secret": os.environ.get('STRAVA_CLIENT_SECRET'),
+        "refresh_token": tokens.refresh_token,
+        "grant_type": "refresh_token"
+    }
+    response = http_client.post(f"{STRAVA_URL}/oauth/token", data=params)
+    try:
+        refresh_response = response.json()
+        return manage_db.Tokens(tokens.id, refresh_response['access_token'],
+                                refresh_response['refresh_token'], refresh_response['expires_at'])
+    except (KeyError, ValueError):
+        raise StravaAPIError(f'Failed to refresh token ID={tokens.id}. Athlete ID={athlete_id}.', response.status_code)
+
+
+def access_revoked(error: StravaAPIError) -> bool:
+    """Check that refresh of tokens failed because athlete revoked access, so retries do not help."""
+    return error.status in REVOKED_STATUSES
+
+
+@contextlib.contextmanager
+def _refresh_lock(athlete_id):
+    with _refresh_locks_guard:
+        lock, users = _refresh_locks.get(athlete_id, (None, 0))
+        lock = lock or threading.Lock()
+        _refresh_locks[athlete_id] = (lock, users + 1)
+    try:
+        with lock:
+            yield
+    finally:
+        with _refresh_locks_guard:
+            lock, users = _refresh_locks[athlete_id]
+            if users == 1:
+                del _refresh_locks[athlete_id]
+            else:
+                _refresh_locks[athlete_id] = (lock, users - 1)
+
+
+def refresh_tokens_once(tokens, athlete_id):
+    """Refresh tokens so that only one request for the athlete is in flight. Concurrent callers wait
+    for it and get the same new tokens instead of using the refresh token twice.
+
+    :param tokens: named tuple Tokens with expiring access token
+    :param athlete_id: Strava athlete ID
+    :return: named tuple Tokens
+    """
+    with _refresh_lock(athlete_id):
+        fresh = REFRESHED_TOKENS.get(athlete_id)
+        if fresh is None or fresh.expires_at <= time.time():
+            fresh = refresh_tokens(tokens, athlete_id)
+            REFRESHED_TOKENS.set(athlete_id, fresh)
+            REJECTED_TOKENS.delete(athlete_id)
+        return fresh
+
+
+def renew_tokens(athlete_id):
+    """Refresh tokens of athlete even if access token is not expired, e.g. Strava rejected it with 401.
+
+    :return: named tuple Tokens
+    """
+    tokens = manage_db.get_athlete(athlete_id)
+    if tokens is None:
+        raise StravaAPIError(f'No tokens of athlete ID={athlete_id}.')
+    REFRESHED_TOKENS.delete(athlete_id)
+    tokens = refresh_tokens_once(tokens, athlete_id)
+    manage_db.add_athlete(tokens)
+    return tokens
+
+
+def auth_headers(athlete_id) -> dict:
+    """Return authorization headers with valid access token of athlete, token is refreshed if it expired."""
+    tokens = manage_db.get_athlete(athlete_id)
+    if tokens is None:
+        raise StravaAPIError(f'No tokens of athlete ID={athlete_id}.')
+    if tokens.expires_at <= time.time():
+        tokens = refresh_tokens_once(tokens, athlete_id)
+        manage_db.add_athlete(tokens)
+    return {'Authorization': f"Bearer {tokens.access_token}"}
+
+
+def fetch_athlete_activities(athlete_id, headers: dict, page: int = 1, per_page: int = 30,
+                             before: int = None, after: int = None) -> list:
+    """Get one page of summaries of athlete's activities, the newest first.
+    See https://developers.strava.com/docs/reference/#api-Activities-getLoggedInAthleteActivities
+    """
+    params = {'page': page, 'per_page': per_page, 'before': before, 'after': after}
+    response = request('GET', f'{STRAVA_URL}/api/v3/athlete/activities', headers=headers,
+                       params={name: value for name, value in params.items() if value is not None})
+    try:
+        activities = response.json()
+    except ValueError:
+        activities = None
+    if not response.ok or not isinstance(activities, list):
+        raise StravaAPIError(f'Failed to get activities of athlete ID={athlete_id}, page {page}.', response.status_code)
+    return activities
+
+
+def activity_url(activity_id) -> str:
+    return f'{STRAVA_URL}/api/v3/activities/{activity_id}'
+
+
+def fetch_activity(athlete_id, activity_id, headers: dict) -> dict:
+    response = request('GET', activity_url(activity_id), headers=headers)
+    try:
+        if response.ok:
+            return response.json()
+    except ValueError:
+        pass
+    raise StravaAPIError(f'Failed to get activity ID={activity_id}. Athlete ID={athlete_id}.', response.status_code)
+
+
+def update_activity(athlete_id, activity_id, headers: dict, payload: dict):
+    response = request('PUT', activity_url(activity_id), headers=headers, data=payload)
+    if not response.ok:
+        raise StravaAPIError(f'Failed modify activity ID={activity_id}. Athlete ID={athlete_id}', response.status_code)
 
 
 class StravaClient:
     def __init__(self, athlete_id, activity_id):
         self.__athlete_id = athlete_id
         self.__activity_id = activity_id
-        self.__session = requests.Session()
         tokens = manage_db.get_athlete(athlete_id)
         tokens = self._update_tokens(tokens)
         manage_db.add_athlete(tokens)
@@ -20,23 +180,7 @@ class StravaClient:
     def _update_tokens(self, tokens):
         if tokens.expires_at > time.time():
             return tokens
-
-        params = {
-            "client_id": os.environ.get('STRAVA_CLIENT_ID'),
-            "client_secret": os.environ.get('STRAVA_CLIENT_SECRET'),
-            "refresh_token": tokens.refresh_token,
-            "grant_type": "refresh_token"
-        }
-        try:
-            refresh_response = self.__session.post("https://www.strava.com/oauth/token", data=params).json()
-            return manage_db.Tokens(tokens.id, refresh_response['access_token'],
-                                    refresh_response['refresh_token'], refresh_response['expires_at'])
-        except (KeyError, ValueError):
-            raise StravaAPIError(f'Failed to refresh token ID={tokens.id}. Athlete ID={self.__athlete_id}.')
-
-    @property
-    def __activity_url(self) -> str:
-        return f'https://www.strava.com/api/v3/activities/{self.__activity_id}'
+        return refresh_tokens_once(tokens, self.__athlete_id)
 
     @property
     def get_activity(self) -> dict:
@@ -44,10 +188,7 @@ class StravaClient:
 
         :return: dictionary with activity data
         """
-        try:
-            return self.__session.get(self.__activity_url, headers=self.__headers).json()
-        except ValueError:
-            raise StravaAPIError(f'Failed to get activity ID={self.__activity_id}. Athlete ID={self.__athlete_id}.')
+        return fetch_activity(self.__athlete_id, self.__activity_id, self.__headers)
 
     def modify_activity(self, payload: dict):
         """Method can change UpdatableActivity parameters such that description, name, type, gear_id.
@@ -56,5 +197,89 @@ class StravaClient:
         :param payload: dictionary with keys description, name, type, gear_id, trainer, commute
         :return: dictionary with updated activity parameters
         """
-        if not self.__session.put(self.__activity_url, headers=self.__headers, data=payload).ok:
-            raise StravaAPIError(f'Failed modify activity ID={self.__activity_id}. Athlete ID={self.__athlete_id}')
+        update_activity(self.__athlete_id, self.__activity_id, self.__headers, payload)
+
+
+class AsyncStravaClient:
+    """Asynchronous version of StravaClient. Blocking requests to Strava are run in the executor
+    of event loop, while database is used only from the thread of event loop.
+    Use AsyncStravaClient.create to make an instance.
+    """
+
+    def __init__(self, athlete_id, activity_id, tokens):
+        self.__athlete_id = athlete_id
+        self.__activity_id = activity_id
+        self.__headers = {'Authorization': f"Bearer {tokens.access_token}"}
+
+    @classmethod
+    async def create(cls, athlete_id, activity_id):
+        tokens = manage_db.get_athlete(athlete_id)
+        if tokens.expires_at <= time.time():
+            with tracing.span('token_refresh'):
+                tokens = await asyncio.to_thread(refresh_tokens_once, tokens, athlete_id)
+                manage_db.add_athlete(tokens)
+        return cls(athlete_id, activity_id, tokens)
+
+    async def get_activity(self) -> dict:
+        return await asyncio.to_thread(fetch_activity, self.__athlete_id, self.__activity_id, self.__headers)
+
+    async def modify_activity(self, payload: dict):
+        await asyncio.to_thread(update_activity, self.__athlete_id, self.__activity_id, self.__headers, payload)
+
+
+class TokenRefresher:
+    """Background thread which renews access tokens shortly before they expire, so processing
+    of activities does not wait for OAuth requests. With membership (see utils/partitions.py) only
+    tokens of athletes of owned partitions are refreshed, so workers do not refresh the same tokens.
+    """
+
+    def __init__(self, app, interval: float = 300, membership=None):
+        self.app = app
+        self.interval = interval
+        self.membership = membership
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def start(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name='token-refresher', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = None):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def refresh_expiring(self):
+        """Refresh all tokens which expire within REFRESH_MARGIN and save them in one transaction."""
+        refreshed = []
+        for tokens in manage_db.get_expiring_athletes(int(time.time()) + REFRESH_MARGIN):
+            if self.membership and not self.membership.owns(tokens.id):
+                continue
+            if REJECTED_TOKENS.get(tokens.id) == tokens.refresh_token:
+                continue
+            try:
+                refreshed.append(refresh_tokens_once(tokens, tokens.id))
+            except StravaAPIError as e:
+                if access_revoked(e):
+                    REJECTED_TOKENS.set(tokens.id, tokens.refresh_token)
+                    logger.warning('Refresh token of athlete ID=%s is rejected, it is not refreshed '
+                                   'until new authorization.', tokens.id)
+                else:
+                    logger.warning('Failed to refresh tokens of athlete ID=%s: %r', tokens.id, e)
+            except requests.RequestException as e:
+                logger.warning('Failed to refresh tokens of athlete ID=%s: %r', tokens.id, e)
+        manage_db.add_athletes(refreshed)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                with self.app.app_context() if self.app else contextlib.nullcontext():
+                    self.refresh_expiring()
+            except Exception:
+                logger.exception('Refresh of tokens failed.')  # e.g. database is locked, it is tried again later
+            self._stopped.wait(self.interval)
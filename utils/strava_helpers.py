@@ -1,7 +1,16 @@
+import logging
 import os
 import urllib.parse
 
-import requests
+from utils import cache, http_client, strava_client
+from utils.exceptions import StravaAPIError
+
+logger = logging.getLogger(__name__)
+
+# Status of push subscription is changed by this application only, see commands in utils/cli.py
+SUBSCRIPTION_TTL = int(os.environ.get('SUBSCRIPTION_CACHE_TTL', 3600))
+SUBSCRIPTION_CACHE = cache.create('push_subscription', maxsize=1, ttl=SUBSCRIPTION_TTL, persistent=True)
+SUBSCRIPTION_KEY = 'subscription'
 
 
 def get_tokens(code):
@@ -11,7 +20,7 @@ def get_tokens(code):
         "code": code,
         "grant_type": "authorization_code"
     }
-    return requests.post("https://www.strava.com/oauth/token", data=params).json()
+    return http_client.post(f"{strava_client.STRAVA_URL}/oauth/token", data=params).json()
 
 
 def make_link_to_get_code(redirect_url: str) -> str:
@@ -26,18 +35,75 @@ def make_link_to_get_code(redirect_url: str) -> str:
     return 'https://www.strava.com/oauth/authorize?' + values_url
 
 
+def get_subscription(refresh: bool = False):
+    """Push subscription of APP to Strava Webhook events. The answer of Strava is cached in memory and
+    on disk for SUBSCRIPTION_TTL seconds, so it is not requested on every GET of webhook.
+
+    :param refresh: request Strava even if status is cached
+    :return: dictionary with subscription (it has 'id' and 'callback_url'), empty if APP is not subscribed,
+        or None if Strava answered with error (this answer is not cached)
+    """
+    if not refresh:
+        subscription = SUBSCRIPTION_CACHE.get(SUBSCRIPTION_KEY)
+        if subscription is not None:
+            return subscription
+    response = strava_client.request('GET', f'{strava_client.STRAVA_URL}/api/v3/push_subscriptions',
+                                     params=_client_credentials())
+    try:
+        subscriptions = response.json()
+        logger.debug('Push subscriptions: %s', subscriptions)
+        subscription = subscriptions[0] if subscriptions else {}
+        subscription = subscription if 'id' in subscription else {}
+    except (IndexError, KeyError, TypeError, ValueError):
+        return
+    SUBSCRIPTION_CACHE.set(SUBSCRIPTION_KEY, subscription)
+    return subscription
+
+
 def is_app_subscribed() -> bool:
-    """A GET request to the push subscription endpoint to check Strava Webhook status of APP.
+    """Check Strava Webhook status of APP, see get_subscription.
 
     :return: boolean
     """
-    payload = {
+    return bool(get_subscription())
+
+
+def create_subscription(callback_url: str) -> dict:
+    """Subscribe APP to Strava Webhook events. Strava verifies callback_url with GET request
+    before it answers, so the webhook must be available.
+
+    :param callback_url: URL of webhook
+    :return: dictionary with subscription
+    :raise StravaAPIError: if Strava refused to create subscription
+    """
+    SUBSCRIPTION_CACHE.delete(SUBSCRIPTION_KEY)
+    payload = {**_client_credentials(), 'callback_url': callback_url,
+               'verify_token': os.environ.get('STRAVA_WEBHOOK_TOKEN')}
+    response = strava_client.request('POST', f'{strava_client.STRAVA_URL}/api/v3/push_subscriptions', data=payload)
+    try:
+        subscription = response.json()
+        subscription_id = subscription['id']
+    except (KeyError, TypeError, ValueError):
+        raise StravaAPIError(f'Failed to create push subscription: {response.text}')
+    subscription = {'id': subscription_id, 'callback_url': callback_url}
+    SUBSCRIPTION_CACHE.set(SUBSCRIPTION_KEY, subscription)
+    return subscription
+
+
+def delete_subscription(subscription_id: int):
+    """Unsubscribe APP from Strava Webhook events.
+
+    :raise StravaAPIError: if Strava refused to delete subscription
+    """
+    SUBSCRIPTION_CACHE.delete(SUBSCRIPTION_KEY)
+    response = strava_client.request('DELETE', f'{strava_client.STRAVA_URL}/api/v3/push_subscriptions/{subscription_id}',
+                                     params=_client_credentials())
+    if not response.ok:
+        raise StravaAPIError(f'Failed to delete push subscription {subscription_id}: {response.text}')
+
+
+def _client_credentials() -> dict:
+    return {
         'client_id': os.environ.get('STRAVA_CLIENT_ID'),
         'client_secret': os.environ.get('STRAVA_CLIENT_SECRET')
     }
-    response = requests.get('https://www.strava.com/api/v3/push_subscriptions', data=payload)
-    try:
-        print(response.json())
-        return 'id' in response.json()[0]
-    except (IndexError, KeyError, ValueError):
-        return False
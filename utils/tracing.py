@@ -0,0 +1,70 @@
+import contextlib
+import contextvars
+import logging
+import time
+import uuid
+
+from utils import metrics
+
+LOG_FORMAT = '%(asctime)s %(levelname)s [%(trace_id)s] %(name)s: %(message)s'
+
+STAGE_LATENCY = metrics.histogram('activity_stage_duration_seconds', 'Latency of stages of adding weather to activity')
+STAGE_ERRORS = metrics.counter('activity_stage_errors_total', 'Number of failed stages of adding weather to activity')
+
+trace_id = contextvars.ContextVar('trace_id', default='-')
+logger = logging.getLogger(__name__)
+
+
+@contextlib.contextmanager
+def trace(activity_id=None):
+    """Start new trace, e.g. for processing of one activity. Trace ID is added to all log records
+    made in this context, including tasks and threads started by asyncio.
+    """
+    token = trace_id.set(f'{activity_id}-{uuid.uuid4().hex[:8]}' if activity_id else uuid.uuid4().hex[:16])
+    try:
+        yield trace_id.get()
+    finally:
+        trace_id.reset(token)
+
+
+@contextlib.contextmanager
+def span(stage: str):
+    """Measure time of the stage of processing. Duration is logged with trace ID and observed
+    in the histogram STAGE_LATENCY, failures are counted in STAGE_ERRORS.
+    """
+    started = time.perf_counter()
+    status = 'ok'
+    try:
+        yield
+    except BaseException:
+        status = 'error'
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        duration = time.perf_counter() - started
+        STAGE_LATENCY.observe(duration, stage=stage)
+        logger.debug('span %s %s in %.3f s', stage, status, duration)
+
+
+async def traced(stage: str, awaitable):
+    """Await the coroutine in span of the stage."""
+    with span(stage):
+        return await awaitable
+
+
+def _record_factory(factory):
+    def make_record(*args, **kwargs):
+        record = factory(*args, **kwargs)
+        record.trace_id = trace_id.get()
+        return record
+    return make_record
+
+
+def init_logging(level=logging.INFO):
+    """Configure logging of application, every record gets attribute trace_id."""
+    factory = logging.getLogRecordFactory()
+    if not getattr(factory, 'with_trace_id', False):
+        factory = _record_factory(factory)
+        factory.with_trace_id = True
+        logging.setLogRecordFactory(factory)
+    logging.basicConfig(level=level, format=LOG_FORMAT)
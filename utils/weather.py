@@ -1,25 +1,46 @@
+import asyncio
+import logging
 import os
-import requests
+import time
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
-from dotenv import load_dotenv
 from urllib.parse import urlencode
 
-from utils import manage_db
-from utils.strava_client import StravaClient
+from utils import manage_db, cache, descriptions, http_client, ledger, metrics, tracing, weather_providers
+from utils.exceptions import WeatherAPIError
+from utils.strava_client import AsyncStravaClient
 
-load_dotenv(os.path.join(os.path.dirname(__file__), '../.env'))
+logger = logging.getLogger(__name__)
+ACTIVITIES = metrics.counter('activities_processed_total', 'Number of activities processed by result')
 
-
-BASE_URL = 'https://api.weatherapi.com/v1'
+BASE_URL = os.environ.get('WEATHER_API_URL', 'https://api.weatherapi.com/v1')
 API_KEY = os.environ.get('API_WEATHER_KEY')
-PHRASES = {
-    'ru': ['по ощущениям', 'км/ч', 'с'],
-    'en': ['feels like', 'kph', 'from']
-}
+# Weather is shared by activities started in the same cell of grid (about 5 km) at the same day
+GRID_STEP = float(os.environ.get('WEATHER_GRID_STEP', 0.05))
+HISTORY_CACHE = cache.create('weather_history', maxsize=int(os.environ.get('WEATHER_CACHE_SIZE', 10000)),
+                             ttl=30 * 24 * 3600, persistent=True)
+# Response for the day which is not over yet holds forecast for the later hours, it is requested again
+# if the needed hour was not over when it was fetched, but not more often than this number of seconds
+FORECAST_REFRESH = int(os.environ.get('WEATHER_FORECAST_REFRESH', 600))
+# Hours of the day are in local time of the place, it may be ahead of UTC up to 14 hours
+MAX_UTC_OFFSET = timedelta(hours=14)
+# Current air quality is shared by activities uploaded from the same city within a few minutes
+AIR_GRID_STEP = float(os.environ.get('AIR_GRID_STEP', 0.1))
+AIR_CACHE = cache.create('air_quality', maxsize=int(os.environ.get('AIR_CACHE_SIZE', 2000)),
+                         ttl=int(os.environ.get('AIR_CACHE_TTL', 600)))
+# Providers of historical weather in the order of preference, see utils/weather_providers.py
+PROVIDERS = os.environ.get('WEATHER_PROVIDERS', 'weatherapi,open-meteo').split(',')
+# The next provider is requested if the current one does not answer within this time
+HEDGE_DELAY = float(os.environ.get('WEATHER_HEDGE_DELAY', 1.0))
+ROUTER = weather_providers.create_router(PROVIDERS, HEDGE_DELAY)
+HOUR_FIELDS = ('condition', 'temp_c', 'feelslike_c', 'humidity', 'wind_kph', 'wind_degree')
+# Activities in progress in one event loop, every one makes one request to Strava at a time, so by default
+# there are as many of them as connections to Strava
+ASYNC_CONCURRENCY = int(os.environ.get('ASYNC_CONCURRENCY', http_client.POOL_SIZES['https://www.strava.com']))
 ICONS = {
-    1000: '☀️', 1003: '🌤', 1006: '☁', 1006: '☁', 1030: '😶‍🌫️', 1135: '☁️', 1147: '☁️', 1066: '🌨',
-    1069: '🌨', 1063: '🌦', 1072: '🌨', 1150: '🌧', 1153: '🌧', 1168: '🌧', 1169: '🌧', 1087: '🌩',
+    1000: '☀️', 1003: '🌤', 1006: '☁', 1009: '☁', 1030: '😶‍🌫️', 1135: '☁️', 1147: '☁️', 1066: '🌨',
+    1069: '🌨', 1063: '🌦', 1072: '🌨', 1150: '🌧', 1153: '🌧', 1168: '🌧', 1169: '🌧', 1171: '🌧', 1087: '🌩',
     1114: '🌨', 1117: '🌨', 1180: '🌦', 1183: '🌦', 1186: '🌦', 1189: '🌧', 1192: '🌧', 1195: '🌧',
     1198: '🌧', 1201: '🌧', 1204: '🌨', 1207: '🌨', 1210: '🌨', 1213: '🌨', 1216: '🌨', 1219: '🌨',
     1222: '🌨', 1237: '🌨', 1240: '🌧', 1243: '🌧', 1246: '🌧', 1249: '🌧', 1252: '🌨', 1255: '🌨',
@@ -28,11 +49,7 @@ ICONS = {
 
 
 def compass_direction(degree: int, lan='en') -> str:
-    compass_arr = {'ru': ["С", "ССВ", "СВ", "ВСВ", "В", "ВЮВ", "ЮВ", "ЮЮВ",
-                          "Ю", "ЮЮЗ", "ЮЗ", "ЗЮЗ", "З", "ЗСЗ", "СЗ", "ССЗ", "С"],
-                   'en': ["N", "NNE", "NE", "ENE", "E", "ESE", "SE", "SSE",
-                          "S", "SSW", "SW", "WSW", "W", "WNW", "NW", "NNW", "N"]}
-    return compass_arr[lan][int((degree % 360) / 22.5 + 0.5)]
+    return descriptions.compass_direction(degree, lan)
 
 
 def add_weather(athlete_id: int, activity_id: int):
@@ -42,72 +59,192 @@ def add_weather(athlete_id: int, activity_id: int):
     :param activity_id: Strava activity ID
     :return: status code
     """
-    strava = StravaClient(athlete_id, activity_id)
-    activity = strava.get_activity
+    return asyncio.run(add_weather_async(athlete_id, activity_id))
 
-    # Activity type checking. Skip processing if activity is manual or indoor.
-    if activity.get('manual', False) or activity.get('trainer', False) or activity.get('type', '') == 'VirtualRide':
-        print(f"Activity with ID{activity_id} is manual created or indoor. Can't add weather info for it.")
-        return  # ok, but no processing
 
-    # Description of activity checking. Don't format this activity if it contains a weather data.
-    description = activity.get('description')
-    description = '' if description is None else description.rstrip() + '\n'
+async def process_activities(activities, concurrency: int = ASYNC_CONCURRENCY) -> list:
+    """Add weather to many activities concurrently in one event loop.
+
+    :param activities: iterable of pairs (athlete_id, activity_id)
+    :param concurrency: max number of activities in progress at the same time
+    :return: list with None for processed activity or exception raised while processing
+    """
+    # weather and air quality of activity are requested at the same time
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(concurrency * 2))
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def process(athlete_id, activity_id):
+        async with semaphore:
+            await add_weather_async(athlete_id, activity_id)
+
+    return await asyncio.gather(*(process(*activity) for activity in activities), return_exceptions=True)
+
+
+async def add_weather_async(athlete_id: int, activity_id: int):
+    """Asynchronous version of add_weather. Weather and air quality are requested concurrently.
+    Processing is traced, stages are measured by spans.
+
+    :param athlete_id: integer Strava athlete ID
+    :param activity_id: Strava activity ID
+    """
+    with tracing.trace(activity_id):
+        try:
+            with tracing.span('add_weather'):
+                status = await _add_weather(athlete_id, activity_id)
+        except Exception:
+            ACTIVITIES.inc(status='error')
+            raise
+        ACTIVITIES.inc(status=status)
+
+
+def _skip_reason(activity: dict, description: str):
+    """Return the reason why weather is not added to activity or None if it can be added."""
+    if activity.get('manual', False) or activity.get('trainer', False) or activity.get('type', '') == 'VirtualRide':
+        return "is manual created or indoor. Can't add weather info for it"
+    # Don't format this activity if it contains a weather data
     if '°C' in description:
-        print(f'Weather description for activity ID={activity_id} is already set.')
-        return  # ok, but no processing
+        return 'already has weather description'
+    try:
+        lat, lon = activity['start_latlng']
+    except (KeyError, ValueError):
+        return 'has no start geo position'
+
 
-    # Check starting time of activity. Convert time to integer Unix time, GMT
+def _skip(athlete_id: int, activity_id: int, started_at: float) -> str:
+    ledger.record(athlete_id, activity_id, ledger.SKIPPED, started_at)
+    return ledger.SKIPPED  # ok, but no processing
+
+
+def _activity_time(activity: dict):
+    """Return time in the middle of activity and time of its finish, both naive UTC."""
     try:
         start_time = datetime.strptime(activity['start_date'], '%Y-%m-%dT%H:%M:%SZ')
     except (KeyError, ValueError):
-        print(f'WARNING: Bad date format for activity ID={activity_id}. Use current time.')
+        logger.warning('Bad date format for activity ID=%s. Use current time.', activity.get('id'))
         # if some problems with activity start time let's use time a hour ago
         start_time = datetime.now(timezone.utc) - timedelta(hours=1)
     elapsed_time = timedelta(seconds=activity.get('elapsed_time', 0))
-    activity_time = start_time + elapsed_time // 2  # in the middle of activity
+    return start_time + elapsed_time // 2, start_time + elapsed_time
 
-    try:
-        lat, lon = activity['start_latlng']
-    except (KeyError, ValueError):
-        print(f'WARNING: No start geo position for activity ID={activity_id}, T={start_time}')
-        return  # ok, but no processing
 
-    settings = manage_db.get_settings(athlete_id)
+async def _add_weather(athlete_id: int, activity_id: int) -> str:
+    started_at = time.time()
+    # Redelivered events of the same activity are detected without requests to Strava
+    if ledger.is_processed(activity_id):
+        logger.info('Activity ID=%s is already processed.', activity_id)
+        return 'duplicate'
+    strava = await AsyncStravaClient.create(athlete_id, activity_id)
+    activity = await tracing.traced('activity_get', strava.get_activity())
+    description = activity.get('description')
+    description = '' if description is None else description.rstrip() + '\n'
+    reason = _skip_reason(activity, description)
+    if reason:
+        logger.info('Activity ID=%s %s.', activity_id, reason)
+        return _skip(athlete_id, activity_id, started_at)
+    lat, lon = activity['start_latlng']
+    activity_time, finish_time = _activity_time(activity)
+
+    with tracing.span('settings_read'):
+        settings = manage_db.get_settings(athlete_id)
 
     if settings.icon:
         activity_title = activity.get('name')
-        icon = get_weather_icon(lat, lon, activity_time)
+        icon = await tracing.traced('weather_fetch', asyncio.to_thread(get_weather_icon, lat, lon, activity_time))
+        if icon is None:
+            raise WeatherAPIError(f'No weather icon for activity ID={activity_id}')
         if not icon or activity_title.startswith(icon):
-            return  # maybe ok, no processing
+            return _skip(athlete_id, activity_id, started_at)
         payload = {'name': icon + ' ' + activity_title}
     else:
-        weather_description = get_weather_description(lat, lon, activity_time, settings)
+        weather_description = tracing.traced('weather_fetch', asyncio.to_thread(
+            get_weather_description, lat, lon, activity_time, settings))
         # Add air quality only if user set this option and time of activity uploading is appropriate!
-        if settings.aqi and \
-           (start_time + elapsed_time + timedelta(hours=2) > datetime.now(timezone.utc).replace(tzinfo=None)):
-            air_conditions = get_air_description(lat, lon, settings.lan)
+        if settings.aqi and finish_time + timedelta(hours=2) > datetime.now(timezone.utc).replace(tzinfo=None):
+            air_conditions = tracing.traced('air_fetch', asyncio.to_thread(get_air_description, lat, lon, settings.lan))
         else:
-            air_conditions = ''
+            air_conditions = asyncio.sleep(0, '')
+        weather_description, air_conditions = await asyncio.gather(weather_description, air_conditions)
+        if not weather_description:
+            raise WeatherAPIError(f'No weather description for activity ID={activity_id}')
         payload = {'description': description + weather_description + air_conditions}
-    strava.modify_activity(payload)
+    await tracing.traced('activity_put', strava.modify_activity(payload))
+    ledger.record(athlete_id, activity_id, ledger.DONE, started_at, payload)
+    return ledger.DONE
 
 
-def weather_info(params: dict) -> dict:
-    params['key'] = API_KEY
-    response = requests.get(f"{BASE_URL}/history.json?{urlencode(params)}")
-    return response.json()['forecast']['forecastday'][0]['hour'][0]
+def day_weather(lat, lon, date: str, lan='en', until: float = None) -> list:
+    """Get historical weather for all hours of the day. Responses are cached by cell of geographical grid,
+    so all athletes started nearby at the same day share one request to weather providers.
+
+    :param lat: latitude
+    :param lon: longitude
+    :param date: date in format YYYY-MM-DD
+    :param lan: language of weather condition text
+    :param until: Unix time, cached response fetched before it is requested again (see FORECAST_REFRESH)
+    :return: list of dictionaries with hour weather data
+    """
+    x, y = cache.grid_cell(lat, lon, GRID_STEP)
+    key = f"{x}:{y}:{date}:{lan}"
+
+    def fetch():
+        return {'fetched_at': time.time(),
+                'hours': [{field: h[field] for field in HOUR_FIELDS} for h in ROUTER.history(lat, lon, date, lan)]}
+
+    record = HISTORY_CACHE.get_or_set(key, fetch)
+    if isinstance(record, list):  # cached by previous version without time of request
+        record = {'fetched_at': 0, 'hours': record}
+    if until is not None and record['fetched_at'] < until and record['fetched_at'] < time.time() - FORECAST_REFRESH:
+        HISTORY_CACHE.delete(key)
+        record = HISTORY_CACHE.get_or_set(key, fetch)
+    return record['hours']
+
+
+def hour_weather(lat, lon, timestamp, lan='en') -> dict:
+    """Get historical weather at the time of timestamp interpolated between adjacent hours.
+
+    :param lat: latitude
+    :param lon: longitude
+    :param timestamp: time of requested weather, UTC if it is naive
+    :param lan: language of weather condition text
+    :return: dictionary with weather data
+    """
+    # the next hour is used for interpolation, it must be over in any time zone
+    until = timestamp if timestamp.tzinfo else timestamp.replace(tzinfo=timezone.utc)
+    until += timedelta(hours=1) + MAX_UTC_OFFSET
+    hours = day_weather(lat, lon, timestamp.strftime('%Y-%m-%d'), lan, until.timestamp())
+    before = hours[min(timestamp.hour, len(hours) - 1)]
+    after = hours[min(timestamp.hour + 1, len(hours) - 1)]
+    k = (timestamp.minute * 60 + timestamp.second) / 3600
+    w = {field: before[field] + (after[field] - before[field]) * k
+         for field in ('temp_c', 'feelslike_c', 'wind_kph')}
+    w['humidity'] = round(before['humidity'] + (after['humidity'] - before['humidity']) * k)
+    # wind direction is interpolated by the shortest arc
+    w['wind_degree'] = (before['wind_degree'] + ((after['wind_degree'] - before['wind_degree'] + 180) % 360 - 180) * k) % 360
+    w['condition'] = before['condition'] if k < 0.5 else after['condition']
+    return w
 
 
 def air_info(params: dict) -> dict:
     params['key'] = API_KEY
     params['aqi'] = 'yes'
-    response = requests.get(f"{BASE_URL}/current.json?{urlencode(params)}")
+    response = http_client.get(f"{BASE_URL}/current.json?{urlencode(params)}")
     return response.json()['current']['air_quality']
 
 
+def current_air(lat, lon) -> dict:
+    """Get current air quality. Responses are cached for AIR_CACHE_TTL seconds by cell of geographical grid.
+
+    :param lat: latitude
+    :param lon: longitude
+    :return: dictionary with air quality data
+    """
+    x, y = cache.grid_cell(lat, lon, AIR_GRID_STEP)
+    key = f'{x}:{y}'
+    return AIR_CACHE.get_or_set(key, lambda: air_info({'q': f'{lat},{lon}'}))
+
+
 def get_weather_description(lat, lon, timestamp, s) -> str:
-    """Get weather data using https://www.weatherapi.com/ API.
+    """Get weather data from the weather providers, see ROUTER.
 
     :param lat: latitude
     :param lon: longitude
@@ -116,29 +253,11 @@ def get_weather_description(lat, lon, timestamp, s) -> str:
     :return: string with history weather data
     """
     try:
-        w = weather_info(
-            {
-                'q': f"{lat},{lon}",
-                'dt': timestamp.strftime('%Y-%m-%d'),
-                'hour': timestamp.hour,
-                'lang': s.lan
-            }
-        )
+        w = hour_weather(lat, lon, timestamp, s.lan)
     except (KeyError, ValueError):
-        print(f'Error! Weather request failed. User ID-{s.id} in ({lat},{lon}) at {timestamp}.')
+        logger.error('Weather request failed. User ID-%s in (%s,%s) at %s.', s.id, lat, lon, timestamp)
         return ''
-    t = PHRASES[s.lan]
-    feels_like = format(w['feelslike_c'], '.0f')
-    description = f"{w['condition']['text'].capitalize()}, " \
-                  f"🌡\xa0{w['temp_c']:.0f}°C ({t[0]} {'0' if feels_like == '-0' else feels_like}°C)"
-    description += f", 💦\xa0{w['humidity']}%" if s.hum else ""
-    if s.wind:
-        description += f", 💨\xa0{w['wind_kph']:.0f}{t[1]}"
-        if f"{w['wind_kph']:.0f}" != '0':
-            description += f" ({t[2]} {compass_direction(w['wind_degree'], s.lan)})."
-        else:
-            description += '.'
-    return description
+    return descriptions.weather(w, s.lan, s.hum, s.wind)
 
 
 def get_air_description(lat, lon, lan='en') -> str:
@@ -147,20 +266,15 @@ def get_air_description(lat, lon, lan='en') -> str:
 
     :param lat: latitude
     :param lon: longitude
-    :param lan: language 'ru' or 'en' by default
+    :param lan: language registered in utils.descriptions, 'en' by default
     :return: string with air quality data
     """
     try:
-        aq = air_info({'q': f'{lat},{lon}', 'lang': lan})
+        aq = current_air(lat, lon)
     except KeyError:
-        print(f'ERROR: failed to GET air info at ({lat},{lon})')
+        logger.error('Failed to GET air info at (%s,%s)', lat, lon)
         return ''
-    # Air Quality Index: 1 = Good, 2 = Moderate, 3 = Unhealthy for sensitive, 4 = Unhealthy, 5 = Very Poor, 6 = Hazardous
-    aqi = ['😃', '🙂', '😐', '🙁', '😨', '🤢'][aq['us-epa-index'] - 1]
-    air = {'ru': 'Воздух', 'en': 'Air'}
-    return f"\n{air[lan]} {aqi} {aq['pm2_5']:.1f}(PM2.5), " \
-           f"{aq['so2']:.0f}(SO₂), {aq['no2']:.0f}(NO₂), " \
-           f"{aq['o3']:.0f}(O₃), {aq['co']:.0f}(CO)."
+    return descriptions.air(aq, lan)
 
 
 def get_weather_icon(lat, lon, timestamp):
@@ -170,17 +284,14 @@ def get_weather_icon(lat, lon, timestamp):
     :param lat: latitude
     :param lon: longitude
     :param timestamp: time of requested weather data
-    :return: emoji with weather
+    :return: emoji with weather, empty string if there is no emoji for the weather condition
+        or None if weather request failed
     """
     try:
-        icon_code = weather_info(
-            {
-                'q': f'{lat},{lon}',
-                'dt': timestamp.strftime('%Y-%m-%d'),
-                'hour': timestamp.hour
-            }
-        )['condition']['code']
-        return ICONS[icon_code]
+        icon_code = hour_weather(lat, lon, timestamp)['condition']['code']
     except (KeyError, ValueError):
-        print(f'ERROR: failed to GET weather in ({lat},{lon}) at {timestamp}.')
+        logger.error('Failed to GET weather in (%s,%s) at %s.', lat, lon, timestamp)
         return
+    if icon_code not in ICONS:
+        logger.warning('No icon for weather condition code %s.', icon_code)
+    return ICONS.get(icon_code, '')
@@ -0,0 +1,220 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlencode
+
+from utils import http_client, metrics
+
+# Weather code of https://open-meteo.com (WMO) -> code of https://www.weatherapi.com and condition text
+WMO_CONDITIONS = {
+    0: (1000, {'en': 'Clear', 'ru': 'Ясно'}),
+    1: (1003, {'en': 'Mainly clear', 'ru': 'Преимущественно ясно'}),
+    2: (1003, {'en': 'Partly cloudy', 'ru': 'Переменная облачность'}),
+    3: (1006, {'en': 'Overcast', 'ru': 'Пасмурно'}),
+    45: (1135, {'en': 'Fog', 'ru': 'Туман'}),
+    48: (1147, {'en': 'Freezing fog', 'ru': 'Переохлажденный туман'}),
+    51: (1150, {'en': 'Light drizzle', 'ru': 'Слабая морось'}),
+    53: (1153, {'en': 'Drizzle', 'ru': 'Морось'}),
+    55: (1153, {'en': 'Dense drizzle', 'ru': 'Сильная морось'}),
+    56: (1168, {'en': 'Freezing drizzle', 'ru': 'Замерзающая морось'}),
+    57: (1168, {'en': 'Dense freezing drizzle', 'ru': 'Сильная замерзающая морось'}),
+    61: (1183, {'en': 'Light rain', 'ru': 'Небольшой дождь'}),
+    63: (1189, {'en': 'Moderate rain', 'ru': 'Умеренный дождь'}),
+    65: (1195, {'en': 'Heavy rain', 'ru': 'Сильный дождь'}),
+    66: (1198, {'en': 'Light freezing rain', 'ru': 'Слабый ледяной дождь'}),
+    67: (1201, {'en': 'Heavy freezing rain', 'ru': 'Сильный ледяной дождь'}),
+    71: (1213, {'en': 'Light snow', 'ru': 'Небольшой снег'}),
+    73: (1219, {'en': 'Moderate snow', 'ru': 'Умеренный снег'}),
+    75: (1222, {'en': 'Heavy snow', 'ru': 'Сильный снег'}),
+    77: (1261, {'en': 'Snow grains', 'ru': 'Снежная крупа'}),
+    80: (1240, {'en': 'Light rain shower', 'ru': 'Небольшой ливень'}),
+    81: (1243, {'en': 'Rain shower', 'ru': 'Ливень'}),
+    82: (1246, {'en': 'Violent rain shower', 'ru': 'Сильный ливень'}),
+    85: (1255, {'en': 'Light snow showers', 'ru': 'Небольшой снегопад'}),
+    86: (1258, {'en': 'Heavy snow showers', 'ru': 'Сильный снегопад'}),
+    95: (1276, {'en': 'Thunderstorm', 'ru': 'Гроза'}),
+    96: (1276, {'en': 'Thunderstorm with hail', 'ru': 'Гроза с градом'}),
+    99: (1276, {'en': 'Thunderstorm with heavy hail', 'ru': 'Гроза с сильным градом'}),
+}
+
+# Weight of the last request in moving averages of latency and error rate
+STATS_ALPHA = 0.2
+# Provider which fails every request is ranked as if it were this times slower
+ERROR_PENALTY = 10
+
+LATENCY = metrics.gauge('weather_provider_latency_seconds', 'Moving average of latency of weather providers')
+ERROR_RATE = metrics.gauge('weather_provider_error_rate', 'Moving average of share of failed requests')
+
+
+class ProviderStats:
+    """Moving averages of latency and error rate of provider."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.requests = 0
+        self.errors = 0
+        self.latency = 0.0
+        self.error_rate = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, latency: float, ok: bool):
+        with self._lock:
+            alpha = STATS_ALPHA if self.requests else 1
+            self.requests += 1
+            self.errors += not ok
+            self.latency += alpha * (latency - self.latency)
+            self.error_rate += alpha * ((not ok) - self.error_rate)
+        LATENCY.set(self.latency, provider=self.name)
+        ERROR_RATE.set(self.error_rate, provider=self.name)
+
+    def score(self) -> float:
+        """Expected cost of request, the lower the better. Provider without requests is ranked last."""
+        if not self.requests:
+            return float('inf')
+        return self.latency * (1 + ERROR_PENALTY * self.error_rate)
+
+    def snapshot(self) -> dict:
+        return {'requests': self.requests, 'errors': self.errors, 'latency': self.latency,
+                'error_rate': self.error_rate}
+
+
+class Provider:
+    """Source of historical weather. Method history returns 24 hours of the day with the same fields
+    as https://www.weatherapi.com returns: condition (text and code), temp_c, feelslike_c, humidity,
+    wind_kph and wind_degree. It raises KeyError or ValueError on bad response.
+    """
+    name = None
+
+    def __init__(self):
+        self.stats = ProviderStats(self.name)
+
+    def history(self, lat, lon, date: str, lan: str) -> list:
+        raise NotImplementedError
+
+
+class WeatherAPIProvider(Provider):
+    name = 'weatherapi'
+
+    def __init__(self, base_url: str = None, api_key: str = None):
+        super().__init__()
+        self.base_url = base_url or os.environ.get('WEATHER_API_URL', 'https://api.weatherapi.com/v1')
+        self.api_key = api_key or os.environ.get('API_WEATHER_KEY')
+
+    def history(self, lat, lon, date: str, lan: str) -> list:
+        params = {'q': f"{lat},{lon}", 'dt': date, 'lang': lan, 'key': self.api_key}
+        response = http_client.get(f"{self.base_url}/history.json?{urlencode(params)}")
+        return response.json()['forecast']['forecastday'][0]['hour']
+
+
+class OpenMeteoProvider(Provider):
+    """Provider of https://open-meteo.com format, it does not need API key. Forecast API keeps only about
+    3 months of the past, so weather of older dates (e.g. for backfill) is requested from archive API,
+    which gets new days with a delay of several days.
+    """
+    name = 'open-meteo'
+    HOURLY = ('weather_code', 'temperature_2m', 'apparent_temperature', 'relative_humidity_2m',
+              'wind_speed_10m', 'wind_direction_10m')
+    ARCHIVE_AFTER_DAYS = 30  # days older than this are requested from archive
+
+    def __init__(self, base_url: str = None, archive_url: str = None):
+        super().__init__()
+        self.base_url = base_url or os.environ.get('OPEN_METEO_URL', 'https://api.open-meteo.com/v1')
+        self.archive_url = archive_url or os.environ.get('OPEN_METEO_ARCHIVE_URL', 'https://archive-api.open-meteo.com/v1')
+
+    def history(self, lat, lon, date: str, lan: str) -> list:
+        params = {'latitude': lat, 'longitude': lon, 'start_date': date, 'end_date': date,
+                  'hourly': ','.join(self.HOURLY), 'timezone': 'auto'}
+        if datetime.strptime(date, '%Y-%m-%d').date() < datetime.now(timezone.utc).date() - \
+                timedelta(days=self.ARCHIVE_AFTER_DAYS):
+            url = f"{self.archive_url}/archive?{urlencode(params)}"
+        else:
+            url = f"{self.base_url}/forecast?{urlencode(params)}"
+        hourly = http_client.get(url).json()['hourly']
+        hours = []
+        for values in zip(*(hourly[field] for field in self.HOURLY)):
+            if None in values:
+                raise ValueError(f'No weather data in ({lat},{lon}) at {date}')
+            weather_code, temp, feels_like, humidity, wind_speed, wind_degree = values
+            code, text = WMO_CONDITIONS[weather_code]
+            hours.append({'condition': {'text': text.get(lan, text['en']), 'code': code}, 'temp_c': temp,
+                          'feelslike_c': feels_like, 'humidity': humidity, 'wind_kph': wind_speed,
+                          'wind_degree': wind_degree})
+        if not hours:
+            raise ValueError(f'No weather data in ({lat},{lon}) at {date}')
+        return hours
+
+
+PROVIDERS = {provider.name: provider for provider in (WeatherAPIProvider, OpenMeteoProvider)}
+
+
+class Router:
+    """Requests weather from the best provider by statistics of latency and errors. If it does not
+    answer within hedge_delay seconds, the same request is sent to the next provider and the first
+    successful response is used. Failed request is repeated by the next provider at once.
+
+    :param providers: list of providers in the order of preference
+    :param hedge_delay: latency budget of provider in seconds, hedging is off if it is 0
+    """
+
+    def __init__(self, providers: list, hedge_delay: float = 1.0, max_workers: int = 32):
+        self.providers = providers
+        self.hedge_delay = hedge_delay
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix='weather')
+
+    def ranked(self) -> list:
+        order = {id(provider): i for i, provider in enumerate(self.providers)}
+        return sorted(self.providers, key=lambda provider: (provider.stats.score(), order[id(provider)]))
+
+    def stats(self) -> dict:
+        return {provider.name: provider.stats.snapshot() for provider in self.providers}
+
+    def reset_stats(self):
+        for provider in self.providers:
+            provider.stats = ProviderStats(provider.name)
+
+    def history(self, lat, lon, date: str, lan: str) -> list:
+        """Get weather for all hours of the day, see Provider.history.
+        Error of the most preferable provider is raised if all providers failed.
+        """
+        ranked = self.ranked()
+        pending, errors = {}, []
+
+        def launch():
+            rank = len(pending) + len(errors)
+            pending[self._executor.submit(self._call, ranked[rank], lat, lon, date, lan)] = rank
+
+        launch()
+        while pending:
+            can_hedge = len(pending) + len(errors) < len(ranked)
+            done, _ = wait(pending, timeout=self.hedge_delay if self.hedge_delay and can_hedge else None,
+                           return_when=FIRST_COMPLETED)
+            if not done:
+                launch()
+                continue
+            for future in done:
+                rank = pending.pop(future)
+                try:
+                    return future.result()
+                except Exception as e:
+                    errors.append((rank, e))
+            if not pending and len(errors) < len(ranked):
+                launch()
+        raise min(errors, key=lambda error: error[0])[1]
+
+    @staticmethod
+    def _call(provider: Provider, lat, lon, date: str, lan: str) -> list:
+        started = time.perf_counter()
+        try:
+            hours = provider.history(lat, lon, date, lan)
+        except Exception:
+            provider.stats.observe(time.perf_counter() - started, ok=False)
+            raise
+        provider.stats.observe(time.perf_counter() - started, ok=True)
+        return hours
+
+
+def create_router(names, hedge_delay: float = 1.0) -> Router:
+    """Make router of providers with given names, see PROVIDERS."""
+    return Router([PROVIDERS[name.strip()]() for name in names if name.strip()], hedge_delay)
@@ -0,0 +1,61 @@
+"""Worker of the queue of activities without web application, run it from the root of repository:
+
+    python -m utils.worker --size 2 --batch-size 10
+
+Several workers may be started with --partitioned, e.g. one per core, then every worker processes
+and refreshes tokens only of athletes of its partitions, see utils/partitions.py.
+
+It imports only modules which process activities (requests and sqlite3, no Flask), so it starts faster
+than flask run-workers. Database and storage are set by environment variables as for the web application.
+"""
+import argparse
+import functools
+import logging
+import os
+import signal
+import sys
+import threading
+
+from utils import backfill, job_queue, manage_db, metrics, partitions, strava_client, tracing
+
+logger = logging.getLogger(__name__)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=int(os.environ.get('WORKERS', 2)),
+                        help='number of worker threads')
+    parser.add_argument('--batch-size', type=int, default=int(os.environ.get('WORKER_BATCH_SIZE', 10)),
+                        help='number of jobs processed concurrently by a thread')
+    parser.add_argument('--partitioned', action='store_true', default=bool(int(os.environ.get('PARTITIONED_WORKERS', 0))),
+                        help='process only athletes of partitions owned by this process, see utils/partitions.py')
+    parser.add_argument('--worker-id', help='unique ID of partitioned worker, host name and process ID by default')
+    args = parser.parse_args(argv)
+    tracing.init_logging()
+    manage_db.configure({
+        'DATABASE': os.path.join(manage_db.ROOT_PATH, os.environ.get('DATABASE')),
+        'STORAGE_BACKEND': os.environ.get('STORAGE_BACKEND', 'sqlite'),
+        'DATABASE_URL': os.environ.get('DATABASE_URL'),
+    })
+    membership = partitions.Membership(args.worker_id) if args.partitioned else None
+    pool = job_queue.WorkerPool(None, args.size, args.batch_size, on_idle=functools.partial(backfill.step, membership),
+                                membership=membership)
+    refresher = strava_client.TokenRefresher(None, membership=membership)
+    stopped = threading.Event()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signal_number, lambda *_: stopped.set())
+    pool.start()
+    refresher.start()
+    metrics.start_dumping()  # processed activities are summed in /metrics of the web application
+    logger.info('Started %s workers.', args.size)
+    while not stopped.wait(1):
+        pass
+    # jobs in progress are finished, the rest of the queue is processed after restart
+    refresher.stop(0)
+    pool.stop()
+    logger.info('Workers are stopped.')
+    return 0
+
+
+if __name__ == '__main__':  # pragma: no cover
+    sys.exit(main())